@@ -0,0 +1,184 @@
+import sys
+import os
+
+# On my machine I need this line otherwise I get a "ModuleNotFoundError" when
+# trying to import the other modules I have written within this directory.
+sys.path.append(os.getcwd())
+sys.path.append(os.path.join(os.getcwd(), "data-processing"))
+sys.path.append(os.path.join(os.getcwd(), "plg-generation"))
+
+import argparse
+import json
+import platform
+import subprocess
+import datetime
+import numpy as np
+import classes.data as d
+import classes.PLG as plg
+import functions.graph as graph
+import functions.instrumentation as instrumentation
+import functions.date_time as date_time
+from synthetic_data import generate_dataset, LAYOUTS
+from data_cleaner import clean_data
+from node_generation import node_generation
+from get_discrete_vehicle_paths import get_discrete_vehicle_paths
+from adj_mat_generation import adj_mat_generation
+from cluster_generation import cluster_generation
+from travel_dict_generation import travel_dict_generation
+from next_node_table_generation import next_node_table_generation
+
+
+BENCHMARK_LOC = "benchmarks/"
+DATA_LOC = BENCHMARK_LOC+"data/"
+RESULTS_LOC = BENCHMARK_LOC+"results/"
+DEFAULT_SIZES = ["1e4", "1e5", "1e6", "1e7"]
+
+
+###############################################################################
+# get_dataset:                                                                #
+#                                                                             #
+# Purpose: Return the directory of a synthetic dataset with the given         #
+#          parameters, generating it if it doesn't exist yet. The generated   #
+#          datasets are kept in benchmarks/data so that later runs (and the   #
+#          .npy column caches of load_data) can reuse them.                   #
+###############################################################################
+def get_dataset(layout, num_points, seed):
+    dataset_dir = os.path.join(DATA_LOC, f"{layout}_{num_points}_{seed}")
+    done_fname = os.path.join(dataset_dir, "dataset.json")
+    if not os.path.isfile(done_fname):
+        generate_dataset(dataset_dir, layout=layout, num_points=num_points, seed=seed)
+        with open(done_fname, "w") as handle:
+            json.dump({"layout": layout, "num_points": num_points, "seed": seed}, handle)
+    return dataset_dir
+
+
+###############################################################################
+# benchmark_pipeline:                                                         #
+#                                                                             #
+# Purpose: Run every stage of the pipeline on a dataset, from loading the     #
+#          original data through to path generation, and return the           #
+#          instrumentation report of the run.                                 #
+###############################################################################
+def benchmark_pipeline(dataset_dir, num_paths, seed, trace_memory=False):
+    rng = np.random.default_rng(seed)
+    with instrumentation.Instrumentation(trace_memory=trace_memory, run_info={"dataset_dir": dataset_dir}) as run:
+        with instrumentation.stage("load_data") as record:
+            original_data = d.load_data(data_loc=dataset_dir)
+            record.count("data_points", len(original_data.x))
+
+        with instrumentation.stage("clean_data") as record:
+            data = clean_data(original_data)
+            record.count("data_points", len(original_data.x))
+        del original_data
+
+        PLG = plg.PLG()
+        with instrumentation.stage("node_generation") as record:
+            node_generation(PLG, data)
+            record.count("data_points", data.num_data_points)
+            record.count("nodes", PLG.num_nodes)
+
+        with instrumentation.stage("get_discrete_vehicle_paths") as record:
+            get_discrete_vehicle_paths(data, PLG)
+            record.count("data_points", data.num_data_points)
+            record.count("vehicles", len(PLG.vehicle_paths))
+
+        with instrumentation.stage("adj_mat_generation") as record:
+            adj_mat_generation(PLG)
+            record.count("edges", PLG.adjmat.nnz)
+
+        with instrumentation.stage("cluster_generation") as record:
+            cluster_generation(PLG)
+            record.count("vehicles", len(PLG.vehicle_paths))
+
+        with instrumentation.stage("travel_dict_generation") as record:
+            travel_dict_generation(PLG)
+            record.count("vehicles", len(PLG.vehicle_paths))
+
+        with instrumentation.stage("next_node_table_generation") as record:
+            next_node_table_generation(PLG)
+            record.count("table_entries", PLG.next_node_given_target.size)
+
+        # Generate paths from random start nodes to random target clusters
+        start_clusters = rng.choice(list(PLG.start_clusters.keys()), num_paths)
+        start_nodes = [rng.choice(PLG.start_clusters[start_cluster]) for start_cluster in start_clusters]
+        target_clusters = rng.choice(list(PLG.target_clusters.keys()), num_paths)
+        with instrumentation.stage("path_generation") as record:
+            paths = [graph.path_generation(PLG, start_node, target_cluster) for (start_node, target_cluster) in zip(start_nodes, target_clusters)]
+            record.count("paths", len(paths))
+            record.count("path_nodes", sum(len(path) for path in paths))
+
+    return run.report
+
+
+###############################################################################
+# compare_results:                                                            #
+#                                                                             #
+# Purpose: Print the wall time of each stage relative to an earlier results  #
+#          file, so that regressions stand out.                               #
+###############################################################################
+def compare_results(results, baseline_results):
+    def stage_times(results):
+        return {(run["num_points"], stage["name"]): stage["wall_time_s"] for run in results["runs"] for stage in run["report"]["stages"]}
+
+    times = stage_times(results)
+    baseline_times = stage_times(baseline_results)
+    print(f"{'points':>10} {'stage':<40} {'baseline s':>12} {'now s':>12} {'ratio':>8}")
+    for (num_points, name), wall_time in times.items():
+        if (num_points, name) in baseline_times:
+            baseline_time = baseline_times[(num_points, name)]
+            ratio = wall_time / baseline_time if baseline_time > 0 else float("inf")
+            print(f"{num_points:>10} {name:<40} {baseline_time:>12.4f} {wall_time:>12.4f} {ratio:>8.2f}")
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each stage of the PLG pipeline on synthetic datasets of increasing size.")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="numbers of data points, e.g. 1e4 1e5")
+    parser.add_argument("--layout", choices=LAYOUTS, default="grid")
+    parser.add_argument("--num-paths", type=int, default=1000, help="number of paths to generate in the path_generation stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="also record the tracemalloc peak of each stage (slower)")
+    parser.add_argument("--compare", help="earlier results file to compare the wall times against")
+    parser.add_argument("--output", help="results file, defaults to benchmarks/results/<time>.json")
+    args = parser.parse_args()
+
+    results = {"created": datetime.datetime.now().isoformat(),
+               "git_commit": get_git_commit(),
+               "platform": platform.platform(),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "cpu_count": os.cpu_count(),
+               "layout": args.layout,
+               "seed": args.seed,
+               "runs": []}
+    output = args.output or os.path.join(RESULTS_LOC, datetime.datetime.now().strftime("%Y%m%d_%H%M%S")+".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    for size in args.sizes:
+        num_points = int(float(size))
+        print(date_time.get_current_time(), f"Benchmarking {num_points} data points")
+        dataset_dir = get_dataset(args.layout, num_points, args.seed)
+        report = benchmark_pipeline(dataset_dir, args.num_paths, args.seed, trace_memory=args.trace_memory)
+        results["runs"].append({"num_points": num_points, "report": report})
+        for stage in report["stages"]:
+            print(f"    {stage['name']:<40} {stage['wall_time_s']:>10.4f} s")
+
+        # Save after every size so that the results of the smaller sizes are
+        # kept if a larger size runs out of memory
+        with open(output, "w") as handle:
+            json.dump(results, handle, indent=1, default=str)
+    print(date_time.get_current_time(), f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare, "r") as handle:
+            compare_results(results, json.load(handle))
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,227 @@
+import sys
+import os
+
+# On my machine I need this line otherwise I get a "ModuleNotFoundError" when
+# trying to import the other modules I have written within this directory.
+sys.path.append(os.getcwd())
+
+import argparse
+import json
+import numpy as np
+import classes.data as d
+
+
+LAYOUTS = ["corridor", "intersection", "grid"]
+LANE_WIDTH = 3.5
+# Lane ID used for the parts of a path which are not on a lane, e.g. within a
+# junction. This is the same lane ID load_data uses if there are no lane IDs.
+NO_LANE_ID = 0
+# Vehicles are first and last recorded up to this many metres from the ends
+# of their route
+MAX_TRIM = 20
+
+
+###############################################################################
+# Road layouts:                                                               #
+#                                                                             #
+# Each layout function returns a function which, given a random number        #
+# generator, returns the route of a random vehicle as a polyline: a 2D numpy  #
+# array of [x, y] points in metres and a 1D numpy array with the lane ID of   #
+# each segment of the polyline. Traffic drives on the right.                  #
+###############################################################################
+def corridor_layout(length=1000, num_lanes=2):
+    # A straight road along the x axis with num_lanes lanes in each direction.
+    # Lanes 1..num_lanes go in the +x direction, the rest go in -x. Vehicles
+    # join the road somewhere in its first quarter and leave it somewhere in
+    # its last quarter, so there are many entry and exit points.
+    def route(rng):
+        lane = rng.integers(2*num_lanes)
+        x_start, x_end = rng.uniform(0, length/4), rng.uniform(3*length/4, length)
+        if lane < num_lanes:
+            y = -(lane + 0.5)*LANE_WIDTH
+            points = np.array([[x_start, y], [x_end, y]])
+        else:
+            y = (lane - num_lanes + 0.5)*LANE_WIDTH
+            points = np.array([[length - x_start, y], [length - x_end, y]])
+        return points, np.array([lane + 1])
+    return route
+
+
+def intersection_layout(arm_length=200, stop_line=10):
+    # A four way junction at the origin. Vehicles enter on one arm and leave
+    # on any other arm. The inbound lane of arm ii has lane ID ii+1 and the
+    # outbound lane has lane ID ii+5.
+    arm_directions = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]])
+
+    def route(rng):
+        arm_in = rng.integers(4)
+        arm_out = (arm_in + rng.integers(1, 4)) % 4
+        d_in = arm_directions[arm_in]
+        d_out = arm_directions[arm_out]
+        # Offset to the right of the direction of travel
+        offset_in = np.array([-d_in[1], d_in[0]])*LANE_WIDTH/2
+        offset_out = np.array([d_out[1], -d_out[0]])*LANE_WIDTH/2
+        points = np.array([arm_length*d_in + offset_in, stop_line*d_in + offset_in, stop_line*d_out + offset_out, arm_length*d_out + offset_out])
+        return points, np.array([arm_in + 1, NO_LANE_ID, arm_out + 5])
+    return route
+
+
+def grid_layout(num_blocks=5, block_length=100, max_blocks_per_route=12):
+    # A square grid of two way roads. Vehicles enter at the edge of the grid
+    # and drive a random walk along the roads, without turning back on
+    # themselves, until they leave the grid. Each direction of each road
+    # segment has its own lane ID.
+    moves = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]])
+
+    def lane_id(node, move):
+        return 1 + 4*(node[0]*(num_blocks + 1) + node[1]) + move
+
+    def route(rng):
+        # Start on a random node at the edge of the grid, driving inwards
+        edge = rng.integers(4)
+        ii = rng.integers(1, num_blocks)
+        node = [np.array([0, ii]), np.array([ii, 0]), np.array([num_blocks, ii]), np.array([ii, num_blocks])][edge]
+        move = edge
+        nodes = [node]
+        lane_ids = []
+        for _ in range(max_blocks_per_route):
+            lane_ids.append(lane_id(node, move))
+            node = node + moves[move]
+            nodes.append(node)
+            if (node.min() == 0) or (node.max() == num_blocks):
+                break
+            # Go straight, left or right
+            move = (move + rng.choice([0, 1, 3])) % 4
+
+        # Offset each road segment to the right of the direction of travel
+        points = []
+        for (start, end) in zip(nodes[:-1], nodes[1:]):
+            direction = end - start
+            offset = np.array([direction[1], -direction[0]])*LANE_WIDTH/2
+            points.append(start*block_length + offset)
+            points.append(end*block_length + offset)
+        # The segments between the offset points of consecutive road segments
+        # are within a junction
+        segment_lane_ids = np.full(len(points) - 1, NO_LANE_ID)
+        segment_lane_ids[::2] = lane_ids
+        return np.array(points, dtype=float), segment_lane_ids
+    return route
+
+
+def get_layout(layout):
+    if layout == "corridor":
+        return corridor_layout()
+    elif layout == "intersection":
+        return intersection_layout()
+    elif layout == "grid":
+        return grid_layout()
+    raise ValueError(f"Unknown layout \"{layout}\", choose from {LAYOUTS}")
+
+
+###############################################################################
+# sample_route:                                                               #
+#                                                                             #
+# Purpose: Sample the position of a vehicle driving along a route at a        #
+#          constant speed. Like in a real dataset, vehicles are first and     #
+#          last recorded at slightly different points of the route.           #
+#                                                                             #
+# Params: IN  points        - 2D numpy array, the polyline of the route.      #
+#         IN  lane_ids      - Lane ID of each segment of the polyline.        #
+#         IN  speed         - Speed of the vehicle in m/s.                    #
+#         IN  sampling_rate - Number of samples per second.                   #
+#         IN  trim          - (start, end) distance in m of the route which   #
+#                             is not recorded.                                #
+#         OUT x, y, lane_id - 1D numpy arrays of the samples.                 #
+#                                                                             #
+###############################################################################
+def sample_route(points, lane_ids, speed, sampling_rate, trim=(0, 0)):
+    segment_lengths = np.hypot(*np.diff(points, axis=0).T)
+    distance_along_route = np.concatenate(([0], np.cumsum(segment_lengths)))
+    s = np.arange(trim[0], distance_along_route[-1] - trim[1], speed/sampling_rate)
+    x = np.interp(s, distance_along_route, points[:,0])
+    y = np.interp(s, distance_along_route, points[:,1])
+    segment = np.clip(np.searchsorted(distance_along_route, s, side="right") - 1, 0, len(lane_ids) - 1)
+    return x, y, lane_ids[segment]
+
+
+###############################################################################
+# generate_dataset:                                                           #
+#                                                                             #
+# Purpose: Generate a synthetic dataset of vehicle trajectories and write it  #
+#          in the same format as the original datasets: the Global_X,         #
+#          Global_Y, Vehicle_ID and Lane_ID text files, with one data point   #
+#          per line. The coordinates are written in UNIT (see inputs.py) so   #
+#          the dataset can be loaded with classes.data.load_data.             #
+#                                                                             #
+# Params: IN  save_dir      - Directory to write the files to.                #
+#         IN  layout        - Road layout, one of LAYOUTS.                    #
+#         IN  num_vehicles  - Number of vehicles to generate. Either this or  #
+#                             num_points must be given.                       #
+#         IN  num_points    - Number of data points to generate. Vehicles are #
+#                             generated until there are this many data        #
+#                             points, the last one is cut short.              #
+#         IN  sampling_rate - Number of samples per second per vehicle.       #
+#         IN  speed_range   - (min, max) speed of the vehicles in m/s.        #
+#         IN  noise         - Standard deviation of the position noise in m.  #
+#         IN  anomaly_rate  - Probability that a data point is replaced by an #
+#                             anomalous jump, which clean_data removes.       #
+#         IN  seed          - Random seed.                                    #
+#         OUT num_points    - Number of data points written.                  #
+#                                                                             #
+###############################################################################
+def generate_dataset(save_dir, layout="grid", num_vehicles=None, num_points=None, sampling_rate=10, speed_range=(5, 15), noise=0.3, anomaly_rate=1e-4, seed=0):
+    if (num_vehicles is None) == (num_points is None):
+        raise ValueError("Specify exactly one of num_vehicles and num_points")
+
+    rng = np.random.default_rng(seed)
+    route = get_layout(layout)
+    columns = {"x": [], "y": [], "vehicle_id": [], "lane_id": []}
+    total_points = 0
+    vehicle_id = 0
+    while (vehicle_id < num_vehicles) if num_points is None else (total_points < num_points):
+        points, lane_ids = route(rng)
+        x, y, lane_id = sample_route(points, lane_ids, rng.uniform(*speed_range), sampling_rate, trim=rng.uniform(0, MAX_TRIM, 2))
+        if num_points is not None:
+            num_samples = min(len(x), num_points - total_points)
+            x, y, lane_id = x[:num_samples], y[:num_samples], lane_id[:num_samples]
+        columns["x"].append(x)
+        columns["y"].append(y)
+        columns["lane_id"].append(lane_id)
+        columns["vehicle_id"].append(np.full(len(x), vehicle_id + 1))
+        total_points += len(x)
+        vehicle_id += 1
+
+    x = np.concatenate(columns["x"])
+    y = np.concatenate(columns["y"])
+    x += rng.normal(0, noise, len(x))
+    y += rng.normal(0, noise, len(y))
+    is_anomaly = rng.uniform(size=len(x)) < anomaly_rate
+    x[is_anomaly] += rng.choice([-1, 1], np.sum(is_anomaly))*rng.uniform(50, 200, np.sum(is_anomaly))
+
+    # Write the columns in the units of the dataset
+    os.makedirs(save_dir, exist_ok=True)
+    np.savetxt(os.path.join(save_dir, "Global_X"), x/d.UNIT_CONVERSION, fmt="%.3f")
+    np.savetxt(os.path.join(save_dir, "Global_Y"), y/d.UNIT_CONVERSION, fmt="%.3f")
+    np.savetxt(os.path.join(save_dir, "Vehicle_ID"), np.concatenate(columns["vehicle_id"]), fmt="%d")
+    np.savetxt(os.path.join(save_dir, "Lane_ID"), np.concatenate(columns["lane_id"]), fmt="%d")
+
+    return total_points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset of vehicle trajectories.")
+    parser.add_argument("save_dir", help="directory to write Global_X, Global_Y, Vehicle_ID and Lane_ID to, e.g. data/<dataset>/original")
+    parser.add_argument("--layout", choices=LAYOUTS, default="grid")
+    size = parser.add_mutually_exclusive_group(required=True)
+    size.add_argument("--num-vehicles", type=int)
+    size.add_argument("--num-points", type=lambda value: int(float(value)))
+    parser.add_argument("--sampling-rate", type=float, default=10, help="samples per second")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    num_points = generate_dataset(args.save_dir, layout=args.layout, num_vehicles=args.num_vehicles, num_points=args.num_points, sampling_rate=args.sampling_rate, seed=args.seed)
+    print(json.dumps({"save_dir": args.save_dir, "layout": args.layout, "num_points": num_points}))
+
+
+if __name__=="__main__":
+    main()
@@ -1,3 +1,21 @@
+import numpy as np
+import scipy.sparse as sp
+import os
+import json
+import shutil
+import threading
+import functions.general as g
+
+
+# Version of the on-disk PLG format written by save_plg. Bump this whenever
+# the layout of the manifest or the arrays changes.
+PLG_FORMAT_VERSION = 1
+PLG_MANIFEST_NAME = "manifest.json"
+# Attributes which describe the state of a PLG object in memory rather than
+# the PLG itself. These are not saved by save_plg.
+PLG_RUNTIME_ATTRIBUTES = ["lazy_attributes", "frozen", "frozen_arrays"]
+
+
 ###############################################################################
 # This file contains the PLG class, which is used to store the PLG data.      #
 #                                                                             #
@@ -8,38 +26,367 @@
 # node_lane_ids            - The i'th entry contains the lane ID for the node #
 #                            i.                                               #
 # vehicle_paths            - A dictionary of {vehicle ID : node path}         #
-# adjmat                   - A 2D numpy adjacency matrix populated with the   #
-#                            connection probability.                          #
+# adjmat                   - A scipy.sparse CSR adjacency matrix populated    #
+#                            with the connection probability.                 #
+# adjmat_counts            - A scipy.sparse CSR int64 matrix. Entry [i, j] is #
+#                            the number of times vehicles went from node i to #
+#                            node j, adjmat is normalised from this.          #
 # start_cluster_centres    - A 2D numpy matrix of [x,y] coordinates. The i'th #
 #                            row contains the i'th row contains the           #
 #                            coordinates for cluster i.                       #
 # target_cluster_centres   - Similar to above but for target clusters.        #
 # start_clusters           - A dictionary of {cluster id : [list of nodes]}.  #
 # target_clusters          - Similar to above but for target clusters.        #
+# node_start_cluster       - A 1D numpy array. The i'th entry contains the    #
+#                            start cluster of node i, or -1 if node i is not  #
+#                            in a start cluster.                              #
+# node_target_cluster      - Similar to above but for target clusters.        #
+# start_cluster_mask       - A 2D boolean numpy array. Entry [c, i] is True   #
+#                            if node i is in start cluster c.                 #
+# target_cluster_mask      - Similar to above but for target clusters.        #
 # closest_clusters_dict    - A dictionary of {cluster id : [list of cluster   #
 #                            IDs]}. Where the list of cluster IDs is ordered  #
 #                            from lowest to highest with respect to their     #
 #                            distance from the key value.                     #
 # p_next_node              - A 2D numpy adjacency matrix populated with the   #
 #                            connection probability.                          #
-# p_next_node_given_target - A 2D numpy adjacency matrix populated with the   #
-#                            connection probability. However, this matrix is  #
+# p_next_node_given_target - A dictionary of {target cluster : scipy.sparse   #
+#                            CSR adjacency matrix} populated with the         #
+#                            connection probability. However, each matrix is  #
 #                            built from vehicles which all had the same       #
 #                            target cluster as their destination.             #
+# transition_counts_given_target                                              #
+#                          - A dictionary of {target cluster : scipy.sparse   #
+#                            CSR int64 matrix} of the transition counts which #
+#                            p_next_node_given_target is normalised from.     #
+# next_node_given_target   - A 2D int32 numpy array of shape [number of       #
+#                            target clusters, num_nodes]. Entry [t, n] is the #
+#                            most likely next node from node n given the      #
+#                            target cluster t (falling back to the closest    #
+#                            clusters), or -1 if there is no next node.       #
+# origin                   - A 1D numpy array, the [x, y] position (in        #
+#                            metres) which was subtracted from the raw data   #
+#                            when it was loaded (see load_data), or None if   #
+#                            it is not known. Data which is added to the PLG  #
+#                            later on must be loaded with the same origin.    #
 #                                                                             #
 ###############################################################################
 class PLG:
+    # Lock used so that only one thread loads a lazily loaded attribute
+    lazy_attribute_lock = threading.RLock()
+
     def __init__(self) -> None:
         self.num_nodes = None
         self.nodes = None
         self.node_lane_ids = None
         self.vehicle_paths = None
         self.adjmat = None
+        self.adjmat_counts = None
         self.start_cluster_centres = None
         self.target_cluster_centres = None
         self.start_clusters = None
         self.target_clusters = None
+        self.node_start_cluster = None
+        self.node_target_cluster = None
+        self.start_cluster_mask = None
+        self.target_cluster_mask = None
         self.closest_clusters_dict = None
         self.p_next_node = None
         self.p_next_node_given_target = None
+        self.transition_counts_given_target = None
+        self.next_node_given_target = None
+        self.origin = None
+
+    def __getattr__(self, name):
+        # This is only called when an attribute is not found in the usual
+        # places. For a PLG opened with load_plg the attributes are loaded
+        # from disk the first time they are accessed.
+        lazy_attributes = self.__dict__.get("lazy_attributes")
+        if (lazy_attributes is None) or (name not in lazy_attributes):
+            raise AttributeError(f"'PLG' object has no attribute '{name}'")
+        with PLG.lazy_attribute_lock:
+            # Another thread may have loaded the attribute while we waited
+            if name in self.__dict__:
+                return self.__dict__[name]
+            value = lazy_attributes[name]()
+            self.freeze_if_frozen(value)
+            setattr(self, name, value)
+            del lazy_attributes[name]
+        return value
+
+    def __getstate__(self):
+        # Load any attributes which are still on disk so the PLG can be
+        # pickled
+        self.load_all_attributes()
+        return self.__dict__
+
+    def load_all_attributes(self):
+        """Load every attribute which has not been accessed yet."""
+        for name in list(self.__dict__.get("lazy_attributes", {})):
+            getattr(self, name)
+        self.__dict__.pop("lazy_attributes", None)
+
+    def freeze(self):
+        """Mark every array of the PLG (including the arrays behind the sparse
+        matrices) as non-writeable. A frozen PLG can be read by many threads
+        at once without taking copies of it. Attributes which are loaded
+        lazily are frozen when they are loaded."""
+        if self.__dict__.get("frozen", False):
+            return self
+        self.frozen = True
+        self.frozen_arrays = []
+        for name, value in list(vars(self).items()):
+            if name not in PLG_RUNTIME_ATTRIBUTES:
+                self.frozen_arrays += freeze_value(value)
+        return self
+
+    def freeze_if_frozen(self, value):
+        """Freeze "value", e.g. an attribute which is added to the PLG, if the
+        PLG is frozen."""
+        if self.__dict__.get("frozen", False):
+            self.__dict__.setdefault("frozen_arrays", []).extend(freeze_value(value))
+
+    def unfreeze(self):
+        """Undo freeze. Only the arrays which were made non-writeable by the
+        PLG being frozen are made writeable again, arrays which were already
+        read-only (e.g. arrays memory mapped read-only by load_plg) stay
+        read-only."""
+        # A view can only be made writeable once its base is, so keep going
+        # over the arrays which failed until none of them can be restored
+        pending_arrays = self.__dict__.get("frozen_arrays", [])
+        while pending_arrays:
+            failed_arrays = []
+            for array in pending_arrays:
+                try:
+                    array.flags.writeable = True
+                except ValueError:
+                    failed_arrays.append(array)
+            if len(failed_arrays) == len(pending_arrays):
+                break
+            pending_arrays = failed_arrays
+        self.frozen = False
+        self.frozen_arrays = []
+        return self
+
+
+def freeze_value(value):
+    """Mark the arrays in "value" as non-writeable. "value" can be a numpy
+    array, a scipy.sparse matrix or a dictionary/list of them. Returns the
+    list of arrays which were writeable before, see PLG.unfreeze."""
+    frozen_arrays = []
+    if isinstance(value, np.ndarray):
+        if value.flags.writeable:
+            value.flags.writeable = False
+            frozen_arrays.append(value)
+    elif sp.issparse(value):
+        for array_name in ("data", "indices", "indptr", "row", "col"):
+            if isinstance(getattr(value, array_name, None), np.ndarray):
+                frozen_arrays += freeze_value(getattr(value, array_name))
+    elif isinstance(value, dict):
+        for entry in value.values():
+            frozen_arrays += freeze_value(entry)
+    elif isinstance(value, (list, tuple)):
+        for entry in value:
+            if isinstance(entry, np.ndarray) or sp.issparse(entry):
+                frozen_arrays += freeze_value(entry)
+    return frozen_arrays
+
+
+###############################################################################
+# On-disk PLG format:                                                         #
+#                                                                             #
+# A PLG is saved as a directory containing a "manifest.json" file and one     #
+# .npy file per array. The manifest records the format version and, for each  #
+# attribute of the PLG, how to rebuild it from the arrays:                    #
+#                                                                             #
+# none        - The attribute is None.                                        #
+# value       - A scalar stored in the manifest itself.                       #
+# array       - A numpy array.                                                #
+# csr         - A scipy.sparse CSR matrix stored as its data, indices and     #
+#               indptr arrays.                                                #
+# csr_dict    - A dictionary of {key : CSR matrix}.                           #
+# ragged_dict - A dictionary of {key : list/array of integers}, e.g., the     #
+#               vehicle paths, stored as a keys array, an offsets array and a #
+#               flat values array.                                            #
+# pickle      - Anything else, stored with the pickle module.                 #
+#                                                                             #
+# load_plg opens the arrays with memory mapping and only loads an attribute   #
+# when it is first accessed. Opening a PLG therefore only reads the manifest  #
+# and processes which open the same PLG share the same pages.                 #
+###############################################################################
+def is_numeric_vector(value):
+    """Returns True if "value" can be stored as a 1D numeric numpy array."""
+    return (np.ndim(value) == 1) and ((len(value) == 0) or np.issubdtype(np.asarray(value).dtype, np.number))
+
+
+def is_integer_vector(value):
+    """Returns True if "value" can be stored as a 1D integer numpy array."""
+    return (np.ndim(value) == 1) and ((len(value) == 0) or np.issubdtype(np.asarray(value).dtype, np.integer))
+
+
+def has_integer_keys(dict):
+    """Returns True if every key of "dict" is an integer."""
+    return all(isinstance(key, (int, np.integer)) and not isinstance(key, bool) for key in dict)
+
+
+def save_plg(PLG, save_dir):
+    """Save a PLG object in the versioned on-disk format.
+
+    Args:
+        PLG (PLG): PLG object to save.
+        save_dir (string): Directory to save the PLG to. Anything already at
+            this path is replaced.
+    """
+    # The PLG might have been opened from save_dir itself so load everything
+    # before we start writing
+    PLG.load_all_attributes()
+    save_attributes({name: value for name, value in vars(PLG).items() if name not in PLG_RUNTIME_ATTRIBUTES}, save_dir)
+
+
+def save_attributes(attributes_to_save, save_dir):
+    """Save a dictionary of {name : value} in the versioned on-disk format
+    used by save_plg. Each value is stored in the most compact way the format
+    supports.
+
+    Args:
+        attributes_to_save (dict): {name : value} to save.
+        save_dir (string): Directory to save the attributes to. Anything
+            already at this path is replaced.
+    """
+    tmp_dir = save_dir+".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    def save_array(fname, array):
+        np.save(os.path.join(tmp_dir, fname), np.asarray(array))
+        return fname
+
+    def describe_csr(name, mat):
+        mat = sp.csr_matrix(mat)
+        return {"data": save_array(name+".data.npy", mat.data),
+                "indices": save_array(name+".indices.npy", mat.indices),
+                "indptr": save_array(name+".indptr.npy", mat.indptr),
+                "shape": list(mat.shape)}
+
+    attributes = {}
+    for name, value in attributes_to_save.items():
+        if value is None:
+            attributes[name] = {"kind": "none"}
+        elif isinstance(value, (bool, int, float, str, np.generic)):
+            attributes[name] = {"kind": "value", "value": value.item() if isinstance(value, np.generic) else value}
+        elif isinstance(value, np.ndarray) and (value.dtype != object):
+            attributes[name] = {"kind": "array", "file": save_array(name+".npy", value)}
+        elif isinstance(value, list) and is_numeric_vector(value):
+            attributes[name] = {"kind": "array", "file": save_array(name+".npy", value), "value_type": "list"}
+        elif sp.issparse(value):
+            attributes[name] = dict(kind="csr", **describe_csr(name, value))
+        elif isinstance(value, dict) and (len(value) > 0) and has_integer_keys(value) and all(sp.issparse(mat) for mat in value.values()):
+            keys = list(value.keys())
+            attributes[name] = {"kind": "csr_dict",
+                                "keys": [int(key) for key in keys],
+                                "matrices": [describe_csr(f"{name}.{ii}", value[key]) for ii, key in enumerate(keys)]}
+        elif isinstance(value, dict) and has_integer_keys(value) and all(is_integer_vector(entry) for entry in value.values()):
+            keys = list(value.keys())
+            entries = [np.asarray(value[key], dtype=np.int64) for key in keys]
+            offsets = np.concatenate(([0], np.cumsum([len(entry) for entry in entries]))).astype(np.int64)
+            attributes[name] = {"kind": "ragged_dict",
+                                "keys": save_array(name+".keys.npy", np.array(keys, dtype=np.int64)),
+                                "offsets": save_array(name+".offsets.npy", offsets),
+                                "values": save_array(name+".values.npy", np.concatenate(entries) if entries else np.zeros(0, dtype=np.int64)),
+                                "value_type": "array" if all(isinstance(value[key], np.ndarray) for key in keys) else "list"}
+        else:
+            g.save_pickled_data(os.path.join(tmp_dir, name+".pickle"), value)
+            attributes[name] = {"kind": "pickle", "file": name+".pickle"}
+
+    manifest = {"format": "PLG", "version": PLG_FORMAT_VERSION, "attributes": attributes}
+    with open(os.path.join(tmp_dir, PLG_MANIFEST_NAME), "w") as handle:
+        json.dump(manifest, handle, indent=1)
+
+    # Replace whatever was at save_dir (an older PLG directory or pickle)
+    if os.path.isdir(save_dir):
+        shutil.rmtree(save_dir)
+    elif os.path.exists(save_dir):
+        os.remove(save_dir)
+    os.replace(tmp_dir, save_dir)
+
+
+def load_plg(load_dir, mmap_mode="r"):
+    """Open a PLG saved with save_plg. Attributes are loaded the first time
+    they are accessed. PLGs saved with the pickle module are also accepted.
+
+    Args:
+        load_dir (string): Directory the PLG was saved to.
+        mmap_mode (string, optional): Memory mapping mode passed to np.load.
+            Defaults to "r", i.e., the arrays are read-only. Set to None to
+            read the arrays into memory instead.
+
+    Returns:
+        PLG: The PLG object.
+    """
+    # Older PLGs were saved with the pickle module
+    if os.path.isfile(load_dir):
+        return g.load_pickled_data(load_dir)
+
+    # Any attribute which isn't in the manifest keeps its default value
+    loaded_PLG = PLG()
+    lazy_attributes = load_attributes(load_dir, mmap_mode=mmap_mode)
+    for name in lazy_attributes:
+        if hasattr(loaded_PLG, name):
+            delattr(loaded_PLG, name)
+    loaded_PLG.lazy_attributes = lazy_attributes
+
+    return loaded_PLG
+
+
+def load_attributes(load_dir, mmap_mode="r"):
+    """Open a directory written by save_attributes (or save_plg). Nothing is
+    read until the loaders are called.
+
+    Args:
+        load_dir (string): Directory the attributes were saved to.
+        mmap_mode (string, optional): See load_plg.
+
+    Returns:
+        dict: {name : loader}, where calling loader() returns the value.
+    """
+    with open(os.path.join(load_dir, PLG_MANIFEST_NAME), "r") as handle:
+        manifest = json.load(handle)
+    if manifest.get("format") != "PLG" or manifest.get("version", 0) > PLG_FORMAT_VERSION:
+        raise ValueError(f"{load_dir} is not a PLG in a format this code can read (version {manifest.get('version')})")
+
+    def load_array(fname):
+        return np.load(os.path.join(load_dir, fname), mmap_mode=mmap_mode)
+
+    def load_csr(description):
+        return sp.csr_matrix((load_array(description["data"]), load_array(description["indices"]), load_array(description["indptr"])), shape=tuple(description["shape"]))
+
+    def attribute_loader(description):
+        kind = description["kind"]
+        if kind == "none":
+            return lambda: None
+        elif kind == "value":
+            return lambda: description["value"]
+        elif kind == "array":
+            if description.get("value_type") == "list":
+                return lambda: load_array(description["file"]).tolist()
+            return lambda: load_array(description["file"])
+        elif kind == "csr":
+            return lambda: load_csr(description)
+        elif kind == "csr_dict":
+            return lambda: {key: load_csr(mat) for key, mat in zip(description["keys"], description["matrices"])}
+        elif kind == "ragged_dict":
+            def load_ragged_dict():
+                keys = load_array(description["keys"]).tolist()
+                offsets = load_array(description["offsets"])
+                values = load_array(description["values"])
+                entries = [values[offsets[ii]:offsets[ii+1]] for ii in range(len(keys))]
+                if description["value_type"] == "list":
+                    entries = [entry.tolist() for entry in entries]
+                return dict(zip(keys, entries))
+            return load_ragged_dict
+        elif kind == "pickle":
+            return lambda: g.load_pickled_data(os.path.join(load_dir, description["file"]))
+        raise ValueError(f"Unknown PLG attribute kind \"{kind}\"")
 
+    return {name: attribute_loader(description) for name, description in manifest["attributes"].items()}
@@ -1,9 +1,17 @@
 import numpy as np
+import os
+import json
+import shutil
+import itertools
 import functions.general as g
+import classes.PLG as plg
 from inputs import *
 
 
 DATA_LOC = "data/"+DATASET+"/original/"
+# Directory, next to a cleaned dataset, of the cleaned data added by
+# plg_update.py (see save_cleaned_data_update)
+CLEANED_DATA_UPDATES_SUFFIX = ".updates"
 ONE_FOOT_IN_METRES = 0.3048
 ONE_METRE_IN_METRES = 1
 # Add any other units here:
@@ -15,32 +23,247 @@ elif UNIT == "metres":
     UNIT_CONVERSION = ONE_METRE_IN_METRES
 
 
+###############################################################################
+# load_column:                                                                #
+#                                                                             #
+# Purpose: Load a single column of the original dataset from its text file.   #
+#          Parsing the text files is slow so the first time a file is parsed  #
+#          we save a binary .npy cache of the column next to it, along with a #
+#          small .json file recording the size and modification time of the   #
+#          text file. The column is returned as the cache opened with memory  #
+#          mapping, so it is paged in lazily. The cache is rebuilt if the     #
+#          size or modification time of the text file changes.                #
+#                                                                             #
+#          If chunk_size is given the text file is parsed chunk_size lines at #
+#          a time, straight into the memory mapped cache, so the column is    #
+#          never held in memory in one go.                                    #
+#                                                                             #
+# Params: IN fname      - Path to the text file.                              #
+#         IN dtype      - The dtype of the column.                            #
+#         IN chunk_size - Optional, number of lines to parse at a time.       #
+#                                                                             #
+# Returns: numpy array of the column. Raises FileNotFoundError if the text    #
+#          file does not exist.                                               #
+###############################################################################
+def load_column(fname, dtype, chunk_size=None):
+    # Describe the text file, this raises FileNotFoundError if it is missing
+    fname_stat = os.stat(fname)
+    cache_fname = fname+".npy"
+    cache_info_fname = fname+".npy.json"
+    cache_info = {"size": fname_stat.st_size, "mtime_ns": fname_stat.st_mtime_ns, "dtype": np.dtype(dtype).str}
+
+    # Use the cache if it is up to date with the text file
+    try:
+        with open(cache_info_fname, "r") as handle:
+            if json.load(handle) == cache_info:
+                return np.load(cache_fname, mmap_mode="r")
+    except (OSError, ValueError):
+        pass
+
+    # Otherwise parse the text file and (re)build the cache. We write to
+    # temporary files first so that a partially written cache is never used.
+    if chunk_size is not None:
+        parse_column_in_chunks(fname, cache_fname+".tmp", dtype, chunk_size)
+        with open(cache_info_fname+".tmp", "w") as handle:
+            json.dump(cache_info, handle)
+        os.replace(cache_fname+".tmp", cache_fname)
+        os.replace(cache_info_fname+".tmp", cache_info_fname)
+        return np.load(cache_fname, mmap_mode="r")
+
+    column = np.genfromtxt(fname, dtype=dtype)
+    try:
+        with open(cache_fname+".tmp", "wb") as handle:
+            np.save(handle, column)
+        with open(cache_info_fname+".tmp", "w") as handle:
+            json.dump(cache_info, handle)
+        os.replace(cache_fname+".tmp", cache_fname)
+        os.replace(cache_info_fname+".tmp", cache_info_fname)
+        # Return the cache so that the parsed column can be freed
+        column = np.load(cache_fname, mmap_mode="r")
+    except OSError:
+        # We can still carry on without a cache, e.g., if the dataset is in
+        # a read-only location
+        pass
+
+    return column
+
+
+###############################################################################
+# parse_column_in_chunks:                                                     #
+#                                                                             #
+# Purpose: Parse a text file with one value per line into a .npy file,        #
+#          chunk_size lines at a time. The file is read twice, first to count #
+#          the lines and then to parse them.                                  #
+#                                                                             #
+# Params: IN fname      - Path to the text file.                              #
+#         IN npy_fname  - Path to the .npy file to write.                     #
+#         IN dtype      - The dtype of the column.                            #
+#         IN chunk_size - Number of lines to parse at a time.                 #
+###############################################################################
+def parse_column_in_chunks(fname, npy_fname, dtype, chunk_size):
+    with open(fname, "r") as handle:
+        num_rows = sum(1 for line in handle if line.strip())
+    column = np.lib.format.open_memmap(npy_fname, mode="w+", dtype=dtype, shape=(num_rows,))
+    with open(fname, "r") as handle:
+        lines = (line for line in handle if line.strip())
+        row = 0
+        while row < num_rows:
+            chunk = np.loadtxt(list(itertools.islice(lines, chunk_size)), dtype=dtype, ndmin=1)
+            column[row:row+len(chunk)] = chunk
+            row += len(chunk)
+    column.flush()
+    del column
+
+
+###############################################################################
+# convert_column_in_chunks:                                                   #
+#                                                                             #
+# Purpose: Convert a column of coordinates to metres and shift it by an       #
+#          offset, chunk_size values at a time, writing the result to a .npy  #
+#          file. By default the offset is the minimum of the converted        #
+#          column, so the column starts at 0. Gives exactly the same values   #
+#          as "column*UNIT_CONVERSION" followed by subtracting the offset.    #
+#                                                                             #
+#          Like load_column, a small .json file records the size and          #
+#          modification time of the .npy cache the column was loaded from,    #
+#          the unit conversion and the requested offset. The .npy file is     #
+#          reused, without reading the column, for as long as these don't     #
+#          change.                                                            #
+#                                                                             #
+# Params: IN  column       - 1D (memory mapped) numpy array of coordinates.   #
+#         IN  source_fname - Path to the .npy cache "column" was loaded from. #
+#         IN  npy_fname    - Path to the .npy file to write.                  #
+#         IN  chunk_size   - Number of values to convert at a time.           #
+#         IN  offset       - Optional, the value (in metres) to subtract.     #
+#                            Defaults to None, i.e., the column minimum.      #
+#         OUT converted    - The converted column, memory mapped read-only.   #
+#         OUT offset       - The value which was subtracted.                  #
+###############################################################################
+def convert_column_in_chunks(column, source_fname, npy_fname, chunk_size, offset=None):
+    source_stat = os.stat(source_fname)
+    info_fname = npy_fname+".json"
+    info = {"size": source_stat.st_size, "mtime_ns": source_stat.st_mtime_ns, "unit_conversion": UNIT_CONVERSION, "offset": offset}
+
+    # Use the converted column if it is up to date with the source cache
+    try:
+        with open(info_fname, "r") as handle:
+            cached_info = json.load(handle)
+        if cached_info["source"] == info:
+            return np.load(npy_fname, mmap_mode="r"), cached_info["offset"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    if offset is None:
+        offset = float(min(np.min(chunk*UNIT_CONVERSION) for (_, chunk) in g.iter_chunks(column, chunk_size=chunk_size)))
+    converted = np.lib.format.open_memmap(npy_fname+".tmp", mode="w+", dtype=float, shape=column.shape)
+    for (chunk_start, chunk) in g.iter_chunks(column, chunk_size=chunk_size):
+        converted[chunk_start:chunk_start+len(chunk)] = chunk*UNIT_CONVERSION - offset
+    converted.flush()
+    del converted
+    with open(info_fname+".tmp", "w") as handle:
+        json.dump({"source": info, "offset": offset}, handle)
+    os.replace(npy_fname+".tmp", npy_fname)
+    os.replace(info_fname+".tmp", info_fname)
+    return np.load(npy_fname, mmap_mode="r"), offset
+
+
+###############################################################################
+# load_coordinate_column:                                                     #
+#                                                                             #
+# Purpose: Load a column of coordinates with load_column, convert it to       #
+#          metres and shift it to start at 0, or by the given offset. The     #
+#          offset is returned so that data recorded later on can be loaded in #
+#          the same frame (see load_data). The converted column is cached     #
+#          as a .npy file next to the text file, see                          #
+#          convert_column_in_chunks, and memory mapped, so neither the column #
+#          nor the converted copy is held in memory. If the column has no     #
+#          cache, e.g., if the dataset is in a read-only location, it is      #
+#          converted in memory instead.                                       #
+#                                                                             #
+# Params: IN  data_loc   - Directory of the dataset.                          #
+#         IN  name       - Name of the column, e.g. "Global_X".               #
+#         IN  chunk_size - Optional, number of values to parse and convert at #
+#                          a time.                                            #
+#         IN  offset     - Optional, the value (in metres) to subtract.       #
+#                          Defaults to None, i.e., the column minimum.        #
+#         OUT column     - The converted column.                              #
+#         OUT offset     - The value which was subtracted.                    #
+###############################################################################
+def load_coordinate_column(data_loc, name, chunk_size=None, offset=None):
+    fname = os.path.join(data_loc, name)
+    column = load_column(fname, float, chunk_size=chunk_size)
+    if isinstance(column, np.memmap):
+        try:
+            return convert_column_in_chunks(column, fname+".npy", fname+".converted.npy", chunk_size, offset=offset)
+        except OSError:
+            pass
+    column = column*UNIT_CONVERSION
+    if offset is None:
+        offset = float(np.min(column))
+    return column - offset, offset
+
+
 ###############################################################################
 # This class will be used to load the entire original dataset.                #
 #                                                                             #
 # Note that not all datasets contain the "lane_id" column. Hence, we try to   #
 # load this column but if it doesn't exist we will just set it to be an array #
 # of zeros.                                                                   #
+#                                                                             #
+# Each column is loaded through load_column so the text files only need to be #
+# parsed once. The x and y coordinates are loaded through                     #
+# load_coordinate_column, so they are memory mapped too.                      #
+#                                                                             #
+# The dataset is read from data_loc, which defaults to the "original" folder  #
+# of DATASET.                                                                 #
+#                                                                             #
+# The positions are shifted so that the dataset starts at (0,0). The [x, y]   #
+# position (in metres) which was subtracted is kept in "origin". Pass the     #
+# origin of an earlier dataset to load new data of the same map in the same   #
+# frame as that dataset, e.g., to update a PLG (see plg_update.py).           #
+#                                                                             #
+# If chunk_size is given the dataset is streamed: the columns are parsed and  #
+# converted chunk_size data points at a time into .npy files next to the text #
+# files, and are memory mapped rather than held in memory. This is for        #
+# datasets which are larger than the available memory.                        #
 ###############################################################################
 class load_data:
-    def __init__(self) -> None:
-        # Load all data
-        self.x = np.genfromtxt(DATA_LOC+"Global_X", dtype=float)*UNIT_CONVERSION
-        self.y = np.genfromtxt(DATA_LOC+"Global_Y", dtype=float)*UNIT_CONVERSION
-        self.vehicle_id = np.genfromtxt(DATA_LOC+"Vehicle_ID", dtype=int)
+    def __init__(self, data_loc=DATA_LOC, chunk_size=None, origin=None) -> None:
+        origin_x, origin_y = (None, None) if origin is None else (float(origin[0]), float(origin[1]))
+        if chunk_size is not None:
+            self.load_in_chunks(data_loc, chunk_size, origin_x, origin_y)
+            return
+
+        # Load all data, the positions are normalised to start at (0,0)
+        self.x, origin_x = load_coordinate_column(data_loc, "Global_X", offset=origin_x)
+        self.y, origin_y = load_coordinate_column(data_loc, "Global_Y", offset=origin_y)
+        self.origin = np.array([origin_x, origin_y])
+        self.vehicle_id = load_column(os.path.join(data_loc, "Vehicle_ID"), int)
         try:
-            self.lane_id = np.genfromtxt(DATA_LOC+"Lane_ID", dtype=int)
+            self.lane_id = load_column(os.path.join(data_loc, "Lane_ID"), int)
         except FileNotFoundError:
             self.lane_id = np.zeros(len(self.x), dtype=int)
 
-        # Normalise position to start at (0,0)
-        self.x = self.x - min(self.x)
-        self.y = self.y - min(self.y)
-
         # Load the sese matrices
         self.vehicle_sese = g.get_se_matrix(self.vehicle_id)
         self.lane_sese = g.get_se_matrix(self.lane_id)
 
+    def load_in_chunks(self, data_loc, chunk_size, origin_x, origin_y):
+        # Load all data as memory mapped arrays
+        self.x, origin_x = load_coordinate_column(data_loc, "Global_X", chunk_size=chunk_size, offset=origin_x)
+        self.y, origin_y = load_coordinate_column(data_loc, "Global_Y", chunk_size=chunk_size, offset=origin_y)
+        self.origin = np.array([origin_x, origin_y])
+        self.vehicle_id = load_column(os.path.join(data_loc, "Vehicle_ID"), int, chunk_size=chunk_size)
+        try:
+            self.lane_id = load_column(os.path.join(data_loc, "Lane_ID"), int, chunk_size=chunk_size)
+        except FileNotFoundError:
+            # A read-only view of a single zero, which takes up no memory
+            self.lane_id = np.broadcast_to(np.zeros(1, dtype=int), (len(self.x),))
+
+        # Load the sese matrices
+        self.vehicle_sese = g.get_se_matrix(self.vehicle_id, chunk_size=chunk_size)
+        self.lane_sese = g.get_se_matrix(self.lane_id, chunk_size=chunk_size)
+
 
 ###############################################################################
 # This class will be used to store data. If we modify the original dataset in #
@@ -60,5 +283,101 @@ class data:
         self.vehicle_id = []        # vehicle ID
         self.vehicle_sese = None    # vehicle ID sese matrix
         self.lane_sese = None       # lane ID sese matrix
+        self.origin = None          # [x, y] subtracted from the positions
+
+
+###############################################################################
+# save_cleaned_data / load_cleaned_data:                                      #
+#                                                                             #
+# Purpose: Save and load a cleaned dataset (a "data" object). A dataset whose #
+#          columns are memory mapped, i.e., which was cleaned in streaming    #
+#          mode, is saved as a directory in the format used by save_plg so    #
+#          that it can be memory mapped again when it is loaded. Any other    #
+#          dataset is saved with the pickle module as before.                 #
+#                                                                             #
+# Params: IN data  - The "data" object to save.                               #
+#         IN fname - Path of the file or directory to save to/load from.      #
+###############################################################################
+def save_cleaned_data(data, fname):
+    if isinstance(data.x, np.memmap):
+        plg.save_attributes(vars(data), fname)
+    else:
+        if os.path.isdir(fname):
+            shutil.rmtree(fname)
+        g.save_pickled_data(fname, data)
 
 
+def load_cleaned_data(fname):
+    if not os.path.isdir(fname):
+        return g.load_pickled_data(fname)
+    loaded_data = data()
+    for name, loader in plg.load_attributes(fname, mmap_mode="r").items():
+        setattr(loaded_data, name, loader())
+    return loaded_data
+
+
+###############################################################################
+# save_cleaned_data_update / load_cleaned_data_with_updates /                 #
+# remove_cleaned_data_updates:                                                #
+#                                                                             #
+# Purpose: plg_update.py cleans only the newly recorded trajectories. Each    #
+#          batch of them is saved, with save_cleaned_data, in the directory   #
+#          fname+CLEANED_DATA_UPDATES_SUFFIX next to the cleaned dataset      #
+#          rather than rewriting the whole dataset.                           #
+#          load_cleaned_data_with_updates returns the cleaned dataset with    #
+#          every batch appended in the order they were saved. The columns are #
+#          then held in memory. Once the combined dataset has been saved over #
+#          the cleaned dataset the batches must be removed with               #
+#          remove_cleaned_data_updates, otherwise they are appended twice.    #
+#                                                                             #
+# Params: IN data  - The cleaned new data ("data" object) to save.            #
+#         IN fname - Path of the cleaned dataset (see save_cleaned_data).     #
+#         IN name  - Name of the batch, e.g. the directory of the new data.   #
+###############################################################################
+def save_cleaned_data_update(data, fname, name):
+    updates_dir = fname+CLEANED_DATA_UPDATES_SUFFIX
+    os.makedirs(updates_dir, exist_ok=True)
+    save_cleaned_data(data, os.path.join(updates_dir, f"{len(os.listdir(updates_dir)):06d}_{name}"))
+
+
+def load_cleaned_data_with_updates(fname):
+    loaded_data = load_cleaned_data(fname)
+    updates_dir = fname+CLEANED_DATA_UPDATES_SUFFIX
+    if not os.path.isdir(updates_dir):
+        return loaded_data
+    updates = [load_cleaned_data(os.path.join(updates_dir, name)) for name in sorted(os.listdir(updates_dir))]
+    return concatenate_cleaned_data([loaded_data] + updates)
+
+
+def remove_cleaned_data_updates(fname):
+    if os.path.isdir(fname+CLEANED_DATA_UPDATES_SUFFIX):
+        shutil.rmtree(fname+CLEANED_DATA_UPDATES_SUFFIX)
+
+
+###############################################################################
+# concatenate_cleaned_data:                                                   #
+#                                                                             #
+# Purpose: Append cleaned datasets one after another. The vehicle IDs must    #
+#          not overlap (see plg_update.py) and the datasets must be in the    #
+#          same frame, i.e., have the same origin. The nodes are only kept if #
+#          every dataset has them.                                            #
+#                                                                             #
+# Params: IN  datasets - List of "data" objects.                              #
+#         OUT combined - The combined "data" object.                          #
+###############################################################################
+def concatenate_cleaned_data(datasets):
+    origins = [np.asarray(dataset.origin) for dataset in datasets if getattr(dataset, "origin", None) is not None]
+    if any(not np.allclose(origin, origins[0]) for origin in origins):
+        raise ValueError("The cleaned datasets have different origins so they can't be combined")
+
+    combined = data()
+    for name in ("x", "y", "lane_id", "vehicle_id"):
+        setattr(combined, name, np.concatenate([np.asarray(getattr(dataset, name)) for dataset in datasets]))
+    nodes = [getattr(dataset, "node", None) for dataset in datasets]
+    if all((node is not None) and (len(node) == len(dataset.x)) for node, dataset in zip(nodes, datasets)):
+        combined.node = np.concatenate([np.asarray(node) for node in nodes])
+    combined.vehicle_sese = g.get_se_matrix(combined.vehicle_id)
+    combined.lane_sese = g.get_se_matrix(combined.lane_id)
+    combined.num_data_points = len(combined.x)
+    combined.origin = origins[0] if len(origins) > 0 else None
+    return combined
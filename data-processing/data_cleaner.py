@@ -1,21 +1,30 @@
 import sys
 import os
+import shutil
 
 # On my machine I need this line otherwise I get a "ModuleNotFoundError" when
 # trying to import the other modules I have written within this directory.
 sys.path.append(os.getcwd())
 
 import functions.general as g
+import functions.parallel as parallel
+import functions.instrumentation as instrumentation
 import classes.data as d
-import math
+import classes.PLG as plg
+import numpy as np
 import functions.date_time as date_time
 from inputs import *
 
 
 SAVE_LOC = "data/"+DATASET+"/cleaned/"
+REPORT_LOC = "data/"+DATASET+"/reports/"
 
 DATA_SAVE_NAME = "clean_data_v2"
 
+# Remove data points which are at least this far from the previous kept data
+# point in their path
+DR_UPPER_THRESHOLD = 10
+
 
 ###############################################################################
 # Clean the dataset. If there are any two data points d_k and d_{k+1} where   #
@@ -29,97 +38,238 @@ DATA_SAVE_NAME = "clean_data_v2"
 #                                                                             #
 # This function will take the original dataset loaded via the load_data class #
 # and will return a cleaned dataset.                                          #
+#                                                                             #
+# The paths are independent of each other so, on large datasets, they are     #
+# split into shards which are cleaned in a process pool (see                  #
+# functions/parallel.py). The result is identical to cleaning serially.       #
+# num_workers defaults to NUM_WORKERS in inputs.py, 1 always runs serially.   #
 ###############################################################################
-def clean_data(orignal_dataset):
+def clean_data(orignal_dataset, num_workers=None):
     # Define constants used for this function
     cleaned_dataset = d.data()
-    dr_upper_threshold = 10
-    num_vehicles = len((orignal_dataset.vehicle_sese)[:,0])
-    new_vehicle_id = -1
-
-    # Look through every vehicle and every vehicle's path and inspect change in
-    # distance between adjacent time steps to remove anomalous data points.
-    for ii_path in range(num_vehicles):
-        for ii_sub_path in range((orignal_dataset.vehicle_sese)[ii_path, 1]):
-            # We will re-name the vehicle IDs such that there is a single
-            # vehicle ID corresponding to a single "path". Right now there are
-            # multiple "paths" for each vehicle. In real life this corresponds
-            # to the vehicle entering the map, exiting at a junction and then
-            # re-entering the map at another junction. Its re-entry junction
-            # usually corresponds to the one which it exited at, i.e., I 
-            # for a vehicle to be able to get from it's original entry to its
-            # final target it had to leave and re-enter the map. We will
-            # separate all of these cases out and assign them their own vehicle
-            # ID to make the coding a bit easier.
-            new_vehicle_id += 1
-
-            # Extract the data corresponding to each vehicle path
-            x = g.se_extraction(orignal_dataset.vehicle_sese[ii_path, 0], orignal_dataset.x, orignal_dataset.vehicle_sese, sub_index=ii_sub_path)
-            y = g.se_extraction(orignal_dataset.vehicle_sese[ii_path, 0], orignal_dataset.y, orignal_dataset.vehicle_sese, sub_index=ii_sub_path)
-            lane_id = g.se_extraction(orignal_dataset.vehicle_sese[ii_path, 0], orignal_dataset.lane_id, orignal_dataset.vehicle_sese, sub_index=ii_sub_path)
-
-            # Intantiate variables to hold the new cleaned version of the data
-            # for this path
-            x_clean = [x[0,0]]
-            y_clean = [y[0,0]]
-            lane_id_clean = [lane_id[0,0]]
-            vehicle_id_clean = [new_vehicle_id]
-
-            # Number of data points in this vehicle path
-            path_length = len(x)
-
-            # Cycle through the data for this path
-            for ii in range(1, path_length):
-                # Current x,y values
-                x_current = x[ii,0]
-                y_current = y[ii,0]
-                # Previous x,y values
-                x_prev = x_clean[-1]
-                y_prev = y_clean[-1]
-
-                # Euclidean distance between current and previous datum
-                dr = math.sqrt((x_current - x_prev)**2 + (y_current - y_prev)**2)
-
-                # If the distance between the current data point and the
-                # previous data point is less than the threshold then append
-                # this data point to the "cleaned" versions. Otherwise ignore
-                # it.
-                if dr < dr_upper_threshold:
-                    x_clean.extend(x[ii])
-                    y_clean.extend(y[ii])
-                    lane_id_clean.extend(lane_id[ii])
-                    vehicle_id_clean.append(new_vehicle_id)
-
-            # Appeand the cleaned vehicle data to our data object
-            (cleaned_dataset.x).extend(x_clean)
-            (cleaned_dataset.y).extend(y_clean)
-            (cleaned_dataset.lane_id).extend(lane_id_clean)
-            (cleaned_dataset.vehicle_id).extend(vehicle_id_clean)
+    vehicle_index = g.SEIndex(orignal_dataset.vehicle_sese)
+
+    # We will re-name the vehicle IDs such that there is a single vehicle ID
+    # corresponding to a single "path". Right now there are multiple "paths"
+    # for each vehicle. In real life this corresponds to the vehicle entering
+    # the map, exiting at a junction and then re-entering the map at another
+    # junction. Its re-entry junction usually corresponds to the one which it
+    # exited at, i.e., I for a vehicle to be able to get from it's original
+    # entry to its final target it had to leave and re-enter the map. We will
+    # separate all of these cases out and assign them their own vehicle ID to
+    # make the coding a bit easier. Each [start, end] segment of the vehicle
+    # sese matrix is one "path" so we gather the paths one after another.
+    path_lengths = vehicle_index.segment_ends + g.ONE - vehicle_index.segment_starts
+    path_offsets = np.concatenate(([0], np.cumsum(path_lengths)))
+    num_points = path_offsets[-1]
+    data_index = np.arange(num_points) + np.repeat(vehicle_index.segment_starts - path_offsets[:-1], path_lengths)
+    x = np.asarray(orignal_dataset.x)[data_index]
+    y = np.asarray(orignal_dataset.y)[data_index]
+    lane_id = np.asarray(orignal_dataset.lane_id)[data_index]
+    vehicle_id = np.repeat(np.arange(len(path_lengths)), path_lengths)
+
+    # Find the data points to keep, shard by shard if there is enough data
+    shards = parallel.get_shards(path_lengths, num_workers=num_workers)
+    if len(shards) == 1:
+        is_kept = get_kept_points(x, y, path_offsets)
+    else:
+        with parallel.SharedArrays({"x": x, "y": y, "path_offsets": path_offsets}) as shared:
+            is_kept = np.concatenate(parallel.run_sharded(clean_data_shard, shared.handles, shards, num_workers=num_workers))
+
+    # Write the cleaned data into our data object
+    cleaned_dataset.x = x[is_kept]
+    cleaned_dataset.y = y[is_kept]
+    cleaned_dataset.lane_id = lane_id[is_kept]
+    cleaned_dataset.vehicle_id = vehicle_id[is_kept]
 
     # Build the sese matrices for this new cleaned dataset
     cleaned_dataset.vehicle_sese = g.get_se_matrix(cleaned_dataset.vehicle_id)
     cleaned_dataset.lane_sese = g.get_se_matrix(cleaned_dataset.lane_id)
 
-    # Set num_data_points
+    # Set num_data_points and keep the origin of the positions
     cleaned_dataset.num_data_points = len(cleaned_dataset.x)
+    cleaned_dataset.origin = getattr(orignal_dataset, "origin", None)
 
     return cleaned_dataset
 
 
+###############################################################################
+# clean_data_streaming:                                                       #
+#                                                                             #
+# Purpose: Streaming version of clean_data for datasets which do not fit in   #
+#          memory, e.g., loaded with load_data(chunk_size=...). The paths are #
+#          gathered and cleaned chunk by chunk, where each chunk holds whole  #
+#          paths and about chunk_size data points, and the kept data points   #
+#          are appended to files on disk. The cleaned dataset is saved to     #
+#          save_fname in the format of d.save_cleaned_data and is returned    #
+#          with its columns memory mapped. The result is identical to         #
+#          clean_data followed by d.save_cleaned_data.                        #
+#                                                                             #
+# Params: IN  orignal_dataset - The original dataset (see load_data).         #
+#         IN  save_fname      - Directory to save the cleaned dataset to.     #
+#         IN  chunk_size      - Number of data points to clean at a time.     #
+#         OUT cleaned_dataset - The cleaned dataset, memory mapped.           #
+###############################################################################
+def clean_data_streaming(orignal_dataset, save_fname, chunk_size):
+    vehicle_index = g.SEIndex(orignal_dataset.vehicle_sese)
+    path_lengths = vehicle_index.segment_ends + g.ONE - vehicle_index.segment_starts
+
+    # The kept data points are appended to one raw binary file per column
+    column_dtypes = {"x": np.float64, "y": np.float64, "lane_id": np.int64, "vehicle_id": np.int64}
+    column_dir = save_fname+".columns"
+    os.makedirs(column_dir, exist_ok=True)
+    column_files = {name: open(os.path.join(column_dir, name), "wb") for name in column_dtypes}
+    try:
+        for (first_path, last_path) in g.get_chunks(path_lengths, chunk_size=chunk_size):
+            # Gather the paths of this chunk one after another, as clean_data
+            # does for the whole dataset
+            chunk_lengths = path_lengths[first_path:last_path]
+            chunk_offsets = np.concatenate(([0], np.cumsum(chunk_lengths)))
+            data_index = np.arange(chunk_offsets[-1]) + np.repeat(vehicle_index.segment_starts[first_path:last_path] - chunk_offsets[:-1], chunk_lengths)
+            chunk = {"x": np.asarray(orignal_dataset.x[data_index]),
+                     "y": np.asarray(orignal_dataset.y[data_index]),
+                     "lane_id": np.asarray(orignal_dataset.lane_id[data_index]),
+                     "vehicle_id": np.repeat(np.arange(first_path, last_path), chunk_lengths)}
+
+            is_kept = get_kept_points(chunk["x"], chunk["y"], chunk_offsets)
+            for name, dtype in column_dtypes.items():
+                chunk[name][is_kept].astype(dtype, copy=False).tofile(column_files[name])
+    finally:
+        for column_file in column_files.values():
+            column_file.close()
+
+    # Build the sese matrices from the memory mapped columns and save the
+    # cleaned dataset
+    columns = {}
+    for name, dtype in column_dtypes.items():
+        fname = os.path.join(column_dir, name)
+        columns[name] = np.memmap(fname, dtype=dtype, mode="r") if os.path.getsize(fname) > 0 else np.zeros(0, dtype=dtype)
+    columns["vehicle_sese"] = g.get_se_matrix(columns["vehicle_id"], chunk_size=chunk_size)
+    columns["lane_sese"] = g.get_se_matrix(columns["lane_id"], chunk_size=chunk_size)
+    columns["num_data_points"] = len(columns["x"])
+    columns["origin"] = getattr(orignal_dataset, "origin", None)
+    plg.save_attributes(columns, save_fname)
+    del columns
+    shutil.rmtree(column_dir)
+
+    return d.load_cleaned_data(save_fname)
+
+
+###############################################################################
+# get_kept_points:                                                            #
+#                                                                             #
+# Purpose: Find the data points which clean_data keeps. The data points must  #
+#          be ordered path by path.                                           #
+#                                                                             #
+# Params: IN  x            - 1D numpy array of x coordinates.                 #
+#         IN  y            - 1D numpy array of y coordinates.                 #
+#         IN  path_offsets - 1D numpy array, path ii is the data points       #
+#                            [path_offsets[ii], path_offsets[ii+1]).          #
+#         OUT is_kept      - 1D boolean numpy array, True if the data point   #
+#                            is kept.                                         #
+###############################################################################
+def get_kept_points(x, y, path_offsets):
+    path_lengths = np.diff(path_offsets)
+    num_points = path_offsets[-1]
+    path_end = np.repeat(path_offsets[1:], path_lengths)
+
+    # Inspect the change in distance between adjacent time steps to remove
+    # anomalous data points. A data point is kept if its Euclidean distance
+    # from the previous *kept* data point in its path is less than the
+    # threshold. While no data point has been removed the previous kept data
+    # point is simply the previous data point, so we can accept every data
+    # point whose distance from its predecessor is below the threshold in
+    # bulk. The first data point of each path is always kept.
+    is_kept = np.ones(num_points, dtype=bool)
+    is_kept[1:] = np.sqrt((x[1:] - x[:-1])**2 + (y[1:] - y[:-1])**2) < DR_UPPER_THRESHOLD
+    is_kept[path_offsets[:-1]] = True
+
+    # The rare data points which jump further than the threshold take the
+    # slow path. Starting from the jump, every data point is compared against
+    # the last kept data point (the one before the jump) until we find one
+    # which is within the threshold. Everything in between is removed and the
+    # bulk rule applies again from the data point we found.
+    anomalous_points = np.flatnonzero(~is_kept)
+    ii_anomaly = 0
+    while ii_anomaly < len(anomalous_points):
+        ii_start = anomalous_points[ii_anomaly]
+        ii_prev = ii_start - 1
+        ii_end = path_end[ii_start]
+
+        # Search forward in windows of increasing size for the next data
+        # point we will keep
+        ii_next_kept = ii_end
+        ii_window_start = ii_start
+        window_size = 16
+        while ii_window_start < ii_end:
+            ii_window_end = min(ii_window_start + window_size, ii_end)
+            dr = np.sqrt((x[ii_window_start:ii_window_end] - x[ii_prev])**2 + (y[ii_window_start:ii_window_end] - y[ii_prev])**2)
+            within_threshold = np.flatnonzero(dr < DR_UPPER_THRESHOLD)
+            if len(within_threshold) > 0:
+                ii_next_kept = ii_window_start + within_threshold[0]
+                break
+            ii_window_start = ii_window_end
+            window_size *= 2
+
+        is_kept[ii_start:ii_next_kept] = False
+        if ii_next_kept < ii_end:
+            is_kept[ii_next_kept] = True
+
+        # Move on to the next anomaly after the data point we kept
+        ii_anomaly = np.searchsorted(anomalous_points, ii_next_kept, side="right")
+
+    return is_kept
+
+
+###############################################################################
+# clean_data_shard:                                                           #
+#                                                                             #
+# Purpose: Worker for the sharded mode of clean_data. Runs get_kept_points on #
+#          the paths [first_path, last_path) of the shared arrays.            #
+###############################################################################
+def clean_data_shard(arrays, first_path, last_path):
+    path_offsets = arrays["path_offsets"][first_path:last_path + 1]
+    return get_kept_points(arrays["x"][path_offsets[0]:path_offsets[-1]], arrays["y"][path_offsets[0]:path_offsets[-1]], path_offsets - path_offsets[0])
+
+
 def main():
+    # Record the time and memory used by each stage of the run
+    with instrumentation.for_script("data_cleaner", REPORT_LOC):
+        run_data_cleaner()
+
+
+def run_data_cleaner():
     # Time the script
     print(date_time.get_current_time(), "Program started")
 
     # Load the original dataset
-    original_dataset = d.load_data()
+    with instrumentation.stage("load_data") as record:
+        original_dataset = d.load_data(chunk_size=STREAMING_CHUNK_SIZE)
+        record.count("data_points", len(original_dataset.x))
     print(date_time.get_current_time(), "Loaded original dataset")
 
+    # In streaming mode the dataset is cleaned chunk by chunk straight into
+    # its save location
+    if STREAMING_CHUNK_SIZE is not None:
+        with instrumentation.stage("clean_data_streaming") as record:
+            cleaned_dataset = clean_data_streaming(original_dataset, SAVE_LOC+DATA_SAVE_NAME, STREAMING_CHUNK_SIZE)
+            record.count("data_points", len(original_dataset.x))
+            record.count("kept_data_points", cleaned_dataset.num_data_points)
+            record.count("paths", len(cleaned_dataset.vehicle_sese))
+        print(date_time.get_current_time(), "Finished cleaning and saving data")
+        return
+
     # Clean the dataset
-    cleaned_dataset = clean_data(original_dataset)
+    with instrumentation.stage("clean_data") as record:
+        cleaned_dataset = clean_data(original_dataset)
+        record.count("data_points", len(original_dataset.x))
+        record.count("kept_data_points", cleaned_dataset.num_data_points)
+        record.count("paths", len(cleaned_dataset.vehicle_sese))
     print(date_time.get_current_time(), "Finished cleaning data")
 
     # Save data
-    g.save_pickled_data(SAVE_LOC+DATA_SAVE_NAME, cleaned_dataset)
+    with instrumentation.stage("save"):
+        d.save_cleaned_data(cleaned_dataset, SAVE_LOC+DATA_SAVE_NAME)
     print(date_time.get_current_time(), "Saved clean data")
 
 
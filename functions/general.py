@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse as sp
 import pickle
 
 
@@ -55,7 +56,7 @@ def reorder(reorder_vector, mat_to_reorder, reverse=False):
     return mat_to_reorder
 
 
-def get_se_matrix(ids, unique_ids=False, order=True):
+def get_se_matrix(ids, unique_ids=False, order=True, chunk_size=None):
     """Generates a se data_vec given a list of IDs
 
     Args:
@@ -66,6 +67,9 @@ def get_se_matrix(ids, unique_ids=False, order=True):
             this into two separte IDs "1" and "2" each with a single [S, E]. Defaults to
             False.
         order (bool, optional): Re-orders data_vec with increasing IDs. Defaults to True.
+        chunk_size (int, optional): If given, "ids" is read this many elements at a
+            time, e.g. so that a memory mapped array is never read into memory in
+            one go. Defaults to None, i.e., "ids" is read in one go.
 
     Returns:
         numpy array: Numpy array describing the start-end information of the input ids.
@@ -78,70 +82,202 @@ def get_se_matrix(ids, unique_ids=False, order=True):
             We call this data structure a "se data_vec" where "se" denotes the "start-end"
             pairs we use for referencing.
     """
-    # Get [id, num_SE, S, E] for first, this will be an unordered list with repeated IDs
-    id_SE = np.zeros((0, 4))
-    # Initialise a dict{} to remember the frequency with which each 'id' appears
-    id_freq = {}
+    if not isinstance(ids, np.ndarray):
+        ids = np.asarray(ids)
     number_of_data_points = len(ids)
-    prev_id = 'no_id_should_have_this_name'
-
-    for k in range(number_of_data_points):
-        this_id = ids[k]
-        # Check if this is a new id
-        if this_id != prev_id:
-            # Build id_freq
-            if str(this_id) in id_freq:
-                id_freq[str(this_id)] += 1
-            else:
-                id_freq[str(this_id)] = 1
-
-            # Build SE data_vec
-            if k == 0:
-                id_SE = np.vstack((id_SE, [this_id, id_freq[str(this_id)], k, 0]))
-            else:
-                id_SE = np.vstack((id_SE, [this_id, id_freq[str(this_id)], k, 0]))
-                id_SE[-2,3] = k-1 # add 'E' of previous ID
-
-        # Consider final element, add 'E' for final element
-        if k == number_of_data_points-1:
-            id_SE[-1,3] = k
-
-        prev_id = this_id
+
+    # Find the boundaries of each run of identical IDs. A run starts wherever
+    # the ID differs from the previous ID and ends one index before the next
+    # run starts.
+    run_starts = []
+    for (chunk_start, chunk_ids) in iter_chunks(ids, chunk_size=chunk_size):
+        is_run_start = np.empty(len(chunk_ids), dtype=bool)
+        is_run_start[0] = (chunk_start == 0) or (chunk_ids[0] != ids[chunk_start - 1])
+        is_run_start[1:] = chunk_ids[1:] != chunk_ids[:-1]
+        run_starts.append(chunk_start + np.flatnonzero(is_run_start))
+    run_starts = np.concatenate(run_starts)
+    run_ends = np.append(run_starts[1:] - 1, number_of_data_points - 1)
+    run_ids = np.asarray(ids[run_starts])
+
+    # Get the unique IDs, which run belongs to which ID and how many runs
+    # (i.e. [S, E] pairs) each ID has
+    unique_id_list, run_id_index, id_freq = np.unique(run_ids, return_inverse=True, return_counts=True)
+    run_id_index = run_id_index.ravel()
+
+    # Calculate the instance of each run, i.e., whether it is the 1st, 2nd,
+    # ... appearance of its ID. A stable sort keeps the runs of each ID in the
+    # order in which they appear.
+    runs_sorted_by_id = np.argsort(run_id_index, kind="stable")
+    first_run_of_id = np.concatenate(([0], np.cumsum(id_freq)[:-1]))
+    run_instance = np.empty(len(run_ids), dtype=int)
+    run_instance[runs_sorted_by_id] = np.arange(len(run_ids)) - first_run_of_id[run_id_index[runs_sorted_by_id]]
 
     unique_ids = False
     if not order:
-        if len(set(id_SE[:,0])) == len(id_SE[:,0]):
+        if len(unique_id_list) == len(run_ids):
             unique_ids = True
 
     if unique_ids and not order:
-        return id_SE.astype(int)
+        # Return the unordered [id, num_SE, S, E] data_vec
+        return np.column_stack((run_ids, run_instance + 1, run_starts, run_ends)).astype(int)
     else:
         if not order:
             print("... IDs are NOT unique for this SESE data_vec.")
-        # Re order in terms of id
-        id_SE_ordered = reorder(id_SE[:,0], id_SE)
 
-        # Turn unordered id_SE data_vec into ordered id_SE_SE data_vec
-        id_freq_list = list(id_freq.values())
-        ordered_id_list = list(set(ids))
-        SE_SE_rows, SE_SE_cols = len(id_freq_list), max(id_freq_list)
-        se_mat = np.zeros((SE_SE_rows, 2 + 2*SE_SE_cols))
-        n_SE = len(id_SE[:,0])
+        # Build the ordered id_SE_SE data_vec, one row per ID in increasing
+        # order of ID
+        SE_SE_rows, SE_SE_cols = len(unique_id_list), max(id_freq)
+        se_mat = np.zeros((SE_SE_rows, 2 + 2*SE_SE_cols), dtype=int)
+        se_mat[:, 0] = unique_id_list
+        se_mat[:, 1] = id_freq
+        se_mat[run_id_index, 2 + 2*run_instance] = run_starts
+        se_mat[run_id_index, 3 + 2*run_instance] = run_ends
+
+        return se_mat
+
 
-        prev_id = 'no_id_should_have_this_name'
-        for k in range(n_SE):
-            this_id, this_id_instance, start, end = id_SE[k,0], id_SE[k,1], id_SE[k,2], id_SE[k,3]
+def iter_chunks(*data_vecs, chunk_size=None):
+    """Generator over consecutive chunks of one or more data vectors of the same
+    length. For each chunk this yields (start index of the chunk, chunk of
+    data_vec_0, chunk of data_vec_1, ...). Each chunk is read into memory so
+    memory mapped data vectors can be processed without reading them in one go.
 
-            i = ordered_id_list.index(this_id)
+    Args:
+        *data_vecs (numpy array): Data vectors to iterate over.
+        chunk_size (int, optional): Number of elements in each chunk. Defaults to
+            None, i.e., a single chunk holding the entire data vectors.
+    """
+    length = len(data_vecs[0])
+    if chunk_size is None:
+        chunk_size = max(1, length)
+    for chunk_start in range(0, length, chunk_size):
+        yield (chunk_start,) + tuple(np.asarray(data_vec[chunk_start:chunk_start + chunk_size]) for data_vec in data_vecs)
 
-            se_mat[i, 0] = this_id
-            se_mat[i, 1] += 1
 
-            i_s, i_e = int(2*se_mat[i, 1]), int(2*se_mat[i, 1]+1)
+def get_chunks(lengths, chunk_size=None):
+    """Groups consecutive items (e.g. vehicle paths) into chunks which hold at
+    most "chunk_size" data points. An item which is longer than "chunk_size" is
+    put in a chunk on its own.
 
-            se_mat[i, i_s], se_mat[i, i_e] = start, end
+    Args:
+        lengths (numpy array): Number of data points in each item.
+        chunk_size (int, optional): Maximum number of data points in a chunk.
+            Defaults to None, i.e., a single chunk holding every item.
 
-        return se_mat.astype(int)
+    Returns:
+        list: (first item, last item + 1) of each chunk, in item order.
+    """
+    num_items = len(lengths)
+    if chunk_size is None:
+        return [(0, num_items)]
+    cumulative_lengths = np.concatenate(([0], np.cumsum(lengths)))
+    chunks = []
+    first = 0
+    while first < num_items:
+        last = np.searchsorted(cumulative_lengths, cumulative_lengths[first] + chunk_size, side="right") - 1
+        last = max(int(last), first + 1)
+        chunks.append((first, last))
+        first = last
+    return chunks
+
+
+def se_row_extraction(se_row, data_vec, sub_index=None):
+    """Extracts the data described by a single row of a sese matrix from the
+    1D "data_vec". See se_extraction for more details.
+
+    Args:
+        se_row (numpy array): Row of a sese matrix, [id, num_SE, S, E, ...].
+        data_vec (numpy array): 1D numpy vector or Python list to extract the
+            data from.
+        sub_index (int, optional): If there are multiple instances of this ID,
+            decide which instance to extract data for. Defaults to None, this
+            returns all instances concatenated into a single vector.
+
+    Returns:
+        numpy array: 1D subset of "data_vec". This is a view of "data_vec" if a
+            single segment is extracted from a numpy vector.
+    """
+    # Get the segments we want to extract. Only the segments are converted to
+    # numpy arrays, converting the whole of a list "data_vec" would copy it on
+    # every call.
+    if sub_index is not None:
+        sub_indices = [sub_index]
+    else:
+        sub_indices = range(se_row[1])
+    segments = [np.asarray(data_vec[se_row[2 + 2 * ii_sub]:se_row[3 + 2 * ii_sub] + ONE]) for ii_sub in sub_indices]
+
+    if len(segments) == 1:
+        return segments[0]
+    return np.concatenate(segments)
+
+
+class SEIndex:
+    """An index over a sese matrix (see get_se_matrix) which is built once and
+    then maps an ID to its row of the sese matrix in O(1).
+
+    The [start, end] segments of every ID are also flattened into the
+    "segment_ids", "segment_starts" and "segment_ends" vectors, ordered by row
+    of the sese matrix and then by the instance of the ID. Extracting data for
+    an ID which has a single segment returns a view of the data vector rather
+    than a copy.
+
+    Args:
+        se_mat (numpy array): sese matrix to index.
+    """
+    def __init__(self, se_mat) -> None:
+        self.se_mat = np.asarray(se_mat)
+        self.row_of_id = {this_id: row for row, this_id in enumerate(self.se_mat[:,0].tolist())}
+
+        # Flatten the [S, E] pairs of each row, keeping only the pairs which
+        # are populated for that ID
+        num_segments = self.se_mat[:,1]
+        is_segment = np.arange((self.se_mat.shape[1] - 2) // 2) < num_segments[:,None]
+        self.segment_ids = np.repeat(self.se_mat[:,0], num_segments)
+        self.segment_starts = self.se_mat[:,2::2][is_segment]
+        self.segment_ends = self.se_mat[:,3::2][is_segment]
+
+    def __contains__(self, id):
+        return id in self.row_of_id
+
+    def __len__(self):
+        return len(self.row_of_id)
+
+    def row(self, id):
+        """Returns the row of the sese matrix for "id", or None if the ID is
+        not in the sese matrix."""
+        return self.row_of_id.get(id)
+
+    def extract(self, id, data_vec, sub_index=None):
+        """Extracts all data with the ID "id" from the 1D "data_vec".
+
+        Args:
+            id (int): The ID who's data we will extract from "data_vec".
+            data_vec (numpy array): 1D numpy vector or Python list to extract
+                the data from.
+            sub_index (int, optional): If there are multiple instances of this
+                ID, decide which instance to extract data for. Defaults to
+                None, this returns all instances concatenated into a single
+                vector.
+
+        Returns:
+            numpy array: 1D subset of "data_vec" corresponding to "id". This is
+                a view of "data_vec" if a single segment is extracted. None if
+                the ID is not in the sese matrix.
+        """
+        ii = self.row_of_id.get(id)
+        if ii is None:
+            return None
+        return se_row_extraction(self.se_mat[ii], data_vec, sub_index=sub_index)
+
+    def iter_segments(self, *data_vecs):
+        """Generator over every [start, end] segment in the sese matrix. For
+        each segment this yields (id, data_vec_0[S:E+1], data_vec_1[S:E+1],
+        ...) where each slice is a view of the input data vector. E.g.,
+        "for vehicle_id, x, y, lane_id in index.iter_segments(x, y, lane_id)".
+        """
+        data_vecs = [np.asarray(data_vec) for data_vec in data_vecs]
+        for this_id, start, end in zip(self.segment_ids.tolist(), self.segment_starts.tolist(), self.segment_ends.tolist()):
+            yield (this_id,) + tuple(data_vec[start:end + ONE] for data_vec in data_vecs)
 
 
 def se_extraction(id, data_vec, se_mat, sub_index=None, print_error=True):
@@ -163,12 +299,15 @@ def se_extraction(id, data_vec, se_mat, sub_index=None, print_error=True):
     dimensional numpy vector. I.e, a vertical numpy vector. This is technically
     2D since to index the data entries we need to indices, such as: [ii,0].
 
+    If the same sese matrix is used for many extractions, build an SEIndex
+    once and pass it in as "se_mat" so that each lookup is O(1).
+
     Args:
         id (int): The ID who's data we will extract from "data_vec".
         data_vec (numpy array): The data_vec we will extract the data from.
             This vector must be a 1D numpy vector (i.e. NOT a vertical vector)
             or a Python list.
-        se_mat (numpy array): sesew matrix for data_vec.
+        se_mat (numpy array or SEIndex): sesew matrix for data_vec.
         sub_index (int, optional): If there are multiple instances of this ID,
             decide which instance to extract data for. Defaults to None, this
             returns all instances concatenated into a single vector.
@@ -179,85 +318,34 @@ def se_extraction(id, data_vec, se_mat, sub_index=None, print_error=True):
     Returns:
         numpy data_vec: Subset of "data_vec" corresponding to "id"
     """
-    # Check the shape of the input array. First we will check if the input
-    # array is 3D. If it is we raise an error.
-    try: 
-        # Try to index 2D, if this fails then data_vec is 1D (or less)
-        data_vec[0,0]
-        # If the shape is higher than 1D then we have an error on our hands so
-        # break out of the function now and let whoever called the function
-        # deal with it.
+    # Check the shape of the input array. If it is higher than 1D then break
+    # out of the function now and let whoever called the function deal with
+    # it.
+    if np.ndim(data_vec) != 1:
         print(f"!!! ERROR: In se_extraction expected 1D input for \"data_vec\" but got something higher.")
         error_variable = True
         assert error_variable != True
         return None
-    except Exception:
-        # If we've reached this point then we've got a 1D input array. We only
-        # need one column for the output data_vec since we know we've got a 1D
-        # input array.
-        num_cols = ONE
-
-    # Initialise the number of IDs and an index variable to store the index of
-    # the ID we're interested in if we find it    
-    num_ids = len(se_mat[:,0])
-    ii = 0
-
-    # Now loop through the sese data_vec looking for the ID we're interested
-    # in. If we find this ID then we'll rememebr its index and break out of
-    # this loop.
-    while ii < num_ids:
-        # Check if we've found the ID
-        if id == se_mat[ii,0]:
-            break
-        # Increment index
-        ii += 1
-        # If ii == num_ids then we couldn't find the ID, print a warning
-        # message and return from this function
-        if ii == num_ids:
-            if print_error:
-                print(f"!!! WARNING: ID {str(id)} not found in the sese matrix you provided")
-            return None
 
-    # Now that we know what row of the sese data_vec to look at, we'll use the
-    # sese data_vec to extract the data we're interested.
-    # 
-    # Calculate the number of rows in our output data_vec. The following loop
-    # is perform twice so that we can learn the size of the output data vector
-    # before hand. By doing this we can specify it's size straight away instead
-    # of concatenating vectors (which is slower).
-    num_rows = 0
-    for ii_sub in range(se_mat[ii,1]):
-        if sub_index:
-            # We want to extract a specific subset of the data corresponding
-            # to this ID
-            if sub_index == ii_sub:
-                num_rows += se_mat[ii, 3 + 2 * ii_sub] + ONE - se_mat[ii, 2 + 2 * ii_sub]
-        else:
-            # We want all the data for this ID
-            num_rows += se_mat[ii, 3 + 2 * ii_sub] + ONE - se_mat[ii, 2 + 2 * ii_sub]
-    
-    # Initialise a data_vec (with zero rows). As we extract data corresponding to
-    # the ID we want we'll concatenate onto this data_vec.
-    data_vec_id = np.zeros((num_rows, num_cols))
-
-    # Extract the data
-    ii_start = 0
-    for ii_sub in range(se_mat[ii,1]):
-        if sub_index:
-            # We want to extract a specific subset of the data corresponding
-            # to this ID
-            if sub_index == ii_sub:
-                len_of_data = se_mat[ii, 3 + 2 * ii_sub] + ONE - se_mat[ii, 2 + 2 * ii_sub]
-                data_vec_id[ii_start:len_of_data, 0] = data_vec[se_mat[ii, 2 + 2 * ii_sub]:se_mat[ii, 3 + 2 * ii_sub] + ONE]
-
-        else:
-            # We want all the data for this ID so concatenate the data for each
-            # sub index into one data data_vec
-            len_of_data = se_mat[ii, 3 + 2 * ii_sub] + ONE - se_mat[ii, 2 + 2 * ii_sub]
-            data_vec_id[ii_start:ii_start+len_of_data, 0] = data_vec[se_mat[ii, 2 + 2 * ii_sub]:se_mat[ii, 3 + 2 * ii_sub] + ONE]
-            ii_start = len_of_data
-
-    return data_vec_id
+    # Find the row of the sese matrix for this ID. An SEIndex can do this in
+    # O(1), otherwise we search the ID column of the sese matrix.
+    if isinstance(se_mat, SEIndex):
+        ii = se_mat.row(id)
+        se_mat = se_mat.se_mat
+    else:
+        rows_with_id = np.flatnonzero(np.asarray(se_mat)[:,0] == id)
+        ii = rows_with_id[0] if len(rows_with_id) > 0 else None
+
+    # If we couldn't find the ID, print a warning message and return from
+    # this function
+    if ii is None:
+        if print_error:
+            print(f"!!! WARNING: ID {str(id)} not found in the sese matrix you provided")
+        return None
+
+    # Extract the data and return it as a vertical vector
+    data_vec_id = se_row_extraction(se_mat[ii], data_vec, sub_index=sub_index)
+    return data_vec_id[:,np.newaxis]
 
 
 def moving_average(y, x=[], n=None):
@@ -324,17 +412,75 @@ def get_dict_key_given_value_list_element(dict, value):
 
 
 def normalise_matrix_rows(mat):
-    """Normalise the rows of a matrix
+    """Normalise the rows of a matrix. Sparse matrices are normalised in their
+    own format so that they are never densified.
 
     Args:
-        mat (np array): Matrix to normalise
+        mat (np array or scipy.sparse matrix): Matrix to normalise
 
     Returns:
-        mat_norm (np array): Normalised matrix
+        mat_norm (np array or scipy.sparse CSR matrix): Normalised matrix
     """
-    for ii in range(mat.shape[0]):
-        row_sum = np.sum(mat[ii,:])
-        if row_sum > 0:
-            mat[ii,:] = mat[ii,:] / row_sum
+    if sp.issparse(mat):
+        # Divide each stored entry by the sum of its row. Rows which sum to
+        # zero are left untouched. The matrix is put into canonical format
+        # (sorted column indices, no duplicates) so that readers can rely on
+        # the column order within each row.
+        mat = sp.csr_matrix(mat, dtype=float)
+        mat.sum_duplicates()
+        row_sums = np.asarray(mat.sum(axis=1)).ravel()
+        row_sums[row_sums <= 0] = 1
+        mat.data /= np.repeat(row_sums, np.diff(mat.indptr))
+        return mat
+
+    row_sums = np.sum(mat, axis=1)
+    is_nonzero = row_sums > 0
+    mat[is_nonzero] = mat[is_nonzero] / row_sums[is_nonzero, np.newaxis]
     return mat
 
+
+def pad_sparse_matrix(mat, shape):
+    """Pads a sparse matrix with empty rows and columns, e.g. for nodes which
+    were added after the matrix was built.
+
+    Args:
+        mat (scipy.sparse matrix): Matrix to pad.
+        shape (tuple): The new (rows, columns), at least the current shape.
+
+    Returns:
+        scipy.sparse CSR matrix: The padded matrix. Its arrays share memory
+            with "mat" if it is already a CSR matrix.
+    """
+    mat = sp.csr_matrix(mat)
+    indptr = np.concatenate((mat.indptr, np.full(shape[0] - mat.shape[0], mat.indptr[-1], dtype=mat.indptr.dtype)))
+    return sp.csr_matrix((mat.data, mat.indices, indptr), shape=shape)
+
+
+def update_normalised_rows(mat_norm, counts, rows):
+    """Updates a row normalised sparse matrix after some rows of the counts it
+    was normalised from changed. Only the given rows are normalised again, the
+    other rows are taken from "mat_norm" as they are.
+
+    Args:
+        mat_norm (scipy.sparse matrix): The normalised matrix. If it has fewer
+            rows and columns than "counts" (e.g. nodes were added) it is
+            padded with empty rows and columns.
+        counts (scipy.sparse matrix): The updated counts.
+        rows (numpy array): The rows of "counts" which changed.
+
+    Returns:
+        scipy.sparse CSR matrix: The updated normalised matrix, in canonical
+            format.
+    """
+    num_rows = counts.shape[0]
+    mat_norm = pad_sparse_matrix(mat_norm, counts.shape)
+
+    is_updated = np.zeros(num_rows, dtype=bool)
+    is_updated[np.asarray(rows, dtype=np.int64)] = True
+    kept_rows = sp.diags((~is_updated).astype(float)) @ mat_norm
+    kept_rows.eliminate_zeros()
+    updated_rows = normalise_matrix_rows(sp.diags(is_updated.astype(float)) @ sp.csr_matrix(counts))
+
+    mat_norm = sp.csr_matrix(kept_rows + updated_rows)
+    mat_norm.sum_duplicates()
+    return mat_norm
@@ -1,16 +1,25 @@
 import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.font_manager import FontProperties
 import random
 from math import inf
 from inputs import *
-import copy
 import cmath
+from concurrent.futures import ThreadPoolExecutor
 import functions.general as g
 
 
 COLOUR_LOWER = 0
 COLOUR_UPPER = 1
 EMPTY_ENTRY = -1010101
+# Maximum number of nodes in a generated path
+MAX_PATH_LENGTH = 300
+# Node used in place of "None" in arrays of nodes, e.g., the next node when
+# a path reaches a dead end
+NO_NODE = -1
 
 
 class GraphPlotInformation:
@@ -36,19 +45,13 @@ class GraphPlotInformation:
             self.node_labels = self.generate_node_labels(PLG)
 
     def generate_colours_for_lane_ids(self, PLG):
-        lane_colour_dict = {}
-        lane_colour_list = [0 for ii in range(PLG.num_nodes)]
-        lane_ids = list(set(PLG.node_lane_ids))
+        lane_ids, node_lane_index = np.unique(np.asarray(PLG.node_lane_ids), return_inverse=True)
 
         # Generate a colour (random tuple) of three value for each lane ID
-        for lane_id in lane_ids:
-            lane_colour_dict[lane_id] = (random.uniform(COLOUR_LOWER,COLOUR_UPPER), random.uniform(COLOUR_LOWER,COLOUR_UPPER), random.uniform(COLOUR_LOWER,COLOUR_UPPER))
+        lane_colours = np.array([(random.uniform(COLOUR_LOWER,COLOUR_UPPER), random.uniform(COLOUR_LOWER,COLOUR_UPPER), random.uniform(COLOUR_LOWER,COLOUR_UPPER)) for _ in range(len(lane_ids))]).reshape(-1, 3)
 
-        # Now create a list of colours corresponding to each lane ID
-        for ii in range(PLG.num_nodes):
-            lane_colour_list[ii] = lane_colour_dict[PLG.node_lane_ids[ii]]
-
-        return lane_colour_list
+        # Now look up the colour of each node from its lane ID
+        return lane_colours[node_lane_index.ravel()]
     
     def generate_node_labels(self, PLG):
         # Get a vector of node labels
@@ -60,56 +63,93 @@ class GraphPlotInformation:
             return self.node_labels
 
 
-def draw(PLG):
-    """Draws the PLG object.
+def draw(PLG, ax=None):
+    """Draws the PLG object. All of the edges are drawn as a single
+    LineCollection and all of the nodes as a single scatter, so the cost of
+    drawing the PLG grows with the number of edges rather than with the
+    number of node pairs.
+
+    Args:
+        PLG (PLG): The PLG to draw.
+        ax (matplotlib Axes, optional): Axes to draw on. Defaults to None, in
+            which case the current axes are used.
     """
+    if ax is None:
+        ax = plt.gca()
     # Initialise Graph Plot Information
     graph_plot_info = GraphPlotInformation(PLG)
     # Coordinates of nodes
-    x = PLG.nodes[:,0]
-    y = PLG.nodes[:,1]
+    nodes = np.asarray(PLG.nodes)
     # Adjacency matrix
-    adj_mat = PLG.adjmat
-
-    # Get the shape of the adjacency matrix and assert that it is square
-    shape_of_adj_mat = np.shape(adj_mat)
-    num_rows = shape_of_adj_mat[0]
-    num_cols = shape_of_adj_mat[1]
-    assert num_rows == num_cols
-
-    # Cycle through the adjacency matrix and plot edges
-    for ii in range(num_rows):
-        for jj in range(ii+1, num_cols):
-            if max(adj_mat[ii,jj], adj_mat[jj,ii]) > 0:
-                # If we've decided to shade the edges by probability then get
-                # the shading for this edge
-                if graph_plot_info.shade_edges_with_connection_probability:
-                    shade_value = min(1 - adj_mat[ii, jj], 1 - adj_mat[jj, ii])*graph_plot_info.shade_darkness
-                    graph_plot_info.edge_colour = [shade_value, shade_value, shade_value]
-
-                # Plot the edge
-                plt.plot([x[ii], x[jj]], [y[ii], y[jj]], color=graph_plot_info.edge_colour, linewidth=graph_plot_info.edge_line_width, zorder=3)
-
-    # Plot the graph nodes
-    plt.scatter(x, y, color=graph_plot_info.node_colour, s=graph_plot_info.node_size, zorder=4)
+    adj_mat = sp.csr_matrix(PLG.adjmat)
+    assert adj_mat.shape[0] == adj_mat.shape[1]
+
+    # An undirected edge exists between ii and jj if either direction has a
+    # non-zero probability. Its shading is based on the more probable of the
+    # two directions, min(1 - p_ij, 1 - p_ji) = 1 - max(p_ij, p_ji), so we
+    # take the element-wise maximum with the transpose and only keep the
+    # stored upper triangle entries.
+    undirected_adj_mat = sp.triu(adj_mat.maximum(adj_mat.T), k=1).tocoo()
+    is_edge = undirected_adj_mat.data > 0
+    edge_start = undirected_adj_mat.row[is_edge]
+    edge_end = undirected_adj_mat.col[is_edge]
+    p_edge = undirected_adj_mat.data[is_edge]
+
+    # If we've decided to shade the edges by probability then get the shading
+    # of every edge
+    if graph_plot_info.shade_edges_with_connection_probability:
+        edge_colours = np.repeat(((1 - p_edge)*graph_plot_info.shade_darkness)[:,None], 3, axis=1)
+    else:
+        edge_colours = graph_plot_info.edge_colour
+
+    # Plot the edges, each segment is [[x_ii, y_ii], [x_jj, y_jj]]
+    segments = np.stack((nodes[edge_start], nodes[edge_end]), axis=1)
+    ax.add_collection(LineCollection(segments, colors=edge_colours, linewidths=graph_plot_info.edge_line_width, zorder=3))
+
+    # Plot the graph nodes, this also updates the axes limits to fit the PLG
+    ax.scatter(nodes[:,0], nodes[:,1], color=graph_plot_info.node_colour, s=graph_plot_info.node_size, zorder=4)
 
     # Plot the node labels
     if graph_plot_info.node_labels is not None:
-        # Offset the labels slightly so that they are not plotted directly on
-        # top of the nodes
-        dx = 0.5
-        dy = 0.5
-        for ii in range(PLG.num_nodes):
-            plt.text(x[ii] + dx, y[ii] + dy, graph_plot_info.node_labels[ii], color=graph_plot_info.node_labels_font_colour, fontsize=graph_plot_info.node_labels_font_size, fontweight="bold", zorder=5)
+        draw_node_labels(ax, nodes, graph_plot_info.node_labels, graph_plot_info.node_labels_font_colour, graph_plot_info.node_labels_font_size)
+
+
+def draw_node_labels(ax, nodes, node_labels, font_colour, font_size):
+    """Draws a label next to each node. Matplotlib needs one Text artist per
+    label, so the label positions are computed in one go and the labels share
+    a single FontProperties. Labels are only drawn for the nodes within the
+    current axes limits.
+
+    Args:
+        ax (matplotlib Axes): Axes to draw on.
+        nodes (2D numpy array): [x, y] coordinates of the nodes.
+        node_labels (list): Label of each node.
+        font_colour (string): Colour of the labels.
+        font_size (float): Font size of the labels.
+    """
+    # Offset the labels slightly so that they are not plotted directly on top
+    # of the nodes
+    dx = 0.5
+    dy = 0.5
+    x_min, x_max = sorted(ax.get_xlim())
+    y_min, y_max = sorted(ax.get_ylim())
+    is_visible = (nodes[:,0] >= x_min) & (nodes[:,0] <= x_max) & (nodes[:,1] >= y_min) & (nodes[:,1] <= y_max)
+    font_properties = FontProperties(size=font_size, weight="bold")
+    for ii in np.flatnonzero(is_visible).tolist():
+        ax.text(nodes[ii,0] + dx, nodes[ii,1] + dy, str(node_labels[ii]), color=font_colour, fontproperties=font_properties, zorder=5)
 
 
 def arg_max_p_next_node(p_next_node, current_node):
     """Returns the next node with the highest probability of being visited
-    given the current node"""
-    if np.sum(p_next_node[current_node,:]) == 0:
+    given the current node. "p_next_node" is a scipy.sparse CSR matrix so we
+    only inspect the entries stored in the row of the current node."""
+    row_start = p_next_node.indptr[current_node]
+    row_end = p_next_node.indptr[current_node + 1]
+    row_data = p_next_node.data[row_start:row_end]
+    if np.sum(row_data) == 0:
         return False
     else:
-        return np.argmax(p_next_node[current_node,:])
+        return p_next_node.indices[row_start + np.argmax(row_data)]
 
 
 def arg_max_p_next_node_given_target(p_next_node_given_target, closest_clusters_list, current_node):
@@ -119,35 +159,404 @@ def arg_max_p_next_node_given_target(p_next_node_given_target, closest_clusters_
     next closest cluster, and so on."""
     for target_cluster in closest_clusters_list:
         next_node = arg_max_p_next_node(p_next_node_given_target[target_cluster], current_node)
-        if next_node:
+        # Node 0 is a valid next node so we can't simply test "if next_node"
+        if next_node is not False:
             return next_node
     
 
 def path_generation(PLG, start_node, target_cluster):
     """Generates a path from the start node to the target cluster. If we reach
-    a dead end then we will return a path that ends with "None"."""
+    a dead end then we will return a path that ends with "None". The PLG is
+    only read, so the same PLG can be used by many calls at once (see
+    batch_path_generation)."""
     # Initialise the path
     path = [start_node]
-    closest_clusters_list = PLG.closest_clusters_dict[target_cluster]
-    max_path_length = 300
-    
-    # Create copies of the transition matrices
-    p_next_node_given_target = copy.deepcopy(PLG.p_next_node_given_target)
+    max_path_length = MAX_PATH_LENGTH
+
+    # The next node for every (target cluster, node) pair is stored in the
+    # PLG's next node table
+    next_node_given_target, target_cluster_mask = get_path_generation_tables(PLG)
+    next_node_given_target = next_node_given_target[target_cluster]
+    is_in_target_cluster = target_cluster_mask[target_cluster]
 
     # Continue to add nodes to the path until we reach the target cluster. If
     # We add "None" to the path then we have reached a dead end and should
     # stop. I.e. we have reached a node that has no outgoing edges.
-    while (path[-1] not in PLG.target_clusters[target_cluster]) and \
-          (len(path) < max_path_length) and \
-          (path[-1] != None):
+    while (path[-1] != None) and \
+          (not is_in_target_cluster[path[-1]]) and \
+          (len(path) < max_path_length):
         # Get the next node
-        next_node = arg_max_p_next_node_given_target(p_next_node_given_target, closest_clusters_list, path[-1])
+        next_node = next_node_given_target[path[-1]]
         # Add the next node to the path
-        path.append(next_node)
+        path.append(None if next_node == NO_NODE else int(next_node))
 
     return path
 
 
+def get_path_generation_tables(PLG):
+    """Returns the next node table and the [target cluster, node] boolean
+    membership mask of the PLG. PLGs which don't have them (e.g. PLGs built
+    before they were added) get them built once and stored on the PLG, so
+    they are not rebuilt for every path.
+
+    Args:
+        PLG (PLG): PLG object to generate paths in.
+
+    Returns:
+        next_node_given_target (2D numpy array): See PLG.next_node_given_target.
+        target_cluster_mask (2D numpy array): See PLG.target_cluster_mask.
+    """
+    next_node_given_target = getattr(PLG, "next_node_given_target", None)
+    target_cluster_mask = getattr(PLG, "target_cluster_mask", None)
+    if (next_node_given_target is not None) and (target_cluster_mask is not None):
+        return next_node_given_target, target_cluster_mask
+
+    # Only one thread builds the missing tables
+    with PLG.lazy_attribute_lock:
+        if getattr(PLG, "next_node_given_target", None) is None:
+            PLG.next_node_given_target = get_next_node_given_target_table(PLG.p_next_node_given_target, PLG.closest_clusters_dict, PLG.num_nodes)
+        if getattr(PLG, "target_cluster_mask", None) is None:
+            PLG.node_target_cluster, PLG.target_cluster_mask = get_cluster_membership(PLG.target_clusters, len(PLG.target_clusters), PLG.num_nodes)
+        # Keep the tables read-only if they were added to a frozen PLG
+        for value in (PLG.next_node_given_target, PLG.node_target_cluster, PLG.target_cluster_mask):
+            PLG.freeze_if_frozen(value)
+
+    return PLG.next_node_given_target, PLG.target_cluster_mask
+
+
+def batch_path_generation(PLG, start_nodes, target_clusters, max_workers=None):
+    """Generates a path for each (start node, target cluster) pair using a
+    pool of threads which all share the same PLG. The PLG is frozen while the
+    threads run so that none of them can modify it, and unfrozen afterwards
+    unless it was already frozen.
+
+    Args:
+        PLG (PLG): PLG object to generate the paths in.
+        start_nodes (array): The start node of each path.
+        target_clusters (array): The target cluster of each path.
+        max_workers (int, optional): Number of threads. Defaults to None, in
+            which case ThreadPoolExecutor chooses.
+
+    Returns:
+        list: The path generated by path_generation for each pair.
+    """
+    assert len(start_nodes) == len(target_clusters)
+
+    # Make sure the attributes we need are loaded before the threads start
+    get_path_generation_tables(PLG)
+    was_frozen = PLG.__dict__.get("frozen", False)
+    PLG.freeze()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            paths = list(executor.map(lambda start_node, target_cluster: path_generation(PLG, start_node, target_cluster), start_nodes, target_clusters))
+    finally:
+        if not was_frozen:
+            PLG.unfreeze()
+
+    return paths
+
+
+def arg_max_p_next_nodes(p_next_node, current_nodes):
+    """Vectorised version of arg_max_p_next_node. Returns the next node with
+    the highest probability of being visited for each of the current nodes,
+    or NO_NODE if the row of the current node sums to zero.
+
+    Args:
+        p_next_node (scipy.sparse CSR matrix): Transition matrix.
+        current_nodes (numpy array): The current nodes.
+
+    Returns:
+        numpy array: The next node for each current node.
+    """
+    current_nodes = np.asarray(current_nodes, dtype=np.int64)
+    num_rows = len(current_nodes)
+    next_nodes = np.full(num_rows, NO_NODE, dtype=np.int64)
+
+    # Gather the stored entries of each row into one flat vector. "row_of_entry"
+    # tells us which of the current nodes each entry belongs to.
+    row_starts = p_next_node.indptr[current_nodes].astype(np.int64)
+    row_lengths = p_next_node.indptr[current_nodes + 1] - row_starts
+    row_of_entry = np.repeat(np.arange(num_rows), row_lengths)
+    entry_offsets = np.concatenate(([0], np.cumsum(row_lengths)))
+    entries = np.arange(entry_offsets[-1]) + np.repeat(row_starts - entry_offsets[:-1], row_lengths)
+    entry_data = p_next_node.data[entries]
+    if len(entry_data) == 0:
+        return next_nodes
+
+    # The next node is the first entry of its row which equals the row maximum
+    row_sum = np.bincount(row_of_entry, weights=entry_data, minlength=num_rows)
+    row_max = np.full(num_rows, -inf)
+    np.maximum.at(row_max, row_of_entry, entry_data)
+    max_entries = np.flatnonzero(entry_data == row_max[row_of_entry])
+    rows_with_max, first_max_entry = np.unique(row_of_entry[max_entries], return_index=True)
+    next_nodes[rows_with_max] = p_next_node.indices[entries[max_entries[first_max_entry]]]
+    next_nodes[row_sum == 0] = NO_NODE
+
+    return next_nodes
+
+
+def arg_max_p_next_nodes_given_targets(p_next_node_given_target, closest_clusters, current_nodes, target_clusters):
+    """Vectorised version of arg_max_p_next_node_given_target for many
+    (current node, target cluster) pairs.
+
+    Args:
+        p_next_node_given_target (dict): {target cluster : CSR matrix}.
+        closest_clusters (2D numpy array): Row i is the list of clusters
+            ordered by their distance from cluster i.
+        current_nodes (numpy array): The current nodes.
+        target_clusters (numpy array): The target cluster of each node.
+
+    Returns:
+        numpy array: The next node for each pair, NO_NODE if there is none.
+    """
+    num_pairs = len(current_nodes)
+    next_nodes = np.full(num_pairs, NO_NODE, dtype=np.int64)
+    pending = np.arange(num_pairs)
+
+    # Try the target cluster first, then the next closest cluster and so on
+    for ii_closest in range(closest_clusters.shape[1]):
+        if len(pending) == 0:
+            break
+        fallback_clusters = closest_clusters[target_clusters[pending], ii_closest]
+        for cluster in np.unique(fallback_clusters):
+            pairs = pending[fallback_clusters == cluster]
+            candidates = arg_max_p_next_nodes(p_next_node_given_target[cluster], current_nodes[pairs])
+            found = candidates != NO_NODE
+            next_nodes[pairs[found]] = candidates[found]
+        pending = pending[next_nodes[pending] == NO_NODE]
+
+    return next_nodes
+
+
+def get_next_node_given_target_table(p_next_node_given_target, closest_clusters_dict, num_nodes, nodes=None):
+    """Precomputes the answer of arg_max_p_next_node_given_target for every
+    (target cluster, node) pair, with the fallback to the closest clusters
+    already applied.
+
+    Args:
+        p_next_node_given_target (dict): {target cluster : CSR matrix}.
+        closest_clusters_dict (dict): {target cluster : list of clusters
+            ordered by their distance from the target cluster}.
+        num_nodes (int): Number of nodes in the PLG.
+        nodes (numpy array, optional): Only compute the columns of these
+            nodes, e.g. to update the table after some rows of the transition
+            matrices changed. Defaults to None, i.e., every node.
+
+    Returns:
+        2D numpy array: int32 array of shape [num target clusters, num nodes]
+            (or [num target clusters, len(nodes)]). Entry [t, n] is the next
+            node from node n given the target cluster t, or NO_NODE if there
+            is no next node.
+    """
+    num_target_clusters = len(closest_clusters_dict)
+    closest_clusters = np.array([closest_clusters_dict[ii] for ii in range(num_target_clusters)])
+    table_nodes = np.arange(num_nodes) if nodes is None else np.asarray(nodes, dtype=np.int64)
+    next_node_given_target = np.empty((num_target_clusters, len(table_nodes)), dtype=np.int32)
+    for target_cluster in range(num_target_clusters):
+        next_node_given_target[target_cluster,:] = arg_max_p_next_nodes_given_targets(p_next_node_given_target, closest_clusters, table_nodes, np.full(len(table_nodes), target_cluster))
+
+    return next_node_given_target
+
+
+def vectorised_path_generation(PLG, start_nodes, target_clusters, max_path_length=MAX_PATH_LENGTH):
+    """Generates a path for each (start node, target cluster) pair with the
+    same rules as path_generation. Rather than generating one path at a time,
+    every unfinished path is advanced by one step at a time by looking up the
+    PLG's next node table.
+
+    The paths are returned in a ragged layout: the nodes of path i are
+    path_nodes[path_offsets[i]:path_offsets[i+1]]. A path which reaches a dead
+    end ends with NO_NODE, which takes the place of "None".
+
+    Args:
+        PLG (PLG): PLG object to generate the paths in.
+        start_nodes (array): The start node of each path.
+        target_clusters (array): The target cluster of each path.
+        max_path_length (int, optional): Maximum number of nodes in a path.
+            Defaults to MAX_PATH_LENGTH.
+
+    Returns:
+        path_offsets (numpy array): Offset of each path in "path_nodes".
+        path_nodes (numpy array): The nodes of every path, one after another.
+    """
+    start_nodes = np.asarray(start_nodes, dtype=np.int64)
+    target_clusters = np.asarray(target_clusters, dtype=np.int64)
+    num_paths = len(start_nodes)
+    assert len(target_clusters) == num_paths
+
+    # The next node table and membership of each target cluster as a boolean
+    # matrix of [target cluster, node]
+    next_node_given_target, is_in_target_cluster = get_path_generation_tables(PLG)
+
+    # Record the (path, node) pairs added at each step, the paths are
+    # assembled from these records at the end
+    path_lengths = np.ones(num_paths, dtype=np.int64)
+    current_nodes = start_nodes.copy()
+    step_paths = [np.arange(num_paths)]
+    step_nodes = [start_nodes]
+    step_positions = [np.zeros(num_paths, dtype=np.int64)]
+    is_unfinished = ~is_in_target_cluster[target_clusters, current_nodes] & (path_lengths < max_path_length)
+
+    while is_unfinished.any():
+        paths = np.flatnonzero(is_unfinished)
+        next_nodes = next_node_given_target[target_clusters[paths], current_nodes[paths]].astype(np.int64)
+
+        # Add the next nodes to the paths
+        step_paths.append(paths)
+        step_nodes.append(next_nodes)
+        step_positions.append(path_lengths[paths])
+        path_lengths[paths] += 1
+        current_nodes[paths] = next_nodes
+
+        # A path is finished when it reaches its target cluster, the maximum
+        # length or a dead end
+        is_dead_end = next_nodes == NO_NODE
+        is_unfinished[paths] = ~is_dead_end & (path_lengths[paths] < max_path_length)
+        is_unfinished[paths[~is_dead_end]] &= ~is_in_target_cluster[target_clusters[paths[~is_dead_end]], next_nodes[~is_dead_end]]
+
+    # Assemble the ragged layout
+    path_offsets = np.concatenate(([0], np.cumsum(path_lengths)))
+    path_nodes = np.empty(path_offsets[-1], dtype=np.int64)
+    path_nodes[path_offsets[np.concatenate(step_paths)] + np.concatenate(step_positions)] = np.concatenate(step_nodes)
+
+    return path_offsets, path_nodes
+
+
+def get_cluster_membership(clusters, num_clusters, num_nodes):
+    """Converts a dictionary of {cluster id : [list of nodes in cluster]} into
+    arrays which can be indexed in O(1).
+
+    Args:
+        clusters (dict): {cluster id : [list of nodes in cluster]}.
+        num_clusters (int): Number of clusters.
+        num_nodes (int): Number of nodes in the PLG.
+
+    Returns:
+        node_cluster (numpy array): The cluster of each node, -1 if the node is
+            not in any cluster.
+        cluster_mask (2D numpy array): Boolean array of shape [num_clusters,
+            num_nodes]. Entry [c, n] is True if node n is in cluster c.
+    """
+    node_cluster = np.full(num_nodes, -1, dtype=np.int32)
+    cluster_mask = np.zeros((num_clusters, num_nodes), dtype=bool)
+    for cluster, cluster_nodes in clusters.items():
+        cluster_nodes = np.asarray(cluster_nodes, dtype=np.int64)
+        node_cluster[cluster_nodes] = cluster
+        cluster_mask[cluster, cluster_nodes] = True
+
+    return node_cluster, cluster_mask
+
+
+def get_path_edges(vehicle_paths):
+    """Concatenates the discrete vehicle paths into arrays of the edges that
+    were traversed, i.e. the (current node, next node) pairs of every path.
+
+    Args:
+        vehicle_paths (dict): {vehicle id : [list of nodes in path]}.
+
+    Returns:
+        current_nodes (numpy array): The node each edge starts at.
+        next_nodes (numpy array): The node each edge ends at.
+    """
+    paths = list(vehicle_paths.values())
+    path_lengths = np.fromiter((len(path) for path in paths), dtype=np.int64, count=len(paths))
+    path_nodes = np.fromiter((node for path in paths for node in path), dtype=np.int64, count=int(np.sum(path_lengths)))
+
+    # Every node except the last one of each path starts an edge
+    is_edge_start = np.ones(len(path_nodes), dtype=bool)
+    is_edge_start[np.cumsum(path_lengths[path_lengths > 0]) - 1] = False
+    edge_starts = np.flatnonzero(is_edge_start)
+
+    return path_nodes[edge_starts], path_nodes[edge_starts + 1]
+
+
+def get_transition_counts(current_nodes, next_nodes, num_nodes):
+    """Counts the number of times each (current node, next node) transition
+    occurs. The transitions are put into a sparse COO matrix with a count of
+    one each and the duplicates are summed when it is converted to CSR, so a
+    dense num_nodes x num_nodes array is never allocated.
+
+    Args:
+        current_nodes (numpy array): The node each transition starts at.
+        next_nodes (numpy array): The node each transition ends at.
+        num_nodes (int): Number of nodes in the PLG.
+
+    Returns:
+        scipy.sparse CSR matrix: int64 matrix of shape [num_nodes, num_nodes]
+            in canonical format. Entry [i, j] is the number of transitions
+            from node i to node j.
+    """
+    current_nodes = np.asarray(current_nodes, dtype=np.int64)
+    next_nodes = np.asarray(next_nodes, dtype=np.int64)
+    transition_counts = sp.coo_matrix((np.ones(len(current_nodes), dtype=np.int64), (current_nodes, next_nodes)), shape=(num_nodes, num_nodes)).tocsr()
+    transition_counts.sum_duplicates()
+    return transition_counts
+
+
+def get_transition_counts_given_target(vehicle_paths, node_target_cluster, num_target_clusters, num_nodes):
+    """Counts the transitions of the vehicle paths separately for each target
+    cluster, where the target cluster of a path is the cluster of its last
+    node. Paths whose last node is not in a target cluster are ignored.
+
+    Args:
+        vehicle_paths (dict): {vehicle id : [list of nodes in path]}.
+        node_target_cluster (numpy array): The target cluster of each node, -1
+            if the node is not in a target cluster.
+        num_target_clusters (int): Number of target clusters.
+        num_nodes (int): Number of nodes in the PLG.
+
+    Returns:
+        dict: {target cluster : int64 CSR matrix of transition counts}, see
+            get_transition_counts.
+    """
+    paths = [path for path in vehicle_paths.values() if len(path) > 1]
+    path_target_clusters = np.fromiter((node_target_cluster[path[-1]] for path in paths), dtype=np.int64, count=len(paths))
+    current_nodes, next_nodes = get_path_edges(dict(enumerate(paths)))
+    edge_target_clusters = np.repeat(path_target_clusters, [len(path) - 1 for path in paths])
+
+    return {ii: get_transition_counts(current_nodes[edge_target_clusters == ii], next_nodes[edge_target_clusters == ii], num_nodes) for ii in range(num_target_clusters)}
+
+
+def get_closest_nodes(nodes, points, node_tree=None):
+    """Returns the index of the closest node to each point. A KD-tree over the
+    nodes answers all of the queries in a single batch. The result is the same
+    as taking np.argmin of the euclidean distance to every node for each point:
+    if the two closest nodes are (numerically) tied we fall back to the brute
+    force search for that point so that ties are broken in the same way.
+
+    Args:
+        nodes (2D numpy array): [x, y] coordinates of the nodes.
+        points (2D numpy array): [x, y] coordinates of the points to query.
+        node_tree (cKDTree, optional): A KD-tree built over "nodes". Pass this
+            in if the same node set is queried multiple times. Defaults to
+            None, in which case the tree is built here.
+
+    Returns:
+        numpy array: Closest node index for each point.
+    """
+    nodes = np.asarray(nodes)
+    points = np.asarray(points).reshape(-1, 2)
+    if node_tree is None:
+        node_tree = cKDTree(nodes)
+
+    # Query the two closest nodes so that we can detect ties
+    num_neighbours = min(2, len(nodes))
+    distance, closest_nodes = node_tree.query(points, k=num_neighbours)
+    if num_neighbours == 1:
+        return closest_nodes.astype(np.int64)
+    distance_to_closest = distance[:,0]
+    closest_nodes = closest_nodes[:,0].astype(np.int64)
+
+    # Resolve (near) ties using the brute force search
+    tie_tolerance = 1e-9
+    tied_points = np.flatnonzero(distance[:,1] - distance_to_closest <= tie_tolerance*np.maximum(1, distance[:,1]))
+    for ii in tied_points:
+        closest_nodes[ii] = np.argmin(np.sqrt(np.sum(np.square(nodes - points[ii]), axis=1)))
+
+    return closest_nodes
+
+
 def node_list_to_edge_phase(PLG, node_list):
     """Converts a list of nodes into a list of edge phases. The edge phases
     are the phases that are traversed when moving from one node to the next.
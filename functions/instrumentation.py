@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import datetime
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from inputs import *
+
+# The resource module is only available on Unix. Elsewhere we don't record
+# the peak resident set size or the CPU time of child processes.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# The instrumentation of the current run, see Instrumentation. The stage
+# function below records into this so that the pipeline stages (and loops
+# within them) can be instrumented without passing it around.
+active_instrumentation = None
+
+
+def get_rss_mb():
+    """Returns the current resident set size of this process in MB, or None if
+    it is not available on this platform."""
+    try:
+        with open("/proc/self/statm", "r") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_peak_rss_mb():
+    """Returns the peak resident set size of this process so far in MB, or None
+    if it is not available on this platform."""
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1e6 if sys.platform == "darwin" else peak_rss * 1024 / 1e6
+
+
+def get_cpu_time():
+    """Returns the CPU time used by this process and any child processes which
+    have finished (e.g. process pool workers), in seconds."""
+    cpu_time = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time += children.ru_utime + children.ru_stime
+    return cpu_time
+
+
+class StageRecord:
+    """The measurements of one stage. Use "count" to record how many items
+    (data points, nodes, vehicles, ...) the stage processed.
+
+    Args:
+        name (string): Name of the stage. Nested stages are named
+            "<parent>/<child>".
+    """
+    def __init__(self, name) -> None:
+        self.name = name
+        self.counts = {}
+        self.info = {}
+        self.tracemalloc_peak = 0
+        self.result = {}
+
+    def count(self, item, num_items):
+        """Record that the stage processed "num_items" of "item"."""
+        self.counts[item] = self.counts.get(item, 0) + int(num_items)
+
+    def set(self, key, value):
+        """Record any other (JSON serialisable) information about the stage."""
+        self.info[key] = value
+
+
+class NullRecord(StageRecord):
+    """Record returned by stage when there is no active instrumentation."""
+    def __init__(self) -> None:
+        super().__init__(None)
+
+    def count(self, item, num_items):
+        pass
+
+    def set(self, key, value):
+        pass
+
+
+class Instrumentation:
+    """Context manager which records the wall time, CPU time, memory and item
+    counts of each stage of a run and writes them to a JSON report when the
+    run finishes. Within the context, wrap each stage in "stage(name)".
+
+    Args:
+        report_path (string, optional): File to write the JSON report to.
+            Defaults to None, i.e., no report is written.
+        trace_memory (bool, optional): If True, also record the peak memory
+            allocated by Python in each stage using tracemalloc. This slows
+            the run down. Defaults to False.
+        profile_dir (string, optional): If given, each top level stage is run
+            under cProfile and the stats are dumped to
+            "<profile_dir>/<stage name>.prof". Defaults to None.
+        run_info (dict, optional): Extra information to include in the report,
+            e.g. the dataset and parameters. Defaults to None.
+    """
+    def __init__(self, report_path=None, trace_memory=False, profile_dir=None, run_info=None) -> None:
+        self.report_path = report_path
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.run_info = run_info or {}
+        self.records = []
+        self.open_records = []
+
+    def __enter__(self):
+        global active_instrumentation
+        self.previous_instrumentation = active_instrumentation
+        active_instrumentation = self
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = datetime.datetime.now().isoformat()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = get_cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        global active_instrumentation
+        active_instrumentation = self.previous_instrumentation
+        if self.trace_memory:
+            tracemalloc.stop()
+        self.report = {"started": self.started,
+                       "run": self.run_info,
+                       "wall_time_s": time.perf_counter() - self.wall_start,
+                       "cpu_time_s": get_cpu_time() - self.cpu_start,
+                       "peak_rss_mb": get_peak_rss_mb(),
+                       "stages": [record.result for record in self.records]}
+        if self.report_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.report_path)), exist_ok=True)
+            with open(self.report_path, "w") as handle:
+                json.dump(self.report, handle, indent=1, default=str)
+        return False
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the code run within the context as the stage "name".
+        Yields the StageRecord of the stage."""
+        parent = self.open_records[-1] if self.open_records else None
+        record = StageRecord(name if parent is None else parent.name+"/"+name)
+        self.records.append(record)
+        self.open_records.append(record)
+
+        # tracemalloc has a single peak, so the peak so far is handed to the
+        # enclosing stage before it is reset for this one
+        if self.trace_memory:
+            if parent is not None:
+                parent.tracemalloc_peak = max(parent.tracemalloc_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        profiler = None
+        if (self.profile_dir is not None) and (parent is None):
+            profiler = cProfile.Profile()
+
+        rss_start = get_rss_mb()
+        cpu_start = get_cpu_time()
+        wall_start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = get_cpu_time() - cpu_start
+            self.open_records.pop()
+
+            # The peak RSS is the peak of the whole process so far, not of
+            # this stage. The peak of the stage itself is only known with
+            # trace_memory, see "tracemalloc_peak_mb".
+            record.result = {"name": record.name,
+                             "wall_time_s": wall_time,
+                             "cpu_time_s": cpu_time,
+                             "rss_start_mb": rss_start,
+                             "rss_end_mb": get_rss_mb(),
+                             "process_peak_rss_mb": get_peak_rss_mb(),
+                             "counts": record.counts}
+            if wall_time > 0:
+                record.result["items_per_s"] = {item: num_items / wall_time for item, num_items in record.counts.items()}
+            if self.trace_memory:
+                record.tracemalloc_peak = max(record.tracemalloc_peak, tracemalloc.get_traced_memory()[1])
+                record.result["tracemalloc_peak_mb"] = record.tracemalloc_peak / 1e6
+                if parent is not None:
+                    parent.tracemalloc_peak = max(parent.tracemalloc_peak, record.tracemalloc_peak)
+                tracemalloc.reset_peak()
+            record.result.update(record.info)
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, name+".prof"))
+
+
+def stage(name):
+    """Measure the code run within the context as the stage "name" of the
+    active instrumentation (see Instrumentation). If there is no active
+    instrumentation this does nothing, so it is safe to use in any function,
+    e.g.:
+
+        with instrumentation.stage("kmeans") as record:
+            ...
+            record.count("lanes", num_lanes)
+
+    Args:
+        name (string): Name of the stage.
+
+    Returns:
+        Context manager which yields the StageRecord of the stage.
+    """
+    if active_instrumentation is None:
+        return null_stage()
+    return active_instrumentation.stage(name)
+
+
+@contextmanager
+def null_stage():
+    yield NullRecord()
+
+
+def for_script(script_name, report_dir):
+    """Returns the Instrumentation for a run of "script_name", configured by
+    WRITE_RUN_REPORT, TRACE_MEMORY and PROFILE_STAGES in inputs.py. The
+    report (and the cProfile stats) are saved in "report_dir" under a name
+    which is unique to the time the run started."""
+    run_name = script_name+"_"+datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return Instrumentation(report_path=os.path.join(report_dir, run_name+".json") if WRITE_RUN_REPORT else None,
+                           trace_memory=TRACE_MEMORY,
+                           profile_dir=os.path.join(report_dir, run_name+"_profiles") if PROFILE_STAGES else None,
+                           run_info={"script": script_name, "dataset": DATASET})
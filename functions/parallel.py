@@ -0,0 +1,177 @@
+import numpy as np
+import os
+from collections import deque
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import functions.instrumentation as instrumentation
+from inputs import *
+
+
+# Sharding only pays for the cost of starting the worker processes and copying
+# the columns into shared memory when there is enough data. Each shard is
+# given at least this many data points.
+MIN_POINTS_PER_SHARD = 100000
+
+
+def get_num_workers(num_workers=None):
+    """Returns the number of worker processes to use.
+
+    Args:
+        num_workers (int, optional): Requested number of workers. Defaults to
+            None, which uses NUM_WORKERS from inputs.py, or one worker per CPU
+            core if that is also None.
+
+    Returns:
+        int: Number of worker processes, at least 1.
+    """
+    if num_workers is None:
+        num_workers = NUM_WORKERS
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    return max(1, int(num_workers))
+
+
+def get_shards(lengths, num_workers=None, min_points_per_shard=None):
+    """Splits a sequence of items (e.g. vehicle paths) into contiguous shards
+    which contain roughly the same number of data points.
+
+    Args:
+        lengths (numpy array): Number of data points in each item.
+        num_workers (int, optional): See get_num_workers.
+        min_points_per_shard (int, optional): Minimum number of data points in
+            a shard. Defaults to MIN_POINTS_PER_SHARD.
+
+    Returns:
+        list: (first item, last item + 1) of each shard, in item order. A
+            single shard means the work should be run serially.
+    """
+    if min_points_per_shard is None:
+        min_points_per_shard = MIN_POINTS_PER_SHARD
+    lengths = np.asarray(lengths)
+    num_items = len(lengths)
+    num_points = int(np.sum(lengths))
+    num_shards = min(get_num_workers(num_workers), num_points // max(1, min_points_per_shard), num_items)
+    if num_shards <= 1:
+        return [(0, num_items)]
+
+    # Cut the items where the cumulative number of data points crosses each
+    # multiple of num_points / num_shards
+    cumulative_points = np.cumsum(lengths)
+    cuts = np.searchsorted(cumulative_points, np.arange(1, num_shards) * (num_points / num_shards), side="right")
+    bounds = np.unique(np.concatenate(([0], cuts, [num_items])))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+class SharedArrays:
+    """Context manager which copies numpy arrays into shared memory so that
+    worker processes can read them without receiving a pickled copy. The
+    shared memory is released when the context exits.
+
+    Pass "handles" to run_sharded, or to call_with_shared_arrays in the
+    workers.
+
+    Args:
+        arrays (dict): {name : numpy array} to share.
+    """
+    def __init__(self, arrays) -> None:
+        self.arrays = arrays
+        self.shared_blocks = []
+        self.handles = {}
+
+    def __enter__(self):
+        for name, array in self.arrays.items():
+            array = np.ascontiguousarray(array)
+            shared_block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            self.shared_blocks.append(shared_block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shared_block.buf)[...] = array
+            self.handles[name] = (shared_block.name, array.shape, array.dtype.str)
+        return self
+
+    def __exit__(self, *exc_info):
+        for shared_block in self.shared_blocks:
+            shared_block.close()
+            shared_block.unlink()
+        self.shared_blocks = []
+        return False
+
+
+def call_with_shared_arrays(worker, handles, *args):
+    """Attaches to the arrays shared by SharedArrays from within a worker
+    process and returns "worker(arrays, *args)". The arrays are read-only and
+    are only valid during the call so the result must not be a view of them.
+
+    Args:
+        worker (function): Module level function to call.
+        handles (dict): SharedArrays.handles.
+        *args: Further arguments for "worker".
+
+    Returns:
+        The result of "worker".
+    """
+    shared_blocks = []
+    arrays = {}
+    try:
+        for name, (block_name, shape, dtype) in handles.items():
+            shared_block = shared_memory.SharedMemory(name=block_name)
+            shared_blocks.append(shared_block)
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_block.buf)
+            arrays[name].flags.writeable = False
+        return worker(arrays, *args)
+    finally:
+        # The views must be released before the shared memory can be closed
+        arrays.clear()
+        for shared_block in shared_blocks:
+            shared_block.close()
+
+
+def run_sharded(worker, handles, shards, num_workers=None):
+    """Runs "worker(arrays, first, last)" for every (first, last) shard in a
+    process pool, where "arrays" are the shared arrays described by
+    "handles", and returns the results in shard order.
+
+    Args:
+        worker (function): Module level function to run on each shard.
+        handles (dict): SharedArrays.handles of the arrays the workers read.
+        shards (list): Shards as returned by get_shards.
+        num_workers (int, optional): See get_num_workers.
+
+    Returns:
+        list: Result of "worker" for each shard.
+    """
+    num_workers = min(get_num_workers(num_workers), len(shards))
+    with instrumentation.stage(worker.__name__) as record:
+        record.count("shards", len(shards))
+        record.set("num_workers", num_workers)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(call_with_shared_arrays, worker, handles, first, last) for (first, last) in shards]
+            return [future.result() for future in futures]
+
+
+def map_lazily(function, *iterables, num_workers=None):
+    """Like "map", but runs "function" in a process pool and, unlike
+    "ProcessPoolExecutor.map", only reads ahead a couple of items per worker
+    from the input iterables. Use this instead when the inputs are generated
+    on the fly and holding all of them in memory at once is not an option.
+
+    Args:
+        function (function): Module level function to call.
+        *iterables: Iterables of the arguments of "function".
+        num_workers (int, optional): See get_num_workers. With one worker the
+            items are run one after another in this process.
+
+    Yields:
+        The result of "function" for each item, in order.
+    """
+    num_workers = get_num_workers(num_workers)
+    if num_workers == 1:
+        yield from map(function, *iterables)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for args in zip(*iterables):
+            pending.append(executor.submit(function, *args))
+            if len(pending) >= 2*num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,162 @@
+import numpy as np
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import classes.PLG as plg
+
+
+# Number of array elements hashed at a time by hash_arrays
+HASH_BLOCK_SIZE = 1 << 20
+# Root directory of the repository. Only the source of modules within this
+# directory is hashed into the stage keys.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def hash_arrays(*arrays):
+    """Returns a hash of the contents of one or more arrays.
+
+    Args:
+        *arrays (array_like): Arrays to hash.
+
+    Returns:
+        string: sha256 hex digest of the dtype, shape and data of each array.
+    """
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.asarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        # Hash the data a block at a time so that memory mapped arrays are
+        # not read into memory in one go
+        flat_array = array.reshape(-1)
+        for block_start in range(0, len(flat_array), HASH_BLOCK_SIZE):
+            digest.update(np.ascontiguousarray(flat_array[block_start:block_start + HASH_BLOCK_SIZE]).data)
+    return digest.hexdigest()
+
+
+def get_source_files(stage):
+    """Returns the source files of the module a stage is defined in and of
+    every module of this repository it uses, directly or through the modules
+    it uses. Modules are found from the modules, functions and classes in the
+    namespace of each module, e.g. "import functions.graph as graph" or
+    "from node_generation import node_generation".
+
+    Args:
+        stage (function): The stage function.
+
+    Returns:
+        list: Sorted absolute paths of the source files.
+    """
+    source_files = set()
+    visited_modules = set()
+    pending_modules = [inspect.getmodule(stage)]
+    while pending_modules:
+        module = pending_modules.pop()
+        if (module is None) or (id(module) in visited_modules):
+            continue
+        visited_modules.add(id(module))
+        source_file = getattr(module, "__file__", None)
+        if source_file is None:
+            continue
+        source_file = os.path.abspath(source_file)
+        if (os.path.commonpath([source_file, REPO_ROOT]) != REPO_ROOT) or ("site-packages" in source_file):
+            continue
+        source_files.add(source_file)
+        for value in vars(module).values():
+            if inspect.ismodule(value):
+                pending_modules.append(value)
+            elif inspect.isfunction(value) or inspect.isclass(value):
+                pending_modules.append(inspect.getmodule(value))
+    return sorted(source_files)
+
+
+def get_stage_key(stage, upstream_keys, params):
+    """Returns the cache key of a stage. The key is a hash of the stage's
+    name, the source code of the module it is defined in and of the modules
+    of this repository it depends on (see get_source_files), its parameters
+    and the keys of the stages (or data) it depends on, so it changes whenever
+    anything which could change the stage's output changes.
+
+    Args:
+        stage (function): The stage function.
+        upstream_keys (list): Keys of the inputs of the stage.
+        params (dict): {name : value} of the parameters of the stage.
+
+    Returns:
+        string: sha256 hex digest.
+    """
+    source_digest = hashlib.sha256()
+    for source_file in get_source_files(stage):
+        source_digest.update(os.path.relpath(source_file, REPO_ROOT).encode())
+        with open(source_file, "rb") as handle:
+            source_digest.update(hashlib.sha256(handle.read()).digest())
+    description = {"stage": stage.__name__, "source": source_digest.hexdigest(), "params": params, "upstream": list(upstream_keys)}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+class StageCache:
+    """On-disk cache of the outputs of the PLG generation stages. Each stage
+    writes its outputs as attributes of one or more objects (e.g. the PLG and
+    the data), so the cache stores those attributes, in the format used by
+    save_plg, under cache_dir/<stage name>/<stage key>. Only the newest
+    entry of each stage is kept: when a stage is rerun its older entries are
+    deleted, so the cache holds at most one copy of each stage's outputs.
+
+    Args:
+        cache_dir (string): Directory to keep the cache in.
+        force (bool, optional): If True every stage is rerun and the cache is
+            overwritten. Defaults to False.
+        enabled (bool, optional): If False stages are always run and nothing
+            is cached. Defaults to True.
+    """
+    def __init__(self, cache_dir, force=False, enabled=True) -> None:
+        self.cache_dir = cache_dir
+        self.force = force
+        self.enabled = enabled
+
+    def run_stage(self, stage, args, upstream_keys, params, outputs):
+        """Runs "stage(*args)", or restores its outputs from the cache.
+
+        Args:
+            stage (function): The stage function.
+            args (tuple): Arguments to call the stage with.
+            upstream_keys (list): Keys of the inputs of the stage, see
+                get_stage_key.
+            params (dict): Parameters of the stage, see get_stage_key.
+            outputs (dict): {prefix : (object, [attribute names])} of the
+                attributes the stage sets, e.g. {"PLG": (PLG, ["adjmat"])}.
+
+        Returns:
+            key (string): The stage key, pass this on to downstream stages.
+            is_cached (bool): True if the outputs were restored from the cache.
+        """
+        key = get_stage_key(stage, upstream_keys, params)
+        entry_dir = os.path.join(self.cache_dir, stage.__name__, key)
+
+        if self.enabled and (not self.force) and os.path.isfile(os.path.join(entry_dir, plg.PLG_MANIFEST_NAME)):
+            # The arrays are memory mapped copy-on-write, so a stage may still
+            # modify its inputs in place without changing the cache
+            loaders = plg.load_attributes(entry_dir, mmap_mode="c")
+            for prefix, (obj, names) in outputs.items():
+                for name in names:
+                    setattr(obj, name, loaders[prefix+"."+name]())
+            return key, True
+
+        stage(*args)
+        if self.enabled:
+            plg.save_attributes({prefix+"."+name: getattr(obj, name) for prefix, (obj, names) in outputs.items() for name in names}, entry_dir)
+            self.prune(stage.__name__, key)
+        return key, False
+
+    def prune(self, stage_name, key):
+        """Deletes every entry of the stage "stage_name" except "key".
+
+        Args:
+            stage_name (string): Name of the stage function.
+            key (string): Key of the entry to keep.
+        """
+        stage_dir = os.path.join(self.cache_dir, stage_name)
+        for entry_name in os.listdir(stage_dir):
+            if entry_name != key:
+                shutil.rmtree(os.path.join(stage_dir, entry_name), ignore_errors=True)
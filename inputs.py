@@ -2,10 +2,11 @@
 # This file contains all of the inputs the user may modify for the PLG        #
 # generation and visualisation code.                                          #
 #                                                                             #
-# The inputs will be split into three sections:                               #
+# The inputs will be split into four sections:                                #
 # 1. Dataset                                                                  #
 # 2. PLG generation                                                           #
-# 3. PLG visualisation                                                        #
+# 3. Performance                                                              #
+# 4. PLG visualisation                                                        #
 #                                                                             #
 # All inputs are provided in the variables below. If any of the inputs are    #
 # modified, the user must ensure that the valid script is (re)run in order    #
@@ -101,6 +102,89 @@ NUM_START_CLUSTERS = 10
 NUM_TARGET_CLUSTERS = 10
 DO_KMEANS = True
 
+###############################################################################
+# Performance                                                                 #
+#                                                                             #
+# Relevant script: - plg-generation\plg_generation.py                         #
+#                                                                             #
+# Purpose: Specify how the more expensive steps of the PLG generation process #
+#          are run. These parameters only affect the run time, the generated  #
+#          PLG is the same for any number of workers.                         #
+#                                                                             #
+# Params:  NUM_WORKERS            - The number of worker processes used for   #
+#                                   the steps which are run in parallel. Set  #
+#                                   to None to use one worker per CPU core or #
+#                                   to 1 to run everything in the main        #
+#                                   process.                                  #
+#          KMEANS_MINIBATCH_THRESHOLD                                         #
+#                                 - Lanes with more data points than this use #
+#                                   mini-batch k-means instead of k-means in  #
+#                                   the node generation step. Mini-batch      #
+#                                   k-means is much faster on very long lanes #
+#                                   but gives slightly different nodes. Set   #
+#                                   to None to always use k-means.            #
+#          KMEANS_SEED            - The random seed given to the k-means      #
+#                                   steps so that the PLG is reproducible.    #
+#          USE_STAGE_CACHE        - Boolean value. Set to True to cache the   #
+#                                   output of each PLG generation stage in    #
+#                                   data/<dataset name>/data-structures/cache #
+#                                   When the script is rerun, only the stages #
+#                                   whose inputs or parameters have changed   #
+#                                   (and the stages after them) are rerun.    #
+#                                   Only the newest output of each stage is   #
+#                                   kept, the cache can be deleted at any     #
+#                                   time to free the disk space.              #
+#          FORCE_REBUILD          - Boolean value. Set to True to ignore the  #
+#                                   cache and rerun every stage. The cache is #
+#                                   still updated with the new outputs.       #
+#          WRITE_RUN_REPORT       - Boolean value. Set to True to write a     #
+#                                   JSON report of the wall time, CPU time,   #
+#                                   memory use and number of items processed  #
+#                                   by each stage of the data cleaning and    #
+#                                   PLG generation scripts to                 #
+#                                   data/<dataset name>/reports.              #
+#          TRACE_MEMORY           - Boolean value. Set to True to also record #
+#                                   the peak memory allocated by Python in    #
+#                                   each stage. This slows the scripts down.  #
+#          PROFILE_STAGES         - Boolean value. Set to True to run each    #
+#                                   stage under cProfile and save the stats   #
+#                                   next to the report. The stats can be      #
+#                                   viewed with the pstats module or a tool   #
+#                                   such as snakeviz.                         #
+#          STREAMING_CHUNK_SIZE   - Set to a number of data points to load,   #
+#                                   clean and process the dataset in chunks   #
+#                                   of about this many data points, for       #
+#                                   datasets which do not fit in memory. The  #
+#                                   columns are kept in .npy files on disk    #
+#                                   and memory mapped. Also used by           #
+#                                   data-processing\data_cleaner.py. Set to   #
+#                                   None to hold the dataset in memory.       #
+#          TILE_SIZE              - Set to a length in metres to build the    #
+#                                   nodes and discretise the vehicle paths    #
+#                                   tile by tile, in parallel, for maps which #
+#                                   are too large to process in one go. The   #
+#                                   map is split into square tiles with sides #
+#                                   of this length. Set to None to build the  #
+#                                   whole map at once.                        #
+#          TILE_OVERLAP           - How far, in metres, each tile reaches     #
+#                                   into its neighbours when its nodes are    #
+#                                   generated and its data points are         #
+#                                   discretised, so that the tiles join up at #
+#                                   their borders.                            #
+#                                                                             #
+###############################################################################
+NUM_WORKERS = None
+KMEANS_MINIBATCH_THRESHOLD = None
+KMEANS_SEED = 0
+USE_STAGE_CACHE = True
+FORCE_REBUILD = False
+WRITE_RUN_REPORT = True
+TRACE_MEMORY = False
+PROFILE_STAGES = False
+STREAMING_CHUNK_SIZE = None
+TILE_SIZE = None
+TILE_OVERLAP = 25
+
 ###############################################################################
 # PLG visualisation                                                           #
 #                                                                             #
@@ -147,6 +231,20 @@ DO_KMEANS = True
 #                                 all of the background data will be the same #
 #                                 colour. In our dataset, the lane IDs are    #
 #                                 only available for the Lankershim dataset.  #
+#          RASTERISE_BACKGROUND_DATA                                          #
+#                               - Boolean value. Set to True to bin the       #
+#                                 background data into an image, shaded by    #
+#                                 the density of the data (or coloured by     #
+#                                 lane ID), which is shown with imshow. The   #
+#                                 time matplotlib takes to render the image   #
+#                                 does not depend on the number of data       #
+#                                 points. Set to False to scatter every data  #
+#                                 point instead.                              #
+#          BACKGROUND_DATA_RESOLUTION                                         #
+#                               - The side of each pixel of the rasterised    #
+#                                 background data in metres. The pixels are   #
+#                                 made larger if the image would be more than #
+#                                 4000 pixels across.                         #
 #                                                                             #
 # Node params:                                                                #
 #          NODE_SIZE            - The size of the nodes in the PLG.           #
@@ -228,6 +326,8 @@ PLOT_PLG = True
 PLOT_BACKGROUND_DATA = False
 COLOUR_OF_BACKGROUND_DATA = "grey"
 COLOUR_CODE_LANES_IN_BACKGROUND_DATA = False
+RASTERISE_BACKGROUND_DATA = True
+BACKGROUND_DATA_RESOLUTION = 0.5
 
 NODE_SIZE = 5
 NODE_COLOUR = "black"
@@ -1,5 +1,11 @@
 import numpy as np
+import scipy.sparse as sp
 import functions.general as g
+import functions.graph as graph
+
+
+# Edges longer than this (in metres) are removed from the PLG
+MAX_EDGE_LEN = 7.5
 
 
 ###############################################################################
@@ -12,61 +18,57 @@ import functions.general as g
 #          there is no edge between nodes ii and jj, otherwise there is an    #
 #          edge and the value of the entry is the number of times that edge   #
 #          was traversed by vehicles in the dataset.                          #    
+#                                                                             #
+#          The paths are concatenated into arrays of (from, to) node pairs    #
+#          so that the edge lengths, pruning and counting are all vectorised  #
+#          and the stage runs in time (close to) linear in the total path     #
+#          length. Edges longer than max_edge_len are removed in both         #
+#          directions. The final adjacency matrix is stored as a              #
+#          scipy.sparse CSR matrix.                                           #
+#                                                                             #
+#          The integer transition counts are kept in PLG.adjmat_counts so     #
+#          that the PLG can be updated with new data later on without         #
+#          recounting the old data (see plg_update.py).                       #
 #                                                                             #                                    
 # Params IN/OUT PLG  - A PLG object of type "PLG" defined in classes/PLG.py.  #
-#                      The PLG.adjmat parameter will be updated with the 2D   #
-#                      numpy array.                                           #
+#                      The PLG.adjmat parameter will be updated with the      #
+#                      sparse CSR matrix and PLG.adjmat_counts with the       #
+#                      counts it was normalised from.                         #
 #                                                                             #
 ###############################################################################
 def adj_mat_generation(PLG):
-    # Initialisations
-    discrete_vehicle_paths = PLG.vehicle_paths
-    PLG.adjmat = np.zeros((PLG.num_nodes, PLG.num_nodes))
-    max_edge_len = 7.5
-
-    # Cycle through the discrete vehicle paths and create edges between any two
-    # adjacent nodes in a vehicle path
-    for ii in discrete_vehicle_paths:
-        # Path as a list of nodes
-        path = discrete_vehicle_paths[ii]
-        path_length = len(path)
-
-        # Cycle through the vehicle path
-        for jj in range(path_length - 1):
-            current_node = path[jj]
-            next_node = path[jj + 1]
-
-            # Create an edge between these two nodes, we're going from
-            # current_node->next node so we will only increment the row/col
-            # corresponding to [current_node, next_node]. This means that the
-            # directions in our adjacency matric are as follows:
-            # current_node = row
-            # nect_node = column
-            # So an edge goes from the row to the column
-            PLG.adjmat[current_node, next_node] += 1
+    # Get every edge traversed by a vehicle. An edge goes from current_node to
+    # next_node so the directions in our adjacency matrix are as follows:
+    # current_node = row
+    # next_node = column
+    current_nodes, next_nodes = graph.get_path_edges(PLG.vehicle_paths)
 
     # Remove super long edges from the PLG
-    for ii in range(PLG.num_nodes-1):
-        for jj in range(ii+1, PLG.num_nodes):
-            if PLG.adjmat[ii,jj] > 0:
-                # Coords of 1st node
-                n1 = complex(PLG.nodes[ii,0], PLG.nodes[ii,1])
-                # Coords of 2nd node
-                n2 = complex(PLG.nodes[jj,0], PLG.nodes[jj,1])
-                # Distance of this edge
-                n1n2_length = abs(n1 - n2)
-                if n1n2_length > max_edge_len:
-                    PLG.adjmat[ii,jj] = 0
+    current_nodes, next_nodes = remove_long_edges(PLG.nodes, current_nodes, next_nodes)
 
-    # Convert the adjacency matrix to a probability matrix by cylcing through
-    # each row and dividing each entry by the sum of the row
-    PLG.adjmat = g.normalise_matrix_rows(PLG.adjmat)
-
-    return True
-
-
-    
+    # Count the number of times each edge was traversed
+    PLG.adjmat_counts = graph.get_transition_counts(current_nodes, next_nodes, PLG.num_nodes)
 
+    # Convert the adjacency matrix to a probability matrix by dividing each
+    # entry by the sum of its row
+    PLG.adjmat = g.normalise_matrix_rows(PLG.adjmat_counts)
 
+    return True
 
 
+###############################################################################
+# remove_long_edges:                                                          #
+#                                                                             #
+# Purpose: Remove the edges which are longer than MAX_EDGE_LEN.               #
+#                                                                             #
+# Params: IN  nodes         - 2D numpy array of the [x, y] node coordinates.  #
+#         IN  current_nodes - The node each edge starts at.                   #
+#         IN  next_nodes    - The node each edge ends at.                     #
+#         OUT current_nodes - The node each kept edge starts at.              #
+#         OUT next_nodes    - The node each kept edge ends at.                #
+#                                                                             #
+###############################################################################
+def remove_long_edges(nodes, current_nodes, next_nodes):
+    edge_lengths = np.hypot(nodes[next_nodes,0] - nodes[current_nodes,0], nodes[next_nodes,1] - nodes[current_nodes,1])
+    is_kept = edge_lengths <= MAX_EDGE_LEN
+    return current_nodes[is_kept], next_nodes[is_kept]
@@ -1,5 +1,6 @@
 import numpy as np
 from sklearn.cluster import KMeans
+import functions.graph as graph
 from inputs import *
 
 
@@ -14,7 +15,12 @@ from inputs import *
 # Params: IN/OUT PLG  - A PLG object of type "PLG" defined in classes/PLG.py. #
 #                       The PLG.start_cluster and PLG.target_cluster          #
 #                       parameterts will be updated with the start and target #
-#                       clusters generated by this function.                  #  
+#                       clusters generated by this function. The cluster of   #
+#                       each node and the cluster membership masks are also   #
+#                       stored (PLG.node_start_cluster,                       #
+#                       PLG.node_target_cluster, PLG.start_cluster_mask and   #
+#                       PLG.target_cluster_mask) so that cluster lookups are  #
+#                       O(1) array indexing.                                  #  
 #                                                                             # 
 ###############################################################################
 def cluster_generation(PLG):
@@ -44,11 +50,11 @@ def cluster_generation(PLG):
 
     # We now do a k-means clustering on the start and target nodes
     # Start nodes
-    kmeans_start = KMeans(n_clusters=NUM_START_CLUSTERS, init='k-means++', n_init=1, max_iter=num_kmeans_iterations).fit(start_node_coords)
+    kmeans_start = KMeans(n_clusters=NUM_START_CLUSTERS, init='k-means++', n_init=1, max_iter=num_kmeans_iterations, random_state=KMEANS_SEED).fit(start_node_coords)
     start_node_cluster_labels = kmeans_start.labels_
 
     # Target nodes
-    kmeans_target = KMeans(n_clusters=NUM_TARGET_CLUSTERS, init='k-means++', n_init=1, max_iter=num_kmeans_iterations).fit(target_node_coords)
+    kmeans_target = KMeans(n_clusters=NUM_TARGET_CLUSTERS, init='k-means++', n_init=1, max_iter=num_kmeans_iterations, random_state=KMEANS_SEED).fit(target_node_coords)
     target_node_cluster_labels = kmeans_target.labels_
 
     # Build the start and target cluster dictionaries
@@ -91,5 +97,9 @@ def cluster_generation(PLG):
     PLG.target_clusters = target_clusters
     PLG.closest_clusters_dict = closest_clusters_dict
 
+    # Build the node to cluster reverse index and the membership masks
+    PLG.node_start_cluster, PLG.start_cluster_mask = graph.get_cluster_membership(start_clusters, NUM_START_CLUSTERS, PLG.num_nodes)
+    PLG.node_target_cluster, PLG.target_cluster_mask = graph.get_cluster_membership(target_clusters, NUM_TARGET_CLUSTERS, PLG.num_nodes)
+
     return True
 
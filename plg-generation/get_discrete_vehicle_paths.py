@@ -1,8 +1,12 @@
 import numpy as np
 import classes.data as d
 import functions.general as g
+import functions.graph as graph
+import functions.parallel as parallel
 import functions.date_time as date_time
 import time
+import tempfile
+from inputs import *
 
 
 ###############################################################################
@@ -12,7 +16,18 @@ import time
 #          continuous vehicle paths into a discrete format. This function     #
 #          takes the continuous vehicle paths and converts them into a set of #
 #          nodes in the PLG. A vehicle's position is associated with the node #
-#          that it is closest to.                                             #
+#          that it is closest to. The closest nodes for the whole dataset are #
+#          found in one batch using a KD-tree built once over PLG.nodes.      #
+#                                                                             #
+#          The vehicles are independent of each other so, on large datasets,  #
+#          the rows of the vehicle sese matrix are split into shards which    #
+#          are discretised in a process pool (see functions/parallel.py). The #
+#          result is identical to discretising serially.                      #
+#                                                                             #
+#          In streaming mode (chunk_size is not None) the rows are instead    #
+#          discretised serially in chunks of about chunk_size data points and #
+#          data.node is a memory mapped array in a temporary file, so the     #
+#          data can be memory mapped arrays which do not fit in memory.       #
 #                                                                             #
 # Params: IN/OUT data - A data object of type "data" defined in               #
 #                       classes/data.py which contains the cleaned dataset.   #
@@ -23,64 +38,107 @@ import time
 #                       The PLG.vehicle_paths parameter will be updated with  #
 #                       the discretised vehicle paths generated by this       #
 #                       function.                                             #
+#         IN     num_workers - Number of worker processes. Defaults to        #
+#                              NUM_WORKERS in inputs.py, 1 always runs        #
+#                              serially.                                      #
+#         IN     chunk_size  - Number of data points to discretise at a time  #
+#                              in streaming mode. Defaults to                 #
+#                              STREAMING_CHUNK_SIZE in inputs.py.             #
 #                                                                             #
 ###############################################################################
-def get_discrete_vehicle_paths(data, PLG):
+def get_discrete_vehicle_paths(data, PLG, num_workers=None, chunk_size=None):
     # Create a dictionary of {vehicle id : unique node list vehicle path}
     discrete_vehicle_paths = {}
-    num_paths = len(data.vehicle_sese[:,0])
-    nodal_data = [0 for ii in range(data.num_data_points)]
-    nodes = PLG.nodes
-    global_counter = 0
-
-    # Cycle through each vehicle path and calculate it's discretised version
-    for ii in range(num_paths):
-        # Initialise the path for this vehicle
-        vehicle_id = data.vehicle_sese[ii,0]
-        # We use a dict to store the growing vehicle path because we get O(1)
-        # search speed.
-        vehicle_path_dict = {}
+    arrays = {"x": np.asarray(data.x), "y": np.asarray(data.y), "nodes": np.asarray(PLG.nodes), "vehicle_sese": np.asarray(data.vehicle_sese)}
+    vehicle_index = g.SEIndex(arrays["vehicle_sese"])
 
-        # Get the continuous path 
-        x_path = g.se_extraction(vehicle_id, data.x, data.vehicle_sese)
-        y_path = g.se_extraction(vehicle_id, data.y, data.vehicle_sese)
-        path_length = len(x_path)
+    # Discretise the vehicle paths, shard by shard if there is enough data.
+    # The shards are made up of whole rows of the sese matrix.
+    segment_offsets = np.concatenate(([0], np.cumsum(vehicle_index.segment_ends + g.ONE - vehicle_index.segment_starts)))
+    row_lengths = np.diff(segment_offsets[np.concatenate(([0], np.cumsum(arrays["vehicle_sese"][:,1])))])
+    if chunk_size is None:
+        chunk_size = STREAMING_CHUNK_SIZE
 
-        # Now cycle through the vehicle path
-        for jj in range(path_length):
-            x_jj = x_path[jj,0]
-            y_jj = y_path[jj,0]
-            d_jj = np.array([[x_jj, y_jj]])
+    # nodal_data stores the closest node to every data point
+    if chunk_size is None:
+        nodal_data = np.full(len(arrays["x"]), -1, dtype=np.int64)
+    else:
+        nodal_data = np.memmap(tempfile.TemporaryFile(), dtype=np.int64, mode="w+", shape=(len(arrays["x"]),))
+        for (chunk_start, chunk_x) in g.iter_chunks(arrays["x"], chunk_size=chunk_size):
+            nodal_data[chunk_start:chunk_start + len(chunk_x)] = -1
 
-            # Get the closest node to the current position
-            node_jj = np.argmin(np.sqrt(np.sum(np.square(nodes - d_jj), axis=1)))
+    if chunk_size is None:
+        shards = parallel.get_shards(row_lengths, num_workers=num_workers)
+        if len(shards) == 1:
+            shard_results = [discretise_vehicle_shard(arrays, *shards[0])]
+        else:
+            with parallel.SharedArrays(arrays) as shared:
+                shard_results = parallel.run_sharded(discretise_vehicle_shard, shared.handles, shards, num_workers=num_workers)
+    else:
+        shard_results = (discretise_vehicle_shard(arrays, first_row, last_row) for (first_row, last_row) in g.get_chunks(row_lengths, chunk_size=chunk_size))
 
-            # If this node is not already in the discrete path then append it,
-            # otherwise skip it. We can get multiple instances of a node in a
-            # vehicle path if, for example, a vehicle is stopped at a traffic
-            # light.
-            if node_jj not in vehicle_path_dict:
-                vehicle_path_dict[node_jj] = True
+    # Gather the results in vehicle order
+    for (point_index, closest_nodes, vehicle_paths) in shard_results:
+        nodal_data[point_index] = closest_nodes
+        discrete_vehicle_paths.update(vehicle_paths)
 
-            # We want to store the nodes to the data.node anyway because we
-            # want to store a discrete version of spatial data anyway. So we
-            # Will use this list to store the data and then assign it to
-            # data.node.
-            nodal_data[global_counter] = node_jj
-            global_counter += 1
-
-        # We've finished iterating this vehicle path. Now convert the
-        # vehicle_path_dict into a list of nodes. We can do this by taking just
-        # the keys of the dictionary.
-        discrete_vehicle_paths[vehicle_id] = list(vehicle_path_dict.keys())
+    # Any data points which are not part of a vehicle path still get their
+    # closest node
+    for (chunk_start, chunk_nodes, chunk_x, chunk_y) in g.iter_chunks(nodal_data, arrays["x"], arrays["y"], chunk_size=chunk_size):
+        is_missing = chunk_nodes < 0
+        if np.any(is_missing):
+            nodal_data[chunk_start + np.flatnonzero(is_missing)] = graph.get_closest_nodes(arrays["nodes"], np.column_stack((chunk_x[is_missing], chunk_y[is_missing])))
 
     # Objects are passed by reference so now we set the data.nodes and
     # PLG.vehicle_paths data structures here and we will save the data and PLG
     # outside objects outsde of this function in the place that this function
-    # is called.
+    # is called. data.node stores a discrete version of the spatial data in
+    # the same order as data.x and data.y.
     PLG.vehicle_paths = discrete_vehicle_paths
     data.node = nodal_data
 
     return True
 
 
+###############################################################################
+# discretise_vehicle_shard:                                                   #
+#                                                                             #
+# Purpose: Discretise the vehicles in the rows [first_row, last_row) of the   #
+#          vehicle sese matrix. This is run by the worker processes in the    #
+#          sharded mode of get_discrete_vehicle_paths so it must stay at      #
+#          module level.                                                      #
+#                                                                             #
+# Params: IN  arrays          - Dictionary holding the "x", "y", "nodes" and  #
+#                               "vehicle_sese" arrays.                        #
+#         IN  first_row       - First row of the sese matrix to discretise.   #
+#         IN  last_row        - One past the last row to discretise.          #
+#         OUT point_index     - Index of every data point in the shard.       #
+#         OUT closest_nodes   - Closest node to each data point in            #
+#                               point_index.                                  #
+#         OUT vehicle_paths   - List of (vehicle id, unique node list vehicle #
+#                               path) in the order of the sese matrix rows.   #
+#                                                                             #
+###############################################################################
+def discretise_vehicle_shard(arrays, first_row, last_row):
+    vehicle_sese = arrays["vehicle_sese"][first_row:last_row]
+    vehicle_index = g.SEIndex(vehicle_sese)
+
+    # Get the data points of every segment, ordered by row and then by the
+    # instance of the vehicle ID, and find their closest nodes in one go
+    segment_lengths = vehicle_index.segment_ends + g.ONE - vehicle_index.segment_starts
+    segment_offsets = np.concatenate(([0], np.cumsum(segment_lengths)))
+    point_index = np.arange(segment_offsets[-1]) + np.repeat(vehicle_index.segment_starts - segment_offsets[:-1], segment_lengths)
+    closest_nodes = graph.get_closest_nodes(arrays["nodes"], np.column_stack((arrays["x"][point_index], arrays["y"][point_index])))
+
+    # Cycle through each vehicle path and calculate it's discretised version.
+    # Only keep the first instance of each node in the discrete path. We can
+    # get multiple instances of a node in a vehicle path if, for example, a
+    # vehicle is stopped at a traffic light. A dict preserves insertion order
+    # and gives us O(1) search speed.
+    row_offsets = segment_offsets[np.concatenate(([0], np.cumsum(vehicle_sese[:,1])))]
+    vehicle_paths = []
+    for ii, vehicle_id in enumerate(vehicle_sese[:,0]):
+        node_path = closest_nodes[row_offsets[ii]:row_offsets[ii + 1]]
+        vehicle_paths.append((vehicle_id, list(dict.fromkeys(node_path))))
+
+    return point_index, closest_nodes, vehicle_paths
@@ -0,0 +1,25 @@
+import functions.graph as graph
+
+
+###############################################################################
+# next_node_table_generation:                                                 #
+#                                                                             #
+# Purpose: Precompute the next node the path generation algorithm will choose #
+#          for every (target cluster, node) pair. The choice only depends on  #
+#          the node and the target cluster, so path generation can look the  #
+#          next node up in this table instead of searching the transition     #
+#          matrices at every step. If there is no next node given the target  #
+#          cluster we fall back to the next closest cluster, and so on, in    #
+#          the same way as graph.arg_max_p_next_node_given_target.            #
+#                                                                             #
+# Params: IN/OUT PLG  - A PLG object of type "PLG" defined in classes/PLG.py. #
+#                       The PLG.next_node_given_target parameter will be      #
+#                       updated with a 2D int32 numpy array of shape [number  #
+#                       of target clusters, number of nodes]. Entries with no #
+#                       next node are set to -1.                              #
+#                                                                             #
+###############################################################################
+def next_node_table_generation(PLG):
+    PLG.next_node_given_target = graph.get_next_node_given_target_table(PLG.p_next_node_given_target, PLG.closest_clusters_dict, PLG.num_nodes)
+
+    return True
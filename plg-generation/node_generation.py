@@ -1,6 +1,9 @@
 import numpy as np
-from numpy.linalg import norm
-from sklearn.cluster import KMeans
+import math
+from sklearn.cluster import KMeans, MiniBatchKMeans
+import functions.general as g
+import functions.parallel as parallel
+import functions.instrumentation as instrumentation
 from inputs import *
 
 
@@ -16,81 +19,73 @@ from inputs import *
 #          respectively: [x, y]. The node ID will be the row index of the     #
 #          coordinate in the 2D numpy.                                        #
 #                                                                             #
+#          The nodes accepted so far are hashed into a grid of square cells   #
+#          with side MIN_DIST_BETWEEN_NODES. Any node closer than             #
+#          MIN_DIST_BETWEEN_NODES to a data point must lie in the data        #
+#          point's cell or one of its eight neighbours so only those cells    #
+#          are checked.                                                       #
+#                                                                             #
+#          The data is read STREAMING_CHUNK_SIZE data points at a time (see   #
+#          inputs.py) and the k-means step reads one lane at a time, so the   #
+#          columns of "data" may be memory mapped arrays which do not fit in  #
+#          memory.                                                            #
+#                                                                             #
 # Params: IN     data - A data object of type "data" defined in               #
 #                       classes/data.py which contains the cleaned dataset.   #
 #         IN/OUT PLG  - A PLG object of type "PLG" defined in classes/PLG.py. #
 #                       The PLG.nodes parameter will be updated with the 2D   #
 #                       numpy array of nodes generated by this function.      #
+#         IN     num_workers - Number of worker processes for the k-means     #
+#                              step. Defaults to NUM_WORKERS in inputs.py, 1  #
+#                              always runs serially.                          #
 #                                                                             # 
 ###############################################################################
-def node_generation(PLG, data):
+def node_generation(PLG, data, num_workers=None):
     # Initialisations
-    data_x = np.array(data.x)
-    data_y = np.array(data.y)
-    data_lid = np.array(data.lane_id)
-    node_set = np.array([[data_x[0], data_y[0]]])
-    node_set_lane_ids = [data.lane_id[0]]
     max_kmeans_iterations = 100
     # Note that since the kmeans step is tailored to the lankershim dataset,
     # this parameter is hard-coded here and is specific to the lankershim
     # data.
     lids_to_ignore_for_kmeans = [0, 101]
-    
+
     # First we will generate an initial set of nodes using the vehicle paths
-    # and the pre-defined minimum node distance.
+    # and the pre-defined minimum node distance, starting from the first data
+    # point.
     # Note that in the definiton of our algorithm, we state that we will cycle
     # through the original dataset in chunks of "vehicle path". I.e. extract
     # the data for vehicle ID 1, cycle through this data, then vehicle ID 2
     # and so on. Since the "clean_data" data structure has already been sorted
     # into this format there is no need to think about that here, we can
     # proceed straight to cycling through the entire dataset.
-    for ii in range(data.num_data_points):
-        # Get the x and y coordinates for this data point
-        x_ii = data_x[ii]
-        y_ii = data_y[ii]
-        d_ii = np.array([x_ii, y_ii])
-    
-        # Calculate the euclidean distance between this data point and every
-        # ther node currently in the graph
-        distance_to_nodes = norm(node_set - d_ii, ord=2, axis=1)
-        nodes_within_min_distance = distance_to_nodes[distance_to_nodes < MIN_DIST_BETWEEN_NODES]
-    
-        # Check that this data point is atleast greater than our minimum
-        # treshold away from every other node currently in the graph
-        if len(nodes_within_min_distance) == 0:
-            # This data point is sufficiently far from every node currently in
-            # the PLG so append it to the node set
-            node_set = np.vstack((node_set, [x_ii, y_ii]))
-            node_set_lane_ids.append(int(data.lane_id[ii]))
+    first_node = np.array([[float(data.x[0]), float(data.y[0])]])
+    node_set, node_set_lane_ids = add_nodes(first_node, [int(data.lane_id[0])], g.iter_chunks(data.x, data.y, data.lane_id, chunk_size=STREAMING_CHUNK_SIZE))
 
     # Now we perform k-means clustering to even out the distribution of nodes
-    # along the lanes. First convert the node_set_lane_ids to a numpy array
-    # for the np.argwhere function to work.
+    # along the lanes. The nodes are grouped by lane ID and the original data
+    # points of each lane are read through the lane sese matrix only when the
+    # lane is fitted, so the lanes, which are independent of each other, are
+    # fitted in parallel without every lane being held in memory at once.
     if (DO_KMEANS) and (DATASET == "lankershim"):
-        node_set_lane_ids = np.array(node_set_lane_ids)
-    
-        # Get the unique lane IDs
-        unique_lane_ids = np.unique(node_set_lane_ids)
-    
-        # Cycle through each lane ID and perform k-means clustering on the nodes
-        # corresponding to that lane ID
-        for lane_id in unique_lane_ids:
-            if lane_id not in lids_to_ignore_for_kmeans:
-                # Get nodes and original data points corresponding to this lane ID
-                node_lid_idx = np.argwhere(node_set_lane_ids == lane_id)[:,0]
-                data_lid_idx = np.argwhere(data_lid == lane_id)[:,0]
-
-                # Get x and y coordinates for the nodes and original data points with
-                # this lane ID
-                node_lid_coords = node_set[node_lid_idx,:]
-                data_lid_coords = np.array([data_x[data_lid_idx], data_y[data_lid_idx]]).T
-
-                # Perform k-means clustering on the nodes and original data points with
-                num_nodes_lid = len(node_lid_coords[:,0])
-                kmeans_lid = KMeans(n_clusters=num_nodes_lid, max_iter=max_kmeans_iterations, init=node_lid_coords, n_init=1).fit(data_lid_coords)
-
-                # Update the node set with the k-means cluster centres
-                node_set[node_lid_idx,:] = kmeans_lid.cluster_centers_
+        node_groups = group_indices_by_lane(node_set_lane_ids)
+        lane_index = g.SEIndex(data.lane_sese)
+        kmeans_lane_ids = [lane_id for lane_id in node_groups if lane_id not in lids_to_ignore_for_kmeans]
+
+        # Get the nodes and original data points corresponding to each lane ID
+        node_lid_coords = [node_set[node_groups[lane_id],:] for lane_id in kmeans_lane_ids]
+        data_lid_coords = (np.array([lane_index.extract(lane_id, data.x), lane_index.extract(lane_id, data.y)]).T for lane_id in kmeans_lane_ids)
+        max_iterations = [max_kmeans_iterations]*len(kmeans_lane_ids)
+
+        # Perform k-means clustering on the nodes and original data points of
+        # each lane
+        with instrumentation.stage("kmeans") as record:
+            record.count("lanes", len(kmeans_lane_ids))
+            segment_lengths = lane_index.segment_ends + g.ONE - lane_index.segment_starts
+            record.count("data_points", np.sum(segment_lengths[np.isin(lane_index.segment_ids, kmeans_lane_ids)]))
+            cluster_centres = list(parallel.map_lazily(fit_lane_kmeans, node_lid_coords, data_lid_coords, max_iterations, num_workers=num_workers))
+
+        # Update the node set with the k-means cluster centres
+        for lane_id, lane_cluster_centres in zip(kmeans_lane_ids, cluster_centres):
+            node_set[node_groups[lane_id],:] = lane_cluster_centres
     
     # Set the data into the PLG data structure
     PLG.nodes = node_set
@@ -99,3 +94,114 @@ def node_generation(PLG, data):
 
     return True
 
+
+###############################################################################
+# add_nodes:                                                                  #
+#                                                                             #
+# Purpose: Add every data point which is at least MIN_DIST_BETWEEN_NODES away #
+#          from all of the nodes in the node set (including the ones added    #
+#          before it) to the node set, in the order of the data. This is the  #
+#          first step of node_generation and is also used to add the nodes of #
+#          newly recorded data to an existing PLG (see plg_update.py).        #
+#                                                                             #
+#          The node set is stored in a preallocated buffer which doubles in   #
+#          size whenever it fills up. The grid maps a (cell x, cell y) key to #
+#          the list of [x, y] coordinates of the nodes which lie in that cell #
+#          so only the nodes in the data point's cell and its eight           #
+#          neighbours are checked.                                            #
+#                                                                             #
+# Params: IN   nodes             - 2D numpy array of the [x, y] coordinates   #
+#                                  of the nodes so far.                       #
+#         IN   node_lane_ids     - The lane ID of each node so far.           #
+#         IN   data_chunks       - Iterable of (chunk start, x, y, lane ID)   #
+#                                  chunks of the data, see g.iter_chunks.     #
+#         OUT node_set           - 2D numpy array of the [x, y] coordinates   #
+#                                  of the nodes, the nodes so far first.      #
+#         OUT node_set_lane_ids  - 1D numpy array, the lane ID of each node.  #
+#                                                                             #
+###############################################################################
+def add_nodes(nodes, node_lane_ids, data_chunks):
+    num_nodes = len(nodes)
+    node_buffer = np.zeros((max(1024, 2*num_nodes), 2))
+    node_buffer[:num_nodes,:] = nodes
+    node_set_lane_ids = np.asarray(node_lane_ids).tolist()
+    node_grid = {}
+    for (x_node, y_node) in node_buffer[:num_nodes,:].tolist():
+        node_grid.setdefault((math.floor(x_node / MIN_DIST_BETWEEN_NODES), math.floor(y_node / MIN_DIST_BETWEEN_NODES)), []).append((x_node, y_node))
+    neighbouring_cells = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+    for (_, chunk_x, chunk_y, chunk_lid) in data_chunks:
+        for (x_ii, y_ii, lid_ii) in zip(chunk_x.tolist(), chunk_y.tolist(), chunk_lid.tolist()):
+            # Get the grid cell for this data point
+            cell_x = math.floor(x_ii / MIN_DIST_BETWEEN_NODES)
+            cell_y = math.floor(y_ii / MIN_DIST_BETWEEN_NODES)
+
+            # Calculate the euclidean distance between this data point and
+            # every node in the neighbouring cells. Check that this data point
+            # is atleast greater than our minimum treshold away from all of
+            # them.
+            is_far_from_nodes = True
+            for (dx, dy) in neighbouring_cells:
+                for (x_node, y_node) in node_grid.get((cell_x + dx, cell_y + dy), ()):
+                    if math.sqrt((x_node - x_ii)*(x_node - x_ii) + (y_node - y_ii)*(y_node - y_ii)) < MIN_DIST_BETWEEN_NODES:
+                        is_far_from_nodes = False
+                        break
+                if not is_far_from_nodes:
+                    break
+
+            if is_far_from_nodes:
+                # This data point is sufficiently far from every node currently
+                # in the PLG so append it to the node set
+                if num_nodes == len(node_buffer):
+                    node_buffer = np.vstack((node_buffer, np.zeros_like(node_buffer)))
+                node_buffer[num_nodes,:] = [x_ii, y_ii]
+                num_nodes += 1
+                node_grid.setdefault((cell_x, cell_y), []).append((x_ii, y_ii))
+                node_set_lane_ids.append(lid_ii)
+
+    return node_buffer[:num_nodes,:].copy(), np.array(node_set_lane_ids)
+
+
+###############################################################################
+# group_indices_by_lane:                                                      #
+#                                                                             #
+# Purpose: Group the indices of an array of lane IDs by lane ID using a       #
+#          single stable argsort, so that the indices of each lane are in     #
+#          ascending order.                                                   #
+#                                                                             #
+# Params: IN   lane_ids - 1D numpy array of lane IDs.                         #
+#         OUT  groups   - Dictionary of {lane ID : numpy array of indices}.   #
+#                                                                             #
+###############################################################################
+def group_indices_by_lane(lane_ids):
+    sort_idx = np.argsort(lane_ids, kind="stable")
+    unique_lane_ids, group_starts = np.unique(lane_ids[sort_idx], return_index=True)
+    return dict(zip(unique_lane_ids.tolist(), np.split(sort_idx, group_starts[1:])))
+
+
+###############################################################################
+# fit_lane_kmeans:                                                            #
+#                                                                             #
+# Purpose: Fit k-means to the original data points of a single lane, starting #
+#          from the nodes of that lane. Lanes with more than                  #
+#          KMEANS_MINIBATCH_THRESHOLD data points use mini-batch k-means.     #
+#          This function is run by the worker processes so it must stay at   #
+#          module level.                                                      #
+#                                                                             #
+# Params: IN   node_lid_coords - 2D numpy array of the [x, y] coordinates of  #
+#                                the nodes in the lane.                       #
+#         IN   data_lid_coords - 2D numpy array of the [x, y] coordinates of  #
+#                                the data points in the lane.                 #
+#         IN   max_iterations  - Maximum number of k-means iterations.        #
+#         OUT  cluster_centres - 2D numpy array of the cluster centres, one   #
+#                                row per node.                                #
+#                                                                             #
+###############################################################################
+def fit_lane_kmeans(node_lid_coords, data_lid_coords, max_iterations):
+    num_nodes_lid = len(node_lid_coords[:,0])
+    if (KMEANS_MINIBATCH_THRESHOLD is not None) and (len(data_lid_coords[:,0]) > KMEANS_MINIBATCH_THRESHOLD):
+        kmeans_lid = MiniBatchKMeans(n_clusters=num_nodes_lid, max_iter=max_iterations, init=node_lid_coords, n_init=1, random_state=KMEANS_SEED)
+    else:
+        kmeans_lid = KMeans(n_clusters=num_nodes_lid, max_iter=max_iterations, init=node_lid_coords, n_init=1, random_state=KMEANS_SEED)
+
+    return kmeans_lid.fit(data_lid_coords).cluster_centers_
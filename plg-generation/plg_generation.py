@@ -7,7 +7,10 @@ sys.path.append(os.getcwd())
 
 import functions.general as g
 import functions.date_time as date_time
+import functions.stage_cache as stage_cache
+import functions.instrumentation as instrumentation
 import classes.PLG as plg
+import classes.data as d
 import time
 from inputs import *
 
@@ -17,50 +20,114 @@ from get_discrete_vehicle_paths import get_discrete_vehicle_paths
 from adj_mat_generation import adj_mat_generation
 from cluster_generation import cluster_generation
 from travel_dict_generation import travel_dict_generation
+from next_node_table_generation import next_node_table_generation
+from tiled_generation import tiled_node_generation, tiled_discrete_vehicle_paths
 
 
 DATA_LOC = "data/"+DATASET+"/cleaned/"
 PLG_SAVE_LOC = "data/"+DATASET+"/data-structures/"
+REPORT_LOC = "data/"+DATASET+"/reports/"
 
 PLG_SAVE_NAME = "PLG"
+CACHE_NAME = "cache"
 DATA_SAVE_NAME = "clean_data_v2"
 
 
 def main():
+    # Record the time and memory used by each stage of the run
+    with instrumentation.for_script("plg_generation", REPORT_LOC):
+        generate_plg()
+
+
+def generate_plg():
     # Time the script
     t_start = time.time()
     print(date_time.get_current_time(), "Program started")
 
-    # Load the cleaned data
-    data = g.load_pickled_data(DATA_LOC+DATA_SAVE_NAME)
+    # Load the cleaned data, including any data added by plg_update.py
+    with instrumentation.stage("load_data") as record:
+        data = d.load_cleaned_data_with_updates(DATA_LOC+DATA_SAVE_NAME)
+        record.count("data_points", data.num_data_points)
+        record.count("vehicles", len(data.vehicle_sese))
     print(date_time.get_current_time(), "Loaded clean data")
 
-    # Create a PLG object
+    # Create a PLG object in the frame of the cleaned data
     PLG = plg.PLG()
+    PLG.origin = getattr(data, "origin", None)
+
+    # Each stage is only rerun if its inputs or parameters have changed since
+    # it was last run, otherwise its outputs are restored from the cache. The
+    # key of the cleaned data is a hash of the columns the stages read.
+    cache = stage_cache.StageCache(PLG_SAVE_LOC+CACHE_NAME, force=FORCE_REBUILD, enabled=USE_STAGE_CACHE)
+    data_key = stage_cache.hash_arrays(data.x, data.y, data.lane_id, data.vehicle_sese)
+
+    # For large maps the nodes are generated and the paths are discretised tile
+    # by tile, see tiled_generation.py
+    if TILE_SIZE is None:
+        node_stage, path_stage, tile_params = node_generation, get_discrete_vehicle_paths, {}
+    else:
+        node_stage, path_stage, tile_params = tiled_node_generation, tiled_discrete_vehicle_paths, {"TILE_SIZE": TILE_SIZE, "TILE_OVERLAP": TILE_OVERLAP}
 
     # Generate node set
-    rc = node_generation(PLG, data)
-    print(date_time.get_current_time(), "Generated nodes")
+    with instrumentation.stage("node_generation") as record:
+        node_key, is_cached = cache.run_stage(node_stage, (PLG, data), [data_key],
+                                              {"DATASET": DATASET, "MIN_DIST_BETWEEN_NODES": MIN_DIST_BETWEEN_NODES, "DO_KMEANS": DO_KMEANS, "KMEANS_MINIBATCH_THRESHOLD": KMEANS_MINIBATCH_THRESHOLD, "KMEANS_SEED": KMEANS_SEED, **tile_params},
+                                              {"PLG": (PLG, ["nodes", "node_lane_ids", "num_nodes"])})
+        record.set("cached", is_cached)
+        record.count("data_points", data.num_data_points)
+        record.count("nodes", PLG.num_nodes)
+    print(date_time.get_current_time(), "Generated nodes"+(" (cached)" if is_cached else ""))
 
     # Generate discrete vehicle paths
-    rc = get_discrete_vehicle_paths(data=data, PLG=PLG)
-    print(date_time.get_current_time(), "Discretised vehicle paths")
+    with instrumentation.stage("get_discrete_vehicle_paths") as record:
+        path_key, is_cached = cache.run_stage(path_stage, (data, PLG), [data_key, node_key], tile_params,
+                                              {"PLG": (PLG, ["vehicle_paths"]), "data": (data, ["node"])})
+        record.set("cached", is_cached)
+        record.count("data_points", data.num_data_points)
+        record.count("vehicles", len(PLG.vehicle_paths))
+    print(date_time.get_current_time(), "Discretised vehicle paths"+(" (cached)" if is_cached else ""))
 
     # Create the adjacency matrix
-    rc = adj_mat_generation(PLG)
-    print(date_time.get_current_time(), "Adjacency matrix generated")
+    with instrumentation.stage("adj_mat_generation") as record:
+        adjmat_key, is_cached = cache.run_stage(adj_mat_generation, (PLG,), [node_key, path_key], {},
+                                                {"PLG": (PLG, ["adjmat", "adjmat_counts"])})
+        record.set("cached", is_cached)
+        record.count("vehicles", len(PLG.vehicle_paths))
+        record.count("edges", PLG.adjmat.nnz)
+    print(date_time.get_current_time(), "Adjacency matrix generated"+(" (cached)" if is_cached else ""))
 
     # Get the start and target node clusters
-    rc = cluster_generation(PLG)
-    print(date_time.get_current_time(), "Start/target node clusters generated")
+    with instrumentation.stage("cluster_generation") as record:
+        cluster_key, is_cached = cache.run_stage(cluster_generation, (PLG,), [node_key, path_key],
+                                                 {"NUM_START_CLUSTERS": NUM_START_CLUSTERS, "NUM_TARGET_CLUSTERS": NUM_TARGET_CLUSTERS, "KMEANS_SEED": KMEANS_SEED},
+                                                 {"PLG": (PLG, ["start_cluster_centres", "target_cluster_centres", "start_clusters", "target_clusters", "closest_clusters_dict",
+                                                                "node_start_cluster", "node_target_cluster", "start_cluster_mask", "target_cluster_mask"])})
+        record.set("cached", is_cached)
+        record.count("vehicles", len(PLG.vehicle_paths))
+    print(date_time.get_current_time(), "Start/target node clusters generated"+(" (cached)" if is_cached else ""))
 
     # Generate the travel dictionary
-    rc = travel_dict_generation(PLG)
-    print(date_time.get_current_time(), "Travel dictionary generated")
+    with instrumentation.stage("travel_dict_generation") as record:
+        travel_dict_key, is_cached = cache.run_stage(travel_dict_generation, (PLG,), [node_key, path_key, cluster_key], {},
+                                                     {"PLG": (PLG, ["p_next_node_given_target", "transition_counts_given_target"])})
+        record.set("cached", is_cached)
+        record.count("vehicles", len(PLG.vehicle_paths))
+        record.count("edges", sum(mat.nnz for mat in PLG.p_next_node_given_target.values()))
+    print(date_time.get_current_time(), "Travel dictionary generated"+(" (cached)" if is_cached else ""))
+
+    # Precompute the next node table used for path generation
+    with instrumentation.stage("next_node_table_generation") as record:
+        _, is_cached = cache.run_stage(next_node_table_generation, (PLG,), [node_key, cluster_key, travel_dict_key], {},
+                                       {"PLG": (PLG, ["next_node_given_target"])})
+        record.set("cached", is_cached)
+        record.count("table_entries", PLG.next_node_given_target.size)
+    print(date_time.get_current_time(), "Next node table generated"+(" (cached)" if is_cached else ""))
 
     # Save and print time taken
-    g.save_pickled_data(PLG_SAVE_LOC+PLG_SAVE_NAME, PLG)
-    g.save_pickled_data(DATA_LOC+DATA_SAVE_NAME, data)
+    with instrumentation.stage("save"):
+        plg.save_plg(PLG, PLG_SAVE_LOC+PLG_SAVE_NAME)
+        d.save_cleaned_data(data, DATA_LOC+DATA_SAVE_NAME)
+        d.remove_cleaned_data_updates(DATA_LOC+DATA_SAVE_NAME)
     print(date_time.get_current_time(), "Saved PLG and updated clean_data with node inforamtion")
     print(f"PLG generation time taken = {round(time.time() - t_start, 3)} s")
 
@@ -0,0 +1,367 @@
+import sys
+import os
+
+# On my machine I need this line otherwise I get a "ModuleNotFoundError" when
+# trying to import the other modules I have written within this directory.
+sys.path.append(os.getcwd())
+
+import argparse
+import time
+import numpy as np
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor
+import functions.general as g
+import functions.graph as graph
+import functions.parallel as parallel
+import functions.date_time as date_time
+import functions.instrumentation as instrumentation
+import classes.PLG as plg
+import classes.data as d
+from inputs import *
+
+# Import functions for PLG generation
+from node_generation import node_generation
+from get_discrete_vehicle_paths import get_discrete_vehicle_paths
+from adj_mat_generation import adj_mat_generation, remove_long_edges
+from cluster_generation import cluster_generation
+from travel_dict_generation import travel_dict_generation
+from next_node_table_generation import next_node_table_generation
+
+
+DATA_LOC = "data/"+DATASET+"/cleaned/"
+PLG_SAVE_LOC = "data/"+DATASET+"/data-structures/"
+REPORT_LOC = "data/"+DATASET+"/reports/"
+
+PLG_SAVE_NAME = "PLG"
+DATA_SAVE_NAME = "clean_data_v2"
+
+
+###############################################################################
+# merge_plgs:                                                                 #
+#                                                                             #
+# Purpose: Merge PLGs which were built from different shards of data, e.g.    #
+#          one per recording day or one per machine, into a single PLG. The   #
+#          PLGs are merged into the first one, one after another:             #
+#                                                                             #
+#          0. The other PLG is shifted into the frame of the first PLG, using #
+#             the origin each PLG's data was loaded with (see PLG.origin).    #
+#          1. The node sets are aligned. A node of the other PLG which is     #
+#             closer than max_dist to a node of the merged PLG (this includes #
+#             shared nodes) is mapped to that node, any other node is added   #
+#             as a new node.                                                  #
+#          2. The start and target clusters are aligned by mapping each       #
+#             cluster of the other PLG to the merged PLG's cluster with the   #
+#             closest centre. Nodes keep the cluster they already have in the #
+#             merged PLG.                                                     #
+#          3. The vehicle paths are mapped onto the merged nodes and only the #
+#             first instance of each node in a path is kept, as in            #
+#             get_discrete_vehicle_paths. Vehicle IDs which are already taken #
+#             are shifted.                                                    #
+#          4. The transition counts (PLG.adjmat_counts and                    #
+#             PLG.transition_counts_given_target) of the mapped paths are     #
+#             counted and added to the merged counts. Each path is counted    #
+#             under the merged target cluster of its last node, so the counts #
+#             always agree with PLG.vehicle_paths and                         #
+#             PLG.node_target_cluster. Edges longer than MAX_EDGE_LEN are     #
+#             dropped from the adjacency matrix counts.                       #
+#                                                                             #
+#          The probabilities and the next node table are then computed from   #
+#          the summed counts. Merging the PLG of a dataset with itself gives  #
+#          the same probabilities with twice the counts.                      #
+#                                                                             #
+#          Either every PLG has an origin or none of them has, in which case  #
+#          the PLGs must already be in the same frame, e.g. the shards of     #
+#          map_reduce_plg_generation. A ValueError is raised otherwise.       #
+#                                                                             #
+# Params: IN  PLGs     - List of PLG objects of type "PLG" defined in         #
+#                        classes/PLG.py, with transition counts (see          #
+#                        adj_mat_generation and travel_dict_generation).      #
+#         IN  max_dist - Nodes closer than this are merged. Defaults to       #
+#                        MIN_DIST_BETWEEN_NODES.                              #
+#         OUT merged   - The merged PLG.                                      #
+#                                                                             #
+###############################################################################
+def merge_plgs(PLGs, max_dist=None):
+    if max_dist is None:
+        max_dist = MIN_DIST_BETWEEN_NODES
+    for PLG in PLGs:
+        if (getattr(PLG, "adjmat_counts", None) is None) or (getattr(PLG, "transition_counts_given_target", None) is None):
+            raise ValueError("Every PLG must have transition counts, regenerate it with plg_generation.py before merging it")
+    frame_shifts = get_frame_shifts(PLGs)
+
+    # Start from a copy of the first PLG
+    first = PLGs[0]
+    merged = plg.PLG()
+    merged.origin = None if getattr(first, "origin", None) is None else np.array(first.origin)
+    merged.nodes = np.array(first.nodes)
+    merged.node_lane_ids = np.array(first.node_lane_ids)
+    merged.num_nodes = len(merged.nodes)
+    merged.vehicle_paths = {vehicle_id: list(path) for vehicle_id, path in first.vehicle_paths.items()}
+    merged.start_cluster_centres = np.array(first.start_cluster_centres)
+    merged.target_cluster_centres = np.array(first.target_cluster_centres)
+    merged.closest_clusters_dict = dict(first.closest_clusters_dict)
+    node_start_cluster = np.array(first.node_start_cluster)
+    node_target_cluster = np.array(first.node_target_cluster)
+    adjmat_counts = sp.csr_matrix(first.adjmat_counts, copy=True)
+    transition_counts_given_target = {ii: sp.csr_matrix(counts, copy=True) for ii, counts in first.transition_counts_given_target.items()}
+
+    for other, frame_shift in zip(PLGs[1:], frame_shifts[1:]):
+        # Shift the other PLG into the frame of the merged PLG and align the
+        # node sets
+        other_nodes = np.asarray(other.nodes) + frame_shift
+        node_map, is_new_node = align_nodes(merged.nodes, other_nodes, max_dist)
+        merged.nodes = np.vstack((merged.nodes, other_nodes[is_new_node]))
+        merged.node_lane_ids = np.concatenate((merged.node_lane_ids, np.asarray(other.node_lane_ids)[is_new_node]))
+        merged.num_nodes = len(merged.nodes)
+        num_nodes_shape = (merged.num_nodes, merged.num_nodes)
+
+        # Align the clusters
+        start_cluster_map = graph.get_closest_nodes(merged.start_cluster_centres, np.asarray(other.start_cluster_centres) + frame_shift)
+        target_cluster_map = graph.get_closest_nodes(merged.target_cluster_centres, np.asarray(other.target_cluster_centres) + frame_shift)
+        node_start_cluster = merge_node_clusters(node_start_cluster, merged.num_nodes, other.node_start_cluster, node_map, start_cluster_map)
+        node_target_cluster = merge_node_clusters(node_target_cluster, merged.num_nodes, other.node_target_cluster, node_map, target_cluster_map)
+
+        # Map the vehicle paths onto the merged nodes
+        vehicle_id_offset = max(merged.vehicle_paths) + 1 if (len(merged.vehicle_paths) > 0) and any(vehicle_id in merged.vehicle_paths for vehicle_id in other.vehicle_paths) else 0
+        other_paths = {vehicle_id + vehicle_id_offset: remove_repeated_nodes(node_map[np.asarray(path, dtype=np.int64)]) for vehicle_id, path in other.vehicle_paths.items()}
+        merged.vehicle_paths.update(other_paths)
+
+        # Count the transitions of the mapped paths and add them to the counts.
+        # The other PLG's counts can't simply be mapped onto the merged nodes
+        # and clusters: nodes which were already clustered keep their merged
+        # cluster, so a path may end in a different target cluster than it
+        # did in the other PLG.
+        current_nodes, next_nodes = graph.get_path_edges(other_paths)
+        current_nodes, next_nodes = remove_long_edges(merged.nodes, current_nodes, next_nodes)
+        adjmat_counts = g.pad_sparse_matrix(adjmat_counts, num_nodes_shape) + graph.get_transition_counts(current_nodes, next_nodes, merged.num_nodes)
+        other_transition_counts_given_target = graph.get_transition_counts_given_target(other_paths, node_target_cluster, len(merged.target_cluster_centres), merged.num_nodes)
+        transition_counts_given_target = {ii: g.pad_sparse_matrix(counts, num_nodes_shape) + other_transition_counts_given_target[ii] for ii, counts in transition_counts_given_target.items()}
+
+    # Compute the clusters, probabilities and next node table from the merged
+    # counts
+    merged.start_clusters = {ii: np.flatnonzero(node_start_cluster == ii).tolist() for ii in range(len(merged.start_cluster_centres))}
+    merged.target_clusters = {ii: np.flatnonzero(node_target_cluster == ii).tolist() for ii in range(len(merged.target_cluster_centres))}
+    merged.node_start_cluster, merged.start_cluster_mask = graph.get_cluster_membership(merged.start_clusters, len(merged.start_cluster_centres), merged.num_nodes)
+    merged.node_target_cluster, merged.target_cluster_mask = graph.get_cluster_membership(merged.target_clusters, len(merged.target_cluster_centres), merged.num_nodes)
+    merged.adjmat_counts = adjmat_counts
+    merged.adjmat = g.normalise_matrix_rows(adjmat_counts)
+    merged.transition_counts_given_target = transition_counts_given_target
+    merged.p_next_node_given_target = {ii: g.normalise_matrix_rows(counts) for ii, counts in transition_counts_given_target.items()}
+    next_node_table_generation(merged)
+
+    return merged
+
+
+###############################################################################
+# get_frame_shifts:                                                           #
+#                                                                             #
+# Purpose: Find the shift which moves the positions of each PLG into the      #
+#          frame of the first PLG. A position p in the frame of a PLG is the  #
+#          raw position p + PLG.origin, i.e., p + PLG.origin - first.origin   #
+#          in the frame of the first PLG.                                     #
+#                                                                             #
+# Params: IN  PLGs         - List of PLG objects.                             #
+#         OUT frame_shifts - 2D numpy array, the [x, y] shift of each PLG.    #
+#                            All zeros if none of the PLGs has an origin.     #
+#                                                                             #
+###############################################################################
+def get_frame_shifts(PLGs):
+    has_origin = [getattr(PLG, "origin", None) is not None for PLG in PLGs]
+    if not any(has_origin):
+        return np.zeros((len(PLGs), 2))
+    if not all(has_origin):
+        raise ValueError("Only some of the PLGs have an origin so they can't be put in the same frame, rerun data_cleaner.py and plg_generation.py for the PLGs without one")
+    origins = np.array([np.asarray(PLG.origin, dtype=float) for PLG in PLGs])
+    return origins - origins[0]
+
+
+###############################################################################
+# align_nodes:                                                                #
+#                                                                             #
+# Purpose: Map the nodes of another PLG onto a node set. Nodes closer than    #
+#          max_dist to a node in the node set are mapped to it, the others    #
+#          are numbered after the last node of the node set in their order.   #
+#                                                                             #
+# Params: IN  nodes       - 2D numpy array of the [x, y] coordinates of the   #
+#                           node set.                                         #
+#         IN  other_nodes - 2D numpy array of the [x, y] coordinates of the   #
+#                           other PLG's nodes.                                #
+#         IN  max_dist    - Distance under which two nodes are merged.        #
+#         OUT node_map    - 1D numpy array, the merged node of each of the    #
+#                           other nodes.                                      #
+#         OUT is_new_node - 1D boolean numpy array, True if the other node is #
+#                           added as a new node.                              #
+#                                                                             #
+###############################################################################
+def align_nodes(nodes, other_nodes, max_dist):
+    closest_nodes = graph.get_closest_nodes(nodes, other_nodes)
+    distance = np.hypot(other_nodes[:,0] - nodes[closest_nodes,0], other_nodes[:,1] - nodes[closest_nodes,1])
+    is_new_node = distance >= max_dist
+    node_map = closest_nodes.astype(np.int64)
+    node_map[is_new_node] = len(nodes) + np.arange(np.sum(is_new_node))
+    return node_map, is_new_node
+
+
+###############################################################################
+# merge_node_clusters:                                                        #
+#                                                                             #
+# Purpose: Add the cluster assignments of another PLG's nodes to the cluster  #
+#          of each merged node. Nodes which already have a cluster keep it.   #
+#                                                                             #
+# Params: IN  node_cluster       - The cluster of each merged node so far, -1 #
+#                                  if the node is not in a cluster.           #
+#         IN  num_nodes          - The number of merged nodes.                #
+#         IN  other_node_cluster - The cluster of each of the other nodes.    #
+#         IN  node_map           - See align_nodes.                           #
+#         IN  cluster_map        - The merged cluster of each other cluster.  #
+#         OUT node_cluster       - The cluster of each merged node.           #
+#                                                                             #
+###############################################################################
+def merge_node_clusters(node_cluster, num_nodes, other_node_cluster, node_map, cluster_map):
+    node_cluster = np.concatenate((node_cluster, np.full(num_nodes - len(node_cluster), -1, dtype=node_cluster.dtype)))
+    other_node_cluster = np.asarray(other_node_cluster)
+    is_clustered = other_node_cluster >= 0
+    merged_nodes = node_map[is_clustered]
+    is_unassigned = node_cluster[merged_nodes] < 0
+    node_cluster[merged_nodes[is_unassigned]] = cluster_map[other_node_cluster[is_clustered][is_unassigned]]
+    return node_cluster
+
+
+###############################################################################
+# remove_repeated_nodes:                                                      #
+#                                                                             #
+# Purpose: Keep only the first instance of each node in a path, e.g. when     #
+#          two nodes of a path were mapped onto the same merged node. This is #
+#          the same rule get_discrete_vehicle_paths uses to build the paths.  #
+###############################################################################
+def remove_repeated_nodes(path):
+    return list(dict.fromkeys(np.asarray(path, dtype=np.int64).tolist()))
+
+
+###############################################################################
+# generate_shard_plg:                                                         #
+#                                                                             #
+# Purpose: The "map" step of map_reduce_plg_generation. Run the PLG           #
+#          generation stages which produce the transition counts on one       #
+#          shard of the cleaned data. This is run by the worker processes so  #
+#          it must stay at module level.                                      #
+###############################################################################
+def generate_shard_plg(data):
+    PLG = plg.PLG()
+    PLG.origin = getattr(data, "origin", None)
+    node_generation(PLG, data, num_workers=1)
+    get_discrete_vehicle_paths(data, PLG, num_workers=1)
+    adj_mat_generation(PLG)
+    cluster_generation(PLG)
+    travel_dict_generation(PLG)
+    return PLG
+
+
+###############################################################################
+# split_data:                                                                 #
+#                                                                             #
+# Purpose: Split a cleaned dataset into num_shards datasets with whole        #
+#          vehicle paths and roughly the same number of data points each.     #
+#          The vehicle IDs are kept so the vehicle paths of the shards don't  #
+#          overlap.                                                           #
+###############################################################################
+def split_data(data, num_shards):
+    vehicle_index = g.SEIndex(data.vehicle_sese)
+    path_lengths = vehicle_index.segment_ends + g.ONE - vehicle_index.segment_starts
+    shards = []
+    for (first_path, last_path) in parallel.get_shards(path_lengths, num_workers=num_shards, min_points_per_shard=1):
+        shard_lengths = path_lengths[first_path:last_path]
+        shard_offsets = np.concatenate(([0], np.cumsum(shard_lengths)))
+        data_index = np.arange(shard_offsets[-1]) + np.repeat(vehicle_index.segment_starts[first_path:last_path] - shard_offsets[:-1], shard_lengths)
+
+        shard = d.data()
+        shard.x = np.asarray(data.x)[data_index]
+        shard.y = np.asarray(data.y)[data_index]
+        shard.lane_id = np.asarray(data.lane_id)[data_index]
+        shard.vehicle_id = np.asarray(data.vehicle_id)[data_index]
+        shard.vehicle_sese = g.get_se_matrix(shard.vehicle_id)
+        shard.lane_sese = g.get_se_matrix(shard.lane_id)
+        shard.num_data_points = len(shard.x)
+        shard.origin = getattr(data, "origin", None)
+        shards.append(shard)
+
+    return shards
+
+
+###############################################################################
+# map_reduce_plg_generation:                                                  #
+#                                                                             #
+# Purpose: Generate a PLG by splitting the cleaned data into shards, building #
+#          a PLG on each shard in a process pool (map) and merging them with  #
+#          merge_plgs (reduce). Unlike plg_generation.py this does not set    #
+#          data.node.                                                         #
+#                                                                             #
+# Params: IN  data        - The cleaned dataset.                              #
+#         IN  num_shards  - The number of shards to build.                    #
+#         IN  num_workers - Number of worker processes. Defaults to           #
+#                           NUM_WORKERS in inputs.py, 1 always runs serially. #
+#         OUT PLG         - The merged PLG.                                   #
+#                                                                             #
+###############################################################################
+def map_reduce_plg_generation(data, num_shards, num_workers=None):
+    shards = split_data(data, num_shards)
+    num_workers = min(parallel.get_num_workers(num_workers), len(shards))
+
+    with instrumentation.stage("map") as record:
+        record.count("shards", len(shards))
+        record.count("data_points", sum(shard.num_data_points for shard in shards))
+        if num_workers == 1:
+            shard_PLGs = [generate_shard_plg(shard) for shard in shards]
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                shard_PLGs = list(executor.map(generate_shard_plg, shards))
+
+    with instrumentation.stage("reduce") as record:
+        PLG = merge_plgs(shard_PLGs)
+        record.count("nodes", PLG.num_nodes)
+
+    return PLG
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge PLGs built on separate shards of data, or build the PLG of DATASET by map-reduce.")
+    parser.add_argument("plg_dirs", nargs="*", help="saved PLGs to merge, in the order they are merged")
+    parser.add_argument("--output", help="where to save the merged PLG, defaults to the PLG of DATASET")
+    parser.add_argument("--map-reduce", type=int, metavar="NUM_SHARDS", help="instead of merging saved PLGs, split the cleaned data of DATASET into NUM_SHARDS shards, build a PLG on each in parallel and merge them")
+    args = parser.parse_args()
+    if (len(args.plg_dirs) == 0) == (args.map_reduce is None):
+        parser.error("give either the PLGs to merge or --map-reduce")
+
+    # Record the time and memory used by each stage of the run
+    with instrumentation.for_script("plg_merge", REPORT_LOC):
+        run_plg_merge(args.plg_dirs, args.output or PLG_SAVE_LOC+PLG_SAVE_NAME, args.map_reduce)
+
+
+def run_plg_merge(plg_dirs, output, num_shards):
+    # Time the script
+    t_start = time.time()
+    print(date_time.get_current_time(), "Program started")
+
+    if num_shards is None:
+        with instrumentation.stage("load"):
+            PLGs = [plg.load_plg(plg_dir) for plg_dir in plg_dirs]
+        print(date_time.get_current_time(), f"Loaded {len(PLGs)} PLGs")
+        with instrumentation.stage("merge") as record:
+            PLG = merge_plgs(PLGs)
+            record.count("nodes", PLG.num_nodes)
+    else:
+        with instrumentation.stage("load_data") as record:
+            data = d.load_cleaned_data_with_updates(DATA_LOC+DATA_SAVE_NAME)
+            record.count("data_points", data.num_data_points)
+        print(date_time.get_current_time(), "Loaded clean data")
+        PLG = map_reduce_plg_generation(data, num_shards)
+    print(date_time.get_current_time(), f"Merged PLG has {PLG.num_nodes} nodes")
+
+    with instrumentation.stage("save"):
+        plg.save_plg(PLG, output)
+    print(date_time.get_current_time(), "Saved merged PLG")
+    print(f"PLG merge time taken = {round(time.time() - t_start, 3)} s")
+
+
+if __name__=="__main__":
+    main()
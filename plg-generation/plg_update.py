@@ -0,0 +1,219 @@
+import sys
+import os
+
+# On my machine I need this line otherwise I get a "ModuleNotFoundError" when
+# trying to import the other modules I have written within this directory.
+sys.path.append(os.getcwd())
+sys.path.append(os.path.join(os.getcwd(), "data-processing"))
+
+import argparse
+import time
+import numpy as np
+import functions.general as g
+import functions.graph as graph
+import functions.date_time as date_time
+import functions.instrumentation as instrumentation
+import classes.PLG as plg
+import classes.data as d
+from inputs import *
+
+from data_cleaner import clean_data
+from node_generation import add_nodes
+from get_discrete_vehicle_paths import get_discrete_vehicle_paths
+from adj_mat_generation import remove_long_edges
+
+
+DATA_LOC = "data/"+DATASET+"/cleaned/"
+PLG_SAVE_LOC = "data/"+DATASET+"/data-structures/"
+REPORT_LOC = "data/"+DATASET+"/reports/"
+
+PLG_SAVE_NAME = "PLG"
+DATA_SAVE_NAME = "clean_data_v2"
+
+
+###############################################################################
+# update:                                                                     #
+#                                                                             #
+# Purpose: Update a PLG with newly recorded trajectories without rebuilding   #
+#          it from the whole history. The work done is proportional to the    #
+#          new data:                                                          #
+#                                                                             #
+#          1. Only the new vehicles are cleaned (see clean_data). Their       #
+#             vehicle IDs follow on from the IDs of PLG.vehicle_paths.        #
+#          2. Nodes are only added where a new data point is further than     #
+#             MIN_DIST_BETWEEN_NODES from every node (see add_nodes). The     #
+#             existing nodes are not moved, so the k-means step of            #
+#             node_generation is not rerun.                                   #
+#          3. Only the new paths are discretised.                             #
+#          4. The start and target nodes of the new paths which are not in a  #
+#             cluster yet join the cluster with the closest centre. The       #
+#             clusters themselves are not refitted.                           #
+#          5. The transitions of the new paths are added to the stored counts #
+#             (PLG.adjmat_counts and PLG.transition_counts_given_target) and  #
+#             only the rows they changed are normalised again. The columns of #
+#             the next node table for those rows are recomputed.              #
+#                                                                             #
+#          The paths of the old data are not discretised again against the    #
+#          new nodes so the result can differ slightly from regenerating the  #
+#          PLG from scratch on all of the data. Regenerate the PLG with       #
+#          plg_generation.py from time to time to refit the nodes and         #
+#          clusters.                                                          #
+#                                                                             #
+#          The new data must be in the same frame as the PLG, i.e., loaded    #
+#          with load_data(origin=PLG.origin). Otherwise it is shifted by the  #
+#          difference between the two origins and no longer lines up with    #
+#          the nodes.                                                         #
+#                                                                             #
+# Params: IN/OUT PLG      - A PLG object of type "PLG" defined in             #
+#                           classes/PLG.py, generated by plg_generation.py.   #
+#         IN     new_data - The new data in the format of the original        #
+#                           dataset (see classes/data.py load_data), loaded   #
+#                           with the origin of the PLG.                       #
+#         OUT    cleaned  - The cleaned new data, with the closest node of    #
+#                           each data point in cleaned.node.                  #
+#                                                                             #
+###############################################################################
+def update(PLG, new_data):
+    if (getattr(PLG, "adjmat_counts", None) is None) or (getattr(PLG, "transition_counts_given_target", None) is None):
+        raise ValueError("The PLG has no transition counts, regenerate it with plg_generation.py before updating it")
+    if (getattr(PLG, "origin", None) is not None) and (getattr(new_data, "origin", None) is not None) and not np.allclose(PLG.origin, new_data.origin):
+        raise ValueError(f"The new data was loaded with the origin {new_data.origin} but the PLG has the origin {PLG.origin}, load it with load_data(origin=PLG.origin)")
+    old_num_nodes = PLG.num_nodes
+    num_target_clusters = len(PLG.closest_clusters_dict)
+
+    # Clean the new vehicles and give them vehicle IDs which follow on from
+    # the vehicle IDs already in the PLG
+    with instrumentation.stage("clean_data") as record:
+        cleaned = clean_data(new_data)
+        vehicle_id_offset = max(PLG.vehicle_paths) + 1 if len(PLG.vehicle_paths) > 0 else 0
+        cleaned.vehicle_id = cleaned.vehicle_id + vehicle_id_offset
+        cleaned.vehicle_sese[:,0] += vehicle_id_offset
+        record.count("data_points", len(new_data.x))
+
+    # Add nodes where the new data is far from the existing nodes
+    with instrumentation.stage("add_nodes") as record:
+        PLG.nodes, PLG.node_lane_ids = add_nodes(np.asarray(PLG.nodes), PLG.node_lane_ids, g.iter_chunks(cleaned.x, cleaned.y, cleaned.lane_id, chunk_size=STREAMING_CHUNK_SIZE))
+        PLG.num_nodes = len(PLG.nodes)
+        record.count("new_nodes", PLG.num_nodes - old_num_nodes)
+
+    # Discretise the new paths against the updated node set
+    with instrumentation.stage("get_discrete_vehicle_paths") as record:
+        new_paths_PLG = plg.PLG()
+        new_paths_PLG.nodes = PLG.nodes
+        new_paths_PLG.num_nodes = PLG.num_nodes
+        get_discrete_vehicle_paths(cleaned, new_paths_PLG)
+        new_paths = new_paths_PLG.vehicle_paths
+        record.count("vehicles", len(new_paths))
+
+    # Put the new start and target nodes into the closest clusters
+    with instrumentation.stage("cluster_assignment"):
+        PLG.start_clusters, PLG.node_start_cluster, PLG.start_cluster_mask = add_to_closest_clusters(PLG.start_clusters, PLG.start_cluster_centres, PLG.nodes, [path[0] for path in new_paths.values()])
+        PLG.target_clusters, PLG.node_target_cluster, PLG.target_cluster_mask = add_to_closest_clusters(PLG.target_clusters, PLG.target_cluster_centres, PLG.nodes, [path[-1] for path in new_paths.values()])
+
+    # Add the transitions of the new paths to the counts and normalise the
+    # rows they changed
+    with instrumentation.stage("update_transitions") as record:
+        current_nodes, next_nodes = remove_long_edges(PLG.nodes, *graph.get_path_edges(new_paths))
+        new_adjmat_counts = graph.get_transition_counts(current_nodes, next_nodes, PLG.num_nodes)
+        PLG.adjmat_counts = g.pad_sparse_matrix(PLG.adjmat_counts, (PLG.num_nodes, PLG.num_nodes)) + new_adjmat_counts
+        PLG.adjmat = g.update_normalised_rows(PLG.adjmat, PLG.adjmat_counts, np.unique(current_nodes))
+        record.count("edges", len(current_nodes))
+
+        new_counts_given_target = graph.get_transition_counts_given_target(new_paths, PLG.node_target_cluster, num_target_clusters, PLG.num_nodes)
+        updated_nodes = [np.arange(old_num_nodes, PLG.num_nodes)]
+        for ii in range(num_target_clusters):
+            changed_rows = np.flatnonzero(np.diff(new_counts_given_target[ii].indptr))
+            PLG.transition_counts_given_target[ii] = g.pad_sparse_matrix(PLG.transition_counts_given_target[ii], (PLG.num_nodes, PLG.num_nodes)) + new_counts_given_target[ii]
+            PLG.p_next_node_given_target[ii] = g.update_normalised_rows(PLG.p_next_node_given_target[ii], PLG.transition_counts_given_target[ii], changed_rows)
+            updated_nodes.append(changed_rows)
+
+    # Recompute the next node table for the nodes whose rows changed in any
+    # of the transition matrices, as the table falls back to the other
+    # clusters
+    with instrumentation.stage("next_node_table") as record:
+        updated_nodes = np.unique(np.concatenate(updated_nodes))
+        next_node_given_target = np.full((num_target_clusters, PLG.num_nodes), graph.NO_NODE, dtype=np.int32)
+        next_node_given_target[:,:old_num_nodes] = PLG.next_node_given_target
+        next_node_given_target[:,updated_nodes] = graph.get_next_node_given_target_table(PLG.p_next_node_given_target, PLG.closest_clusters_dict, PLG.num_nodes, nodes=updated_nodes)
+        PLG.next_node_given_target = next_node_given_target
+        record.count("nodes", len(updated_nodes))
+
+    PLG.vehicle_paths.update(new_paths)
+
+    return cleaned
+
+
+###############################################################################
+# add_to_closest_clusters:                                                    #
+#                                                                             #
+# Purpose: Add the nodes which are not in any of the clusters yet to the      #
+#          cluster with the closest centre.                                   #
+#                                                                             #
+# Params: IN  clusters        - Dictionary of {cluster id : [list of nodes]}. #
+#         IN  cluster_centres - 2D numpy array, the [x, y] centre of each     #
+#                               cluster.                                      #
+#         IN  nodes           - 2D numpy array of the [x, y] node coordinates.#
+#         IN  cluster_nodes   - The nodes which should be in a cluster.       #
+#         OUT clusters        - The updated clusters.                         #
+#         OUT node_cluster    - See graph.get_cluster_membership.             #
+#         OUT cluster_mask    - See graph.get_cluster_membership.             #
+#                                                                             #
+###############################################################################
+def add_to_closest_clusters(clusters, cluster_centres, nodes, cluster_nodes):
+    num_clusters = len(cluster_centres)
+    node_cluster, _ = graph.get_cluster_membership(clusters, num_clusters, len(nodes))
+    cluster_nodes = np.unique(np.asarray(cluster_nodes, dtype=np.int64))
+    new_nodes = cluster_nodes[node_cluster[cluster_nodes] < 0]
+    closest_clusters = graph.get_closest_nodes(cluster_centres, nodes[new_nodes])
+
+    clusters = {ii: list(clusters[ii]) for ii in clusters}
+    for node, cluster in zip(new_nodes.tolist(), closest_clusters.tolist()):
+        clusters[cluster].append(node)
+
+    node_cluster, cluster_mask = graph.get_cluster_membership(clusters, num_clusters, len(nodes))
+    return clusters, node_cluster, cluster_mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the PLG of DATASET with newly recorded trajectories.")
+    parser.add_argument("new_data_loc", help="directory holding the Global_X, Global_Y, Vehicle_ID (and Lane_ID) files of the new data")
+    args = parser.parse_args()
+
+    # Record the time and memory used by each stage of the run
+    with instrumentation.for_script("plg_update", REPORT_LOC):
+        run_plg_update(args.new_data_loc)
+
+
+def run_plg_update(new_data_loc):
+    # Time the script
+    t_start = time.time()
+    print(date_time.get_current_time(), "Program started")
+
+    # Load the PLG and the new data, in the frame of the PLG
+    with instrumentation.stage("load") as record:
+        PLG = plg.load_plg(PLG_SAVE_LOC+PLG_SAVE_NAME)
+        PLG.load_all_attributes()
+        if PLG.origin is None:
+            raise ValueError("The PLG has no origin, rerun data_cleaner.py and plg_generation.py before updating it")
+        new_data = d.load_data(data_loc=new_data_loc, origin=PLG.origin)
+        record.count("data_points", len(new_data.x))
+    print(date_time.get_current_time(), "Loaded PLG and new data")
+
+    # Update the PLG
+    with instrumentation.stage("update") as record:
+        old_num_nodes = PLG.num_nodes
+        cleaned = update(PLG, new_data)
+        record.count("data_points", cleaned.num_data_points)
+    print(date_time.get_current_time(), f"Updated PLG with {len(cleaned.vehicle_sese)} new vehicle paths and {PLG.num_nodes - old_num_nodes} new nodes")
+
+    # Save the PLG and the cleaned new data next to the cleaned dataset, it
+    # is appended to the cleaned dataset when the PLG is next regenerated
+    with instrumentation.stage("save"):
+        plg.save_plg(PLG, PLG_SAVE_LOC+PLG_SAVE_NAME)
+        d.save_cleaned_data_update(cleaned, DATA_LOC+DATA_SAVE_NAME, os.path.basename(os.path.normpath(new_data_loc)))
+    print(date_time.get_current_time(), "Saved PLG and clean new data")
+    print(f"PLG update time taken = {round(time.time() - t_start, 3)} s")
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,276 @@
+import numpy as np
+import math
+import functions.general as g
+import functions.graph as graph
+import functions.parallel as parallel
+import functions.instrumentation as instrumentation
+import classes.PLG as plg
+import classes.data as d
+from node_generation import node_generation
+from inputs import *
+
+
+###############################################################################
+# Tiled PLG generation:                                                       #
+#                                                                             #
+# For city scale maps the node generation and discretisation stages can be    #
+# run tile by tile instead of over the whole map at once. The map is split    #
+# into square tiles of side TILE_SIZE. Each tile "owns" the nodes and data    #
+# points in its core, i.e. the tile itself, and also sees TILE_OVERLAP metres #
+# into its neighbours so that the tiles join up at their borders. The node    #
+# IDs are numbered tile by tile, in the order of get_tile_grid, so they are   #
+# the same however many workers are used.                                     #
+#                                                                             #
+# The other stages already work on the sparse transition counts and only     #
+# depend on the vehicle paths, so they are run on the stitched PLG as usual.  #
+#                                                                             #
+# The coordinates are read STREAMING_CHUNK_SIZE data points at a time, so     #
+# memory mapped data (see load_data) is never read in one go by the parent    #
+# process. The parent does still hold, for the whole map, the indices of the  #
+# data points of every tile (8 bytes per data point and per tile it is in,    #
+# i.e., more with a larger TILE_OVERLAP), the node of every data point        #
+# (data.node) and the stitched PLG, e.g. the nodes and vehicle paths.         #
+###############################################################################
+
+
+###############################################################################
+# get_tile_grid:                                                              #
+#                                                                             #
+# Purpose: Get the grid of tiles which covers every data point.               #
+#                                                                             #
+# Params: IN  x, y      - 1D numpy arrays of the data point coordinates.      #
+#         IN  tile_size - The side of each tile in metres.                    #
+#         OUT tile_grid - (x min, y min, number of tiles in x, number of      #
+#                         tiles in y). Tile (ii, jj) is numbered              #
+#                         ii*num_tiles_y + jj.                                #
+#                                                                             #
+###############################################################################
+def get_tile_grid(x, y, tile_size):
+    x_min, x_max, y_min, y_max = math.inf, -math.inf, math.inf, -math.inf
+    for (_, chunk_x, chunk_y) in g.iter_chunks(x, y, chunk_size=STREAMING_CHUNK_SIZE):
+        x_min, x_max = min(x_min, float(np.min(chunk_x))), max(x_max, float(np.max(chunk_x)))
+        y_min, y_max = min(y_min, float(np.min(chunk_y))), max(y_max, float(np.max(chunk_y)))
+    num_tiles_x = max(1, math.floor((x_max - x_min) / tile_size) + 1)
+    num_tiles_y = max(1, math.floor((y_max - y_min) / tile_size) + 1)
+    return (x_min, y_min, num_tiles_x, num_tiles_y)
+
+
+###############################################################################
+# get_tile_points:                                                            #
+#                                                                             #
+# Purpose: Group the indices of the data points (or nodes) by the tiles they  #
+#          lie in. With an overlap a point is in every tile whose core,       #
+#          grown by the overlap, contains it. The points are read             #
+#          STREAMING_CHUNK_SIZE at a time, only the indices are kept for the  #
+#          whole map.                                                         #
+#                                                                             #
+# Params: IN  x, y        - 1D numpy arrays of the point coordinates.         #
+#         IN  tile_grid   - See get_tile_grid.                                #
+#         IN  tile_size   - The side of each tile in metres.                  #
+#         IN  overlap     - How far each tile reaches into its neighbours.    #
+#                           Defaults to 0, i.e., each point is in one tile.   #
+#         OUT tile_points - Dictionary of {tile : numpy array of indices}, in #
+#                           tile order. The indices of each tile are in       #
+#                           ascending order.                                  #
+#                                                                             #
+###############################################################################
+def get_tile_points(x, y, tile_grid, tile_size, overlap=0):
+    # The chunks are in order, so the indices of each tile stay in ascending
+    # order when the chunks of a tile are concatenated
+    tile_chunks = {}
+    for (chunk_start, chunk_x, chunk_y) in g.iter_chunks(x, y, chunk_size=STREAMING_CHUNK_SIZE):
+        for tile, points in get_chunk_tile_points(chunk_x, chunk_y, tile_grid, tile_size, overlap):
+            tile_chunks.setdefault(tile, []).append(points + chunk_start)
+    return {tile: np.concatenate(tile_chunks[tile]) for tile in sorted(tile_chunks)}
+
+
+###############################################################################
+# get_chunk_tile_points:                                                      #
+#                                                                             #
+# Purpose: get_tile_points for one chunk of points held in memory. Returns    #
+#          (tile, numpy array of the indices of its points in the chunk)      #
+#          pairs in tile order, the indices of each tile are ascending.       #
+###############################################################################
+def get_chunk_tile_points(x, y, tile_grid, tile_size, overlap):
+    x_min, y_min, num_tiles_x, num_tiles_y = tile_grid
+    tile_x = np.clip(np.floor((x - x_min) / tile_size).astype(np.int64), 0, num_tiles_x - 1)
+    tile_y = np.clip(np.floor((y - y_min) / tile_size).astype(np.int64), 0, num_tiles_y - 1)
+
+    # Every tile within "reach" tiles of the point's own tile may overlap it
+    reach = math.ceil(overlap / tile_size)
+    tiles = []
+    points = []
+    for dx in range(-reach, reach + 1):
+        for dy in range(-reach, reach + 1):
+            neighbour_x = tile_x + dx
+            neighbour_y = tile_y + dy
+            is_in_tile = (neighbour_x >= 0) & (neighbour_x < num_tiles_x) & (neighbour_y >= 0) & (neighbour_y < num_tiles_y)
+            if (dx != 0) or (dy != 0):
+                # The point must be within the overlap of the neighbour's core
+                is_in_tile &= (x >= x_min + neighbour_x*tile_size - overlap) & (x < x_min + (neighbour_x + 1)*tile_size + overlap)
+                is_in_tile &= (y >= y_min + neighbour_y*tile_size - overlap) & (y < y_min + (neighbour_y + 1)*tile_size + overlap)
+            tiles.append((neighbour_x*num_tiles_y + neighbour_y)[is_in_tile])
+            points.append(np.flatnonzero(is_in_tile))
+    tiles = np.concatenate(tiles)
+    points = np.concatenate(points)
+
+    # Sort by tile and then by point
+    sort_idx = np.lexsort((points, tiles))
+    unique_tiles, tile_starts = np.unique(tiles[sort_idx], return_index=True)
+    return zip(unique_tiles.tolist(), np.split(points[sort_idx], tile_starts[1:]))
+
+
+def get_tile_bounds(tile, tile_grid, tile_size):
+    """Returns the (x min, x max, y min, y max) of the core of a tile."""
+    x_min, y_min, _, num_tiles_y = tile_grid
+    tile_x, tile_y = divmod(tile, num_tiles_y)
+    return (x_min + tile_x*tile_size, x_min + (tile_x + 1)*tile_size, y_min + tile_y*tile_size, y_min + (tile_y + 1)*tile_size)
+
+
+###############################################################################
+# tiled_node_generation:                                                      #
+#                                                                             #
+# Purpose: Tiled version of node_generation. node_generation is run on the    #
+#          data points of each tile, including its overlap, in a process      #
+#          pool. Each tile keeps the nodes which end up in its core and the   #
+#          nodes of the tiles are then concatenated in tile order.            #
+#                                                                             #
+# Params: IN/OUT PLG         - See node_generation.                           #
+#         IN     data        - See node_generation.                           #
+#         IN     num_workers - Number of worker processes. Defaults to        #
+#                              NUM_WORKERS in inputs.py, 1 always runs        #
+#                              serially.                                      #
+#                                                                             #
+###############################################################################
+def tiled_node_generation(PLG, data, num_workers=None):
+    tile_grid = get_tile_grid(data.x, data.y, TILE_SIZE)
+    tile_points = get_tile_points(data.x, data.y, tile_grid, TILE_SIZE, overlap=TILE_OVERLAP)
+
+    # The data points of each tile are only gathered when the tile is
+    # submitted to the pool
+    tiles = list(tile_points.keys())
+    tile_data = ((data.x[tile_points[tile]], data.y[tile_points[tile]], data.lane_id[tile_points[tile]]) for tile in tiles)
+    tile_bounds = [get_tile_bounds(tile, tile_grid, TILE_SIZE) for tile in tiles]
+
+    with instrumentation.stage("tile_nodes") as record:
+        record.count("tiles", len(tiles))
+        tile_nodes = list(parallel.map_lazily(generate_tile_nodes, tile_data, tile_bounds, num_workers=num_workers))
+
+    # Stitch the tiles together
+    PLG.nodes = np.concatenate([nodes for (nodes, _) in tile_nodes])
+    PLG.node_lane_ids = np.concatenate([node_lane_ids for (_, node_lane_ids) in tile_nodes])
+    PLG.num_nodes = len(PLG.nodes)
+
+    return True
+
+
+###############################################################################
+# generate_tile_nodes:                                                        #
+#                                                                             #
+# Purpose: Run node_generation on the data points of one tile and keep the    #
+#          nodes in the tile's core. This is run by the worker processes so   #
+#          it must stay at module level.                                      #
+#                                                                             #
+# Params: IN  tile_data     - (x, y, lane_id) of the data points of the tile, #
+#                             including its overlap, in the order of the      #
+#                             cleaned data.                                   #
+#         IN  tile_bounds   - (x min, x max, y min, y max) of the tile core.  #
+#         OUT nodes         - 2D numpy array, the nodes in the tile core.     #
+#         OUT node_lane_ids - The lane ID of each node.                       #
+#                                                                             #
+###############################################################################
+def generate_tile_nodes(tile_data, tile_bounds):
+    data = d.data()
+    data.x, data.y, data.lane_id = (np.asarray(column) for column in tile_data)
+    data.lane_sese = g.get_se_matrix(data.lane_id)
+    data.num_data_points = len(data.x)
+
+    tile_PLG = plg.PLG()
+    node_generation(tile_PLG, data, num_workers=1)
+
+    x_min, x_max, y_min, y_max = tile_bounds
+    nodes = tile_PLG.nodes
+    is_in_core = (nodes[:,0] >= x_min) & (nodes[:,0] < x_max) & (nodes[:,1] >= y_min) & (nodes[:,1] < y_max)
+    return nodes[is_in_core], tile_PLG.node_lane_ids[is_in_core]
+
+
+###############################################################################
+# tiled_discrete_vehicle_paths:                                               #
+#                                                                             #
+# Purpose: Tiled version of get_discrete_vehicle_paths. The closest node to   #
+#          the data points in the core of each tile is searched for among the #
+#          nodes of the tile and its overlap only, in a process pool. A node  #
+#          outside of the overlap is further than TILE_OVERLAP from every     #
+#          data point in the core, so if the closest node found is within     #
+#          TILE_OVERLAP it is also the closest node of all. The rare data     #
+#          points without a node within TILE_OVERLAP are searched for among   #
+#          all of the nodes, so the result is the same as                     #
+#          get_discrete_vehicle_paths.                                        #
+#                                                                             #
+# Params: IN/OUT data        - See get_discrete_vehicle_paths.                #
+#         IN/OUT PLG         - See get_discrete_vehicle_paths.                #
+#         IN     num_workers - Number of worker processes. Defaults to        #
+#                              NUM_WORKERS in inputs.py, 1 always runs        #
+#                              serially.                                      #
+#                                                                             #
+###############################################################################
+def tiled_discrete_vehicle_paths(data, PLG, num_workers=None):
+    nodes = np.asarray(PLG.nodes)
+    tile_grid = get_tile_grid(data.x, data.y, TILE_SIZE)
+    tile_points = get_tile_points(data.x, data.y, tile_grid, TILE_SIZE)
+    tile_nodes = get_tile_points(nodes[:,0], nodes[:,1], tile_grid, TILE_SIZE, overlap=TILE_OVERLAP)
+
+    # The data points and nodes of each tile are only gathered when the tile
+    # is submitted to the pool. Tiles without any nearby nodes are searched
+    # against all of the nodes.
+    tiles = list(tile_points.keys())
+    all_nodes = np.arange(len(nodes))
+    tile_node_ids = [tile_nodes.get(tile, all_nodes) for tile in tiles]
+    tile_data = ((np.column_stack((data.x[tile_points[tile]], data.y[tile_points[tile]])), nodes[node_ids], node_ids) for tile, node_ids in zip(tiles, tile_node_ids))
+
+    nodal_data = np.full(len(data.x), -1, dtype=np.int64)
+    with instrumentation.stage("tile_discretisation") as record:
+        record.count("tiles", len(tiles))
+        for tile, closest_nodes in zip(tiles, parallel.map_lazily(discretise_tile, tile_data, num_workers=num_workers)):
+            nodal_data[tile_points[tile]] = closest_nodes
+
+    # Search the data points which had no node within the overlap among all
+    # of the nodes
+    is_missing = nodal_data < 0
+    if np.any(is_missing):
+        nodal_data[is_missing] = graph.get_closest_nodes(nodes, np.column_stack((np.asarray(data.x)[is_missing], np.asarray(data.y)[is_missing])))
+
+    # Cycle through each vehicle path and calculate it's discretised version.
+    # Only keep the first instance of each node in the discrete path, see
+    # get_discrete_vehicle_paths.
+    vehicle_index = g.SEIndex(data.vehicle_sese)
+    discrete_vehicle_paths = {}
+    for vehicle_id in vehicle_index.se_mat[:,0]:
+        discrete_vehicle_paths[vehicle_id] = list(dict.fromkeys(vehicle_index.extract(vehicle_id, nodal_data)))
+
+    PLG.vehicle_paths = discrete_vehicle_paths
+    data.node = nodal_data
+
+    return True
+
+
+###############################################################################
+# discretise_tile:                                                            #
+#                                                                             #
+# Purpose: Find the closest node to each data point of a tile. This is run by #
+#          the worker processes so it must stay at module level.              #
+#                                                                             #
+# Params: IN  tile_data     - (points, node coordinates, node IDs) of the     #
+#                             tile: a 2D numpy array of the [x, y] data       #
+#                             points in the tile core, a 2D numpy array of    #
+#                             the [x, y] nodes in the tile and its overlap    #
+#                             and their node IDs.                             #
+#         OUT closest_nodes - The ID of the closest node to each data point,  #
+#                             or -1 if there is no node within TILE_OVERLAP.  #
+#                                                                             #
+###############################################################################
+def discretise_tile(tile_data):
+    points, nodes, node_ids = tile_data
+    closest_nodes = graph.get_closest_nodes(nodes, points)
+    distance = np.hypot(points[:,0] - nodes[closest_nodes,0], points[:,1] - nodes[closest_nodes,1])
+    return np.where(distance <= TILE_OVERLAP, node_ids[closest_nodes], -1)
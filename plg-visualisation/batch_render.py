@@ -0,0 +1,268 @@
+import sys
+import os
+
+# On my machine I need this line otherwise I get a "ModuleNotFoundError" when
+# trying to import the other modules I have written within this directory.
+sys.path.append(os.getcwd())
+
+# Render without a display. This must be set before pyplot is imported by
+# any of the modules below.
+import matplotlib
+matplotlib.use("Agg")
+
+import argparse
+import json
+import hashlib
+import time
+import functools
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import functions.date_time as date_time
+import functions.graph as graph
+import functions.parallel as parallel
+import functions.stage_cache as stage_cache
+import functions.instrumentation as instrumentation
+import classes.PLG as plg
+import classes.data as d
+from inputs import *
+
+from plg_visualisation import rasterise_background_data
+
+
+DATA_LOC = "data/"+DATASET+"/cleaned/"
+PLG_SAVE_LOC = "data/"+DATASET+"/data-structures/"
+RENDER_LOC = "data/"+DATASET+"/renders/"
+REPORT_LOC = "data/"+DATASET+"/reports/"
+
+DATA_SAVE_NAME = "clean_data_v2"
+BACKGROUND_CACHE_NAME = "background_cache"
+
+
+###############################################################################
+# new_render_figure:                                                          #
+#                                                                             #
+# Purpose: Create a figure of width x height pixels whose axes fill the whole #
+#          figure, so that the background image and the paths drawn over it   #
+#          line up pixel for pixel. Figures are created on an Agg canvas      #
+#          without pyplot so that nothing is kept alive between renders.      #
+#                                                                             #
+###############################################################################
+def new_render_figure(width, height, dpi):
+    fig = Figure(figsize=(width/dpi, height/dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    return fig, ax
+
+
+###############################################################################
+# render_background:                                                          #
+#                                                                             #
+# Purpose: Render the static layer of the plot, i.e. the background data (if  #
+#          PLOT_BACKGROUND_DATA is set) and the PLG, once and save it as a    #
+#          PNG. The axes limits of the image are saved next to it so that     #
+#          the paths can be drawn over it in the same coordinates. The image  #
+#          is cached: it is only rendered again if the PLG, the background    #
+#          data, the size of the image or the plot parameters in inputs.py    #
+#          (see get_background_params) change.                                #
+#                                                                             #
+# Params: IN  PLG        - A PLG object of type "PLG" defined in              #
+#                          classes/PLG.py.                                    #
+#         IN  data       - The cleaned data, or None to leave out the         #
+#                          background data.                                   #
+#         IN  cache_dir  - Directory to keep the rendered backgrounds in.     #
+#         IN  width      - Width of the image in pixels.                      #
+#         IN  height     - Height of the image in pixels.                     #
+#         IN  dpi        - Dots per inch, sets the size of the lines and      #
+#                          markers relative to the image.                     #
+#         OUT fname      - The file name of the background PNG.               #
+#         OUT limits     - (x min, x max, y min, y max) of the axes.          #
+#                                                                             #
+###############################################################################
+def render_background(PLG, data, cache_dir, width, height, dpi):
+    adjmat = PLG.adjmat.tocsr()
+    key_arrays = [np.array([width, height, dpi]), PLG.nodes, PLG.node_lane_ids, adjmat.indptr, adjmat.indices, adjmat.data]
+    if data is not None:
+        key_arrays += [data.x, data.y, data.lane_id]
+    key_description = {"arrays": stage_cache.hash_arrays(*key_arrays), "params": get_background_params(data is not None)}
+    key = hashlib.sha256(json.dumps(key_description, sort_keys=True, default=repr).encode()).hexdigest()
+    fname = os.path.join(cache_dir, key+".png")
+    limits_fname = os.path.join(cache_dir, key+".json")
+    if os.path.isfile(fname) and os.path.isfile(limits_fname):
+        with open(limits_fname, "r") as handle:
+            return fname, tuple(json.load(handle))
+
+    fig, ax = new_render_figure(width, height, dpi)
+    if data is not None:
+        image, extent = rasterise_background_data(data, BACKGROUND_DATA_RESOLUTION, COLOUR_OF_BACKGROUND_DATA, colour_code_lanes=COLOUR_CODE_LANES_IN_BACKGROUND_DATA)
+        ax.imshow(image, extent=extent, origin="lower", interpolation="nearest", zorder=0)
+    graph.draw(PLG, ax=ax)
+    ax.set_aspect("equal", adjustable="datalim")
+
+    # Drawing the figure fixes the axes limits to the aspect ratio
+    fig.canvas.draw()
+    limits = ax.get_xlim() + ax.get_ylim()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fig.savefig(fname, dpi=dpi)
+    with open(limits_fname, "w") as handle:
+        json.dump(limits, handle)
+    return fname, limits
+
+
+def get_background_params(plot_background_data):
+    """Returns the parameters in inputs.py which change how the background
+    image looks, so that changing any of them renders the image again."""
+    params = {"NODE_SIZE": NODE_SIZE,
+              "NODE_COLOUR": NODE_COLOUR,
+              "COLOUR_CODE_LANES_IN_PLG": COLOUR_CODE_LANES_IN_PLG,
+              "EDGE_LINE_WIDTH": EDGE_LINE_WIDTH,
+              "EDGE_COLOUR": EDGE_COLOUR,
+              "SHADE_EDGES_WITH_CONNECTION_PROBABILITY": SHADE_EDGES_WITH_CONNECTION_PROBABILITY,
+              "NODE_LABELS": NODE_LABELS,
+              "NODE_LABELS_FONT_SIZE": NODE_LABELS_FONT_SIZE,
+              "NODE_LABELS_FONT_COLOUR": NODE_LABELS_FONT_COLOUR}
+    if plot_background_data:
+        params.update({"BACKGROUND_DATA_RESOLUTION": BACKGROUND_DATA_RESOLUTION,
+                       "COLOUR_OF_BACKGROUND_DATA": COLOUR_OF_BACKGROUND_DATA,
+                       "COLOUR_CODE_LANES_IN_BACKGROUND_DATA": COLOUR_CODE_LANES_IN_BACKGROUND_DATA})
+    return params
+
+
+@functools.lru_cache(maxsize=1)
+def load_background(fname):
+    """Each worker process only reads the background image once."""
+    return plt.imread(fname)
+
+
+###############################################################################
+# render_path:                                                                #
+#                                                                             #
+# Purpose: Draw one path over the cached background image and save it as a   #
+#          PNG. This is run by the worker processes so it must stay at module #
+#          level.                                                             #
+#                                                                             #
+# Params: IN  background - (file name, limits) returned by render_background. #
+#         IN  path       - 2D numpy array, the [x, y] nodes of the path.      #
+#         IN  title      - Text written in the corner of the image.           #
+#         IN  save_fname - File name of the PNG to write.                     #
+#         IN  image_size - (width, height, dpi) of the image.                 #
+#         OUT save_fname - As above.                                          #
+#                                                                             #
+###############################################################################
+def render_path(background, path, title, save_fname, image_size):
+    background_fname, limits = background
+    width, height, dpi = image_size
+    fig, ax = new_render_figure(width, height, dpi)
+    ax.imshow(load_background(background_fname), extent=limits, interpolation="nearest", aspect="auto", zorder=0)
+    ax.plot(path[:,0], path[:,1], color="orange", linestyle="-", linewidth=1.5, zorder=12)
+    ax.scatter(path[[0],0], path[[0],1], color="blue", marker="x", s=50, zorder=13)
+    ax.scatter(path[[-1],0], path[[-1],1], color="magenta", marker="x", s=50, zorder=13)
+    ax.text(0.01, 0.99, title, transform=ax.transAxes, verticalalignment="top", fontsize=10, zorder=14)
+    ax.set_xlim(limits[:2])
+    ax.set_ylim(limits[2:])
+    fig.savefig(save_fname, dpi=dpi)
+    return save_fname
+
+
+###############################################################################
+# get_paths_to_render:                                                        #
+#                                                                             #
+# Purpose: Get the paths to render as (name, title, node path) tuples. The    #
+#          generated paths go from a random start node to a random target     #
+#          cluster, like PLOT_RANDOM_GENERATED_PATH in plg_visualisation.py.  #
+#          The vehicle paths are the discrete paths of randomly chosen        #
+#          vehicles, or of the vehicles with the given IDs.                   #
+#                                                                             #
+###############################################################################
+def get_paths_to_render(PLG, num_generated_paths, num_vehicle_paths, vehicle_ids, rng):
+    paths = []
+    if num_generated_paths > 0:
+        start_clusters = rng.choice(list(PLG.start_clusters.keys()), num_generated_paths)
+        start_nodes = [rng.choice(PLG.start_clusters[start_cluster]) for start_cluster in start_clusters]
+        target_clusters = rng.choice(list(PLG.target_clusters.keys()), num_generated_paths)
+        generated_paths = graph.batch_path_generation(PLG, start_nodes, target_clusters)
+        for ii, (start_node, target_cluster, path) in enumerate(zip(start_nodes, target_clusters, generated_paths)):
+            # A path which reaches a dead end ends with "None"
+            if path[-1] is None:
+                path = path[:-1]
+            paths.append((f"generated_{ii:06d}", f"Start node {start_node}, target cluster {target_cluster}", path))
+
+    if num_vehicle_paths > 0:
+        vehicle_ids = list(vehicle_ids) + rng.choice(list(PLG.vehicle_paths.keys()), num_vehicle_paths, replace=False).tolist()
+    for vehicle_id in vehicle_ids:
+        paths.append((f"vehicle_{vehicle_id}", f"Vehicle ID {vehicle_id}", PLG.vehicle_paths[vehicle_id]))
+
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the PLG of DATASET with generated and/or recorded vehicle paths drawn over it, one PNG per path.")
+    parser.add_argument("--num-generated-paths", type=int, default=0, help="number of paths to generate with graph.path_generation")
+    parser.add_argument("--num-vehicle-paths", type=int, default=0, help="number of randomly chosen discrete vehicle paths")
+    parser.add_argument("--vehicle-ids", type=int, nargs="*", default=[], help="IDs of vehicles whose discrete paths to render")
+    parser.add_argument("--output", default=RENDER_LOC, help="directory to write the PNGs to")
+    parser.add_argument("--width", type=int, default=1600, help="image width in pixels")
+    parser.add_argument("--height", type=int, default=1200, help="image height in pixels")
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--num-workers", type=int, default=NUM_WORKERS, help="number of worker processes, defaults to NUM_WORKERS in inputs.py")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    # Record the time and memory used by each stage of the run
+    with instrumentation.for_script("batch_render", REPORT_LOC):
+        run_batch_render(args)
+
+
+def run_batch_render(args):
+    # Time the script
+    t_start = time.time()
+    print(date_time.get_current_time(), "Program started")
+    rng = np.random.default_rng(args.seed)
+
+    # Load the PLG and, if it is drawn, the background data
+    with instrumentation.stage("load"):
+        PLG = plg.load_plg(PLG_SAVE_LOC+"PLG")
+        PLG.load_all_attributes()
+        data = d.load_cleaned_data_with_updates(DATA_LOC+DATA_SAVE_NAME) if PLOT_BACKGROUND_DATA else None
+    print(date_time.get_current_time(), "Loaded PLG")
+
+    # Render the PLG once
+    image_size = (args.width, args.height, args.dpi)
+    with instrumentation.stage("render_background"):
+        background = render_background(PLG, data, os.path.join(PLG_SAVE_LOC, BACKGROUND_CACHE_NAME), *image_size)
+    del data
+    print(date_time.get_current_time(), "Rendered background")
+
+    with instrumentation.stage("get_paths") as record:
+        paths = get_paths_to_render(PLG, args.num_generated_paths, args.num_vehicle_paths, args.vehicle_ids, rng)
+        record.count("paths", len(paths))
+    print(date_time.get_current_time(), f"Got {len(paths)} paths to render")
+
+    # Draw each path over the background in a pool of worker processes. Only
+    # the node coordinates of each path are sent to the workers.
+    os.makedirs(args.output, exist_ok=True)
+    save_fnames = [os.path.join(args.output, name+".png") for (name, _, _) in paths]
+    with instrumentation.stage("render_paths") as record:
+        for _ in parallel.map_lazily(render_path,
+                                     (background for _ in paths),
+                                     (PLG.nodes[np.asarray(path, dtype=int)] for (_, _, path) in paths),
+                                     (title for (_, title, _) in paths),
+                                     save_fnames,
+                                     (image_size for _ in paths),
+                                     num_workers=args.num_workers):
+            pass
+        record.count("paths", len(paths))
+
+    # Write an index of the rendered paths for reviewing them
+    with open(os.path.join(args.output, "index.json"), "w") as handle:
+        json.dump([{"file": os.path.basename(save_fname), "title": title, "path": [int(node) for node in path]} for save_fname, (_, title, path) in zip(save_fnames, paths)], handle, indent=1)
+
+    print(date_time.get_current_time(), f"Saved {len(paths)} renders to {args.output}")
+    print(f"Batch render time taken = {round(time.time() - t_start, 3)} s")
+
+
+if __name__=="__main__":
+    main()
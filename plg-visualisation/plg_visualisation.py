@@ -8,8 +8,11 @@ sys.path.append(os.getcwd())
 import functions.general as g
 import functions.date_time as date_time
 import functions.graph as graph
+import classes.PLG as plg
+import classes.data as d
 import time
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
 import random
 from inputs import *
 import numpy as np
@@ -31,6 +34,8 @@ class PLGVisualisationParams:
         self.plot_background_data = PLOT_BACKGROUND_DATA
         self.colour_of_background_data = COLOUR_OF_BACKGROUND_DATA
         self.colour_code_lanes_in_background_data = COLOUR_CODE_LANES_IN_BACKGROUND_DATA
+        self.rasterise_background_data = RASTERISE_BACKGROUND_DATA
+        self.background_data_resolution = BACKGROUND_DATA_RESOLUTION
         # Vehicle path params
         self.plot_random_vehicle_path = PLOT_RANDOM_VEHICLE_PATH
         self.plot_discrete_path = PLOT_DISCRETE_PATH
@@ -39,28 +44,81 @@ class PLGVisualisationParams:
         # Generated path params
         self.plot_start_and_target_clusters = PLOT_START_AND_TARGET_CLUSTERS
         self.plot_random_generated_path = PLOT_RANDOM_GENERATED_PATH
-        # Conditional params
-        if self.colour_code_lanes_in_background_data:
+        # Conditional params. The rasterised background data is coloured by
+        # lane when it is binned, see rasterise_background_data.
+        if self.colour_code_lanes_in_background_data and self.plot_background_data and not self.rasterise_background_data:
             self.colour_of_background_data = self.generate_lane_colours_for_background_data(data)
 
     # Function to generate the colours (in RGB format) for the background data.
     def generate_lane_colours_for_background_data(self, data):
-        lane_colour_dict = {}
-        lane_colour_list = [0 for ii in range(data.num_data_points)]
+        lane_colours, lane_index = generate_lane_colours(data.lane_id)
+        return lane_colours[lane_index]
+
+
+# Function to generate a random colour (in RGB format) for each lane ID.
+# Returns the colours, one row per unique lane ID, and the row of the colour of
+# each element of "lane_ids".
+def generate_lane_colours(lane_ids):
+    unique_lane_ids, lane_index = np.unique(np.asarray(lane_ids), return_inverse=True)
+    return generate_random_colours(len(unique_lane_ids)), lane_index.ravel()
+
+
+# Function to generate "num_colours" random colours (in RGB format), one per
+# row.
+def generate_random_colours(num_colours):
+    return np.array([(random.uniform(COLOUR_LOWER,COLOUR_UPPER), random.uniform(COLOUR_LOWER,COLOUR_UPPER), random.uniform(COLOUR_LOWER,COLOUR_UPPER)) for _ in range(num_colours)]).reshape(-1, 3)
+
+
+# Function to bin the background data into an RGBA image which can be shown
+# with imshow. Without colour coding, each pixel with data in it has the colour
+# "colour" and its opacity grows with the (log) number of data points in it.
+# With colour coding, each pixel has the colour of the lane of the last data
+# point in it, which is the point a scatter plot would draw on top. The data is
+# binned in chunks of STREAMING_CHUNK_SIZE so that memory mapped data is never
+# loaded all at once. Returns the image, as a uint8 RGBA array, and its extent.
+def rasterise_background_data(data, resolution, colour, colour_code_lanes=False, max_pixels=4000):
+    x_min, x_max, y_min, y_max = np.inf, -np.inf, np.inf, -np.inf
+    for (_, chunk_x, chunk_y) in g.iter_chunks(data.x, data.y, chunk_size=STREAMING_CHUNK_SIZE):
+        x_min, x_max = min(x_min, np.min(chunk_x)), max(x_max, np.max(chunk_x))
+        y_min, y_max = min(y_min, np.min(chunk_y)), max(y_max, np.max(chunk_y))
+
+    # Make the pixels larger if the image would be too large
+    resolution = max(resolution, (x_max - x_min)/max_pixels, (y_max - y_min)/max_pixels)
+    num_cols = int((x_max - x_min)/resolution) + 1
+    num_rows = int((y_max - y_min)/resolution) + 1
+
+    # The lanes are numbered by their position in the sorted unique lane IDs,
+    # which are found one chunk at a time
+    if colour_code_lanes:
+        unique_lane_ids = np.zeros(0, dtype=np.asarray(data.lane_id[:0]).dtype)
+        for (_, chunk_lane_ids) in g.iter_chunks(data.lane_id, chunk_size=STREAMING_CHUNK_SIZE):
+            unique_lane_ids = np.union1d(unique_lane_ids, chunk_lane_ids)
+        lane_colours = generate_random_colours(len(unique_lane_ids))
+        pixel_lane = np.zeros(num_rows*num_cols, dtype=np.int32)
+
+    counts = np.zeros(num_rows*num_cols, dtype=np.int32)
+    data_vecs = (data.x, data.y, data.lane_id) if colour_code_lanes else (data.x, data.y)
+    for (_, chunk_x, chunk_y, *chunk_lane_ids) in g.iter_chunks(*data_vecs, chunk_size=STREAMING_CHUNK_SIZE):
+        pixel = ((chunk_y - y_min)/resolution).astype(np.int64)*num_cols + ((chunk_x - x_min)/resolution).astype(np.int64)
+        # Only the pixels in the chunk are counted, so no image sized
+        # temporary array is allocated per chunk
+        chunk_pixels, chunk_counts = np.unique(pixel, return_counts=True)
+        counts[chunk_pixels] += chunk_counts.astype(np.int32)
+        if colour_code_lanes:
+            # The last assignment to each pixel is kept
+            pixel_lane[pixel] = np.searchsorted(unique_lane_ids, chunk_lane_ids[0])
+
+    image = np.zeros((num_rows*num_cols, 4), dtype=np.uint8)
+    has_data = counts > 0
+    if colour_code_lanes:
+        image[has_data,:3] = np.round(255*lane_colours[pixel_lane[has_data]])
+        image[has_data,3] = 255
+    else:
+        image[:,:3] = np.round(255*np.array(mcolors.to_rgb(colour)))
+        image[has_data,3] = np.round(255*(0.25 + 0.75*np.log1p(counts[has_data])/np.log1p(counts.max())))
+    extent = (x_min, x_min + num_cols*resolution, y_min, y_min + num_rows*resolution)
+    return image.reshape(num_rows, num_cols, 4), extent
 
-        # Generate a random tuple of three value for each lane ID
-        for lane_id in data.lane_sese[:,0]:
-            if self.colour_code_lanes_in_background_data:
-                lane_colour_dict[lane_id] = (random.uniform(COLOUR_LOWER,COLOUR_UPPER), random.uniform(COLOUR_LOWER,COLOUR_UPPER), random.uniform(COLOUR_LOWER,COLOUR_UPPER))
-            else:
-                lane_colour_dict[lane_id] = (0, 0, 0)
-
-        # Now generate a list of colours corresponding to each lane ID
-        for ii in range(data.num_data_points):
-            lane_colour_list[ii] = lane_colour_dict[data.lane_id[ii]]
-
-        return lane_colour_list
-            
 
 def main():
     # Time the script
@@ -68,11 +126,11 @@ def main():
     print(date_time.get_current_time(), "Program started")
 
     # Load the cleaned data
-    data = g.load_pickled_data(DATA_LOC+DATA_SAVE_NAME)
+    data = d.load_cleaned_data_with_updates(DATA_LOC+DATA_SAVE_NAME)
     print(date_time.get_current_time(), "Loaded clean data")
 
-    # Create a PLG object
-    PLG = g.load_pickled_data(PLG_SAVE_LOC+"PLG")
+    # Open the PLG, its arrays are only loaded when they are first used
+    PLG = plg.load_plg(PLG_SAVE_LOC+"PLG")
     print(date_time.get_current_time(), "Loaded PLG")
 
     # Get the visualisation parameters
@@ -95,10 +153,11 @@ def main():
         print(date_time.get_current_time(), f"Vehicle ID = {vehicle_id}")
 
         # Get continuous path
-        x_cont = g.se_extraction(vehicle_id, data.x, data.vehicle_sese)
-        y_cont = g.se_extraction(vehicle_id, data.y, data.vehicle_sese)
+        vehicle_index = g.SEIndex(data.vehicle_sese)
+        x_cont = vehicle_index.extract(vehicle_id, data.x)
+        y_cont = vehicle_index.extract(vehicle_id, data.y)
         # Get discrete path
-        n_path = g.se_extraction(vehicle_id, data.node, data.vehicle_sese).astype(int)
+        n_path = vehicle_index.extract(vehicle_id, data.node).astype(int)
         x_disc = PLG.nodes[n_path, 0]
         y_disc = PLG.nodes[n_path, 1]
         # Get average discrete path
@@ -112,7 +171,11 @@ def main():
     # PLOTS
     if vis_params.plot_background_data:
         # Plot the entire dataset in the background
-        plt.scatter(data.x, data.y, color=vis_params.colour_of_background_data, s=1, zorder=0)
+        if vis_params.rasterise_background_data:
+            image, extent = rasterise_background_data(data, vis_params.background_data_resolution, vis_params.colour_of_background_data, colour_code_lanes=vis_params.colour_code_lanes_in_background_data)
+            plt.imshow(image, extent=extent, origin="lower", interpolation="nearest", aspect="auto", zorder=0)
+        else:
+            plt.scatter(data.x, data.y, color=vis_params.colour_of_background_data, s=1, zorder=0)
 
     if vis_params.plot_plg:
         # Plot the PLG   
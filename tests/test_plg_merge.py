@@ -0,0 +1,94 @@
+import sys
+import os
+
+# The PLG generation scripts import each other by module name
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (REPO_ROOT, os.path.join(REPO_ROOT, "data-processing"), os.path.join(REPO_ROOT, "plg-generation"), os.path.join(REPO_ROOT, "benchmarks")):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import copy
+import numpy as np
+import pytest
+import classes.PLG as plg
+import classes.data as d
+import functions.graph as graph
+from synthetic_data import generate_dataset
+from data_cleaner import clean_data
+from node_generation import node_generation
+from get_discrete_vehicle_paths import get_discrete_vehicle_paths
+from adj_mat_generation import adj_mat_generation, remove_long_edges
+from cluster_generation import cluster_generation
+from travel_dict_generation import travel_dict_generation
+from plg_merge import merge_plgs, remove_repeated_nodes
+
+
+def build_plg(dataset_dir, seed):
+    generate_dataset(dataset_dir, num_points=20000, seed=seed)
+    data = clean_data(d.load_data(data_loc=dataset_dir))
+    PLG = plg.PLG()
+    PLG.origin = data.origin
+    node_generation(PLG, data, num_workers=1)
+    get_discrete_vehicle_paths(data, PLG, num_workers=1)
+    adj_mat_generation(PLG)
+    cluster_generation(PLG)
+    travel_dict_generation(PLG)
+    return PLG
+
+
+@pytest.fixture(scope="module")
+def PLGs(tmp_path_factory):
+    return [build_plg(str(tmp_path_factory.mktemp(f"dataset_{seed}")), seed) for seed in (0, 1)]
+
+
+@pytest.fixture(scope="module")
+def merged_plg(PLGs):
+    return merge_plgs(PLGs)
+
+
+def get_shifted_plg(PLG, shift):
+    # The same PLG in a frame whose origin is shift further along
+    shifted = copy.copy(PLG)
+    shifted.origin = np.asarray(PLG.origin) + shift
+    shifted.nodes = np.asarray(PLG.nodes) - shift
+    shifted.start_cluster_centres = np.asarray(PLG.start_cluster_centres) - shift
+    shifted.target_cluster_centres = np.asarray(PLG.target_cluster_centres) - shift
+    return shifted
+
+
+def test_remove_repeated_nodes_keeps_first_instance():
+    assert remove_repeated_nodes([3, 3, 4, 5, 5, 5, 3, 4, 6]) == [3, 4, 5, 6]
+    assert remove_repeated_nodes([7]) == [7]
+    assert remove_repeated_nodes([]) == []
+
+
+def test_merged_counts_match_merged_paths(merged_plg):
+    # Recount the transitions over the merged paths
+    current_nodes, next_nodes = graph.get_path_edges(merged_plg.vehicle_paths)
+    current_nodes, next_nodes = remove_long_edges(merged_plg.nodes, current_nodes, next_nodes)
+    adjmat_counts = graph.get_transition_counts(current_nodes, next_nodes, merged_plg.num_nodes)
+    assert (merged_plg.adjmat_counts != adjmat_counts).nnz == 0
+
+    transition_counts_given_target = graph.get_transition_counts_given_target(merged_plg.vehicle_paths, merged_plg.node_target_cluster, len(merged_plg.target_cluster_centres), merged_plg.num_nodes)
+    assert set(merged_plg.transition_counts_given_target) == set(transition_counts_given_target)
+    for ii, counts in transition_counts_given_target.items():
+        assert (merged_plg.transition_counts_given_target[ii] != counts).nnz == 0
+
+
+def test_merged_paths_have_no_repeated_nodes(merged_plg):
+    for path in merged_plg.vehicle_paths.values():
+        assert len(set(path)) == len(path)
+
+
+def test_merge_shifts_plgs_into_the_same_frame(PLGs):
+    merged = merge_plgs([PLGs[0], get_shifted_plg(PLGs[0], np.array([100.0, -40.0]))])
+    assert merged.num_nodes == PLGs[0].num_nodes
+    assert np.array_equal(merged.origin, PLGs[0].origin)
+    assert (merged.adjmat_counts != 2*PLGs[0].adjmat_counts).nnz == 0
+
+
+def test_merge_rejects_plgs_without_origin(PLGs):
+    without_origin = copy.copy(PLGs[1])
+    without_origin.origin = None
+    with pytest.raises(ValueError):
+        merge_plgs([PLGs[0], without_origin])
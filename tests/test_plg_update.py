@@ -0,0 +1,112 @@
+import sys
+import os
+
+# The PLG generation scripts import each other by module name
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (REPO_ROOT, os.path.join(REPO_ROOT, "data-processing"), os.path.join(REPO_ROOT, "plg-generation"), os.path.join(REPO_ROOT, "benchmarks")):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import numpy as np
+import pytest
+import classes.PLG as plg
+import classes.data as d
+import functions.graph as graph
+from synthetic_data import generate_dataset
+from data_cleaner import clean_data
+from node_generation import node_generation
+from get_discrete_vehicle_paths import get_discrete_vehicle_paths
+from adj_mat_generation import adj_mat_generation, remove_long_edges
+from cluster_generation import cluster_generation
+from travel_dict_generation import travel_dict_generation
+from next_node_table_generation import next_node_table_generation
+from plg_update import update
+import node_generation as node_generation_module
+
+
+def build_plg(dataset_dir):
+    generate_dataset(dataset_dir, num_points=20000, seed=0)
+    data = clean_data(d.load_data(data_loc=dataset_dir))
+    PLG = plg.PLG()
+    PLG.origin = data.origin
+    node_generation(PLG, data, num_workers=1)
+    get_discrete_vehicle_paths(data, PLG, num_workers=1)
+    adj_mat_generation(PLG)
+    cluster_generation(PLG)
+    travel_dict_generation(PLG)
+    next_node_table_generation(PLG)
+    return PLG, data
+
+
+def write_vehicles(dataset_dir, new_data_dir, vehicle_ids):
+    # Copy the data points of the given vehicles to a new dataset
+    columns = {name: np.loadtxt(os.path.join(dataset_dir, name), dtype=str) for name in ("Global_X", "Global_Y", "Vehicle_ID", "Lane_ID")}
+    is_copied = np.isin(columns["Vehicle_ID"].astype(int), vehicle_ids)
+    os.makedirs(new_data_dir)
+    for name, column in columns.items():
+        np.savetxt(os.path.join(new_data_dir, name), column[is_copied], fmt="%s")
+
+
+@pytest.fixture(scope="module")
+def updated_plg(tmp_path_factory):
+    # k-means moves the nodes away from some of the data points, so without
+    # it every data point of the PLG is within MIN_DIST_BETWEEN_NODES of a node
+    dataset_dir = str(tmp_path_factory.mktemp("dataset"))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(node_generation_module, "DO_KMEANS", False)
+        PLG, data = build_plg(dataset_dir)
+    old_num_nodes = PLG.num_nodes
+
+    # Update the PLG with the last vehicles of the dataset again. These don't
+    # start at the minimum x and y of the dataset, so they are only in the
+    # frame of the PLG if they are loaded with its origin.
+    new_data_dir = os.path.join(str(tmp_path_factory.mktemp("new_data")), "original")
+    vehicle_ids = np.unique(np.loadtxt(os.path.join(dataset_dir, "Vehicle_ID"), dtype=int))
+    write_vehicles(dataset_dir, new_data_dir, vehicle_ids[len(vehicle_ids)//2:])
+    new_data = d.load_data(data_loc=new_data_dir, origin=PLG.origin)
+    assert not np.allclose(d.load_data(data_loc=new_data_dir).origin, PLG.origin)
+    cleaned = update(PLG, new_data)
+    return PLG, old_num_nodes, data, cleaned
+
+
+def test_update_with_known_trajectories_adds_no_nodes(updated_plg):
+    PLG, old_num_nodes, _, _ = updated_plg
+    assert PLG.num_nodes == old_num_nodes
+    assert len(PLG.nodes) == old_num_nodes
+
+
+def test_updated_counts_match_recount(updated_plg):
+    PLG, _, _, _ = updated_plg
+
+    # Recount the transitions over all of the paths in the updated PLG
+    current_nodes, next_nodes = remove_long_edges(PLG.nodes, *graph.get_path_edges(PLG.vehicle_paths))
+    adjmat_counts = graph.get_transition_counts(current_nodes, next_nodes, PLG.num_nodes)
+    assert (PLG.adjmat_counts != adjmat_counts).nnz == 0
+
+    transition_counts_given_target = graph.get_transition_counts_given_target(PLG.vehicle_paths, PLG.node_target_cluster, len(PLG.target_cluster_centres), PLG.num_nodes)
+    for ii, counts in transition_counts_given_target.items():
+        assert (PLG.transition_counts_given_target[ii] != counts).nnz == 0
+
+
+def test_cleaned_updates_are_loaded_with_the_cleaned_data(updated_plg, tmp_path):
+    PLG, _, data, cleaned = updated_plg
+    fname = str(tmp_path / "clean_data")
+    d.save_cleaned_data(data, fname)
+    d.save_cleaned_data_update(cleaned, fname, "new_data")
+
+    # The PLG would be regenerated from every vehicle it holds
+    combined = d.load_cleaned_data_with_updates(fname)
+    assert combined.num_data_points == data.num_data_points + cleaned.num_data_points
+    assert set(combined.vehicle_sese[:,0].tolist()) == set(PLG.vehicle_paths)
+    assert np.array_equal(combined.x[data.num_data_points:], cleaned.x)
+
+    d.remove_cleaned_data_updates(fname)
+    assert d.load_cleaned_data_with_updates(fname).num_data_points == data.num_data_points
+
+
+def test_update_rejects_data_in_another_frame(updated_plg):
+    PLG, _, _, _ = updated_plg
+    new_data = d.data()
+    new_data.origin = np.asarray(PLG.origin) + 1.0
+    with pytest.raises(ValueError):
+        update(PLG, new_data)
@@ -0,0 +1,56 @@
+import sys
+import os
+
+# The PLG generation scripts import each other by module name
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (REPO_ROOT, os.path.join(REPO_ROOT, "data-processing"), os.path.join(REPO_ROOT, "plg-generation"), os.path.join(REPO_ROOT, "benchmarks")):
+    if path not in sys.path:
+        sys.path.append(path)
+
+import copy
+import numpy as np
+import pytest
+import classes.PLG as plg
+import classes.data as d
+from synthetic_data import generate_dataset
+from data_cleaner import clean_data
+from node_generation import node_generation
+from get_discrete_vehicle_paths import get_discrete_vehicle_paths
+import tiled_generation
+
+
+@pytest.fixture(scope="module")
+def data_and_nodes(tmp_path_factory):
+    dataset_dir = str(tmp_path_factory.mktemp("dataset"))
+    generate_dataset(dataset_dir, num_points=20000, seed=0)
+    data = clean_data(d.load_data(data_loc=dataset_dir))
+    PLG = plg.PLG()
+    node_generation(PLG, data, num_workers=1)
+    return data, PLG
+
+
+def test_tile_points_do_not_depend_on_the_chunk_size(data_and_nodes, monkeypatch):
+    data, _ = data_and_nodes
+    tile_grid = tiled_generation.get_tile_grid(data.x, data.y, 50)
+    tile_points = tiled_generation.get_tile_points(data.x, data.y, tile_grid, 50, overlap=10)
+    monkeypatch.setattr(tiled_generation, "STREAMING_CHUNK_SIZE", 997)
+    chunked_tile_points = tiled_generation.get_tile_points(data.x, data.y, tile_grid, 50, overlap=10)
+    assert list(tile_points) == list(chunked_tile_points)
+    for tile, points in tile_points.items():
+        assert np.array_equal(points, chunked_tile_points[tile])
+
+
+@pytest.mark.parametrize("chunk_size", [None, 997])
+def test_tiled_paths_match_get_discrete_vehicle_paths(data_and_nodes, monkeypatch, chunk_size):
+    data, PLG = data_and_nodes
+    monkeypatch.setattr(tiled_generation, "TILE_SIZE", 50)
+    monkeypatch.setattr(tiled_generation, "TILE_OVERLAP", 10)
+    monkeypatch.setattr(tiled_generation, "STREAMING_CHUNK_SIZE", chunk_size)
+
+    expected_data, expected_PLG = copy.copy(data), copy.copy(PLG)
+    get_discrete_vehicle_paths(expected_data, expected_PLG, num_workers=1)
+    tiled_data, tiled_PLG = copy.copy(data), copy.copy(PLG)
+    tiled_generation.tiled_discrete_vehicle_paths(tiled_data, tiled_PLG, num_workers=1)
+
+    assert np.array_equal(tiled_data.node, expected_data.node)
+    assert tiled_PLG.vehicle_paths == expected_PLG.vehicle_paths